@@ -9,6 +9,20 @@
 # is chosen by index or by name.  This is specifically suited for regression
 # modules from the statsmodels package.
 #
+# The levels of each variable and the dropped reference levels can also be
+# learned once with `fit` and applied to new batches of data with
+# `transform`, which always gives the same columns in the same order.  Levels
+# that weren't seen by fit are encoded as all zeros, as missing values are.
+# `transform` can return a scipy.sparse CSR matrix instead of a dataframe for
+# variables with many levels, such as route, aircraft or reviewer_country.
+#
+# Datasets too large to load at once are encoded a chunk at a time by
+# `encode_chunks` into a .npy file, which `load_design` memory maps for the
+# regression and bootstrap functions.
+#
+# fit, transform and encode_chunks are recorded as stages when instrumentation
+# is configured, see instrumentation.py.
+#
 # Example usage:
 # example_data = {"id": [1,2,3,4,5,6,7,8],
 #                "price":[22., 21., 17., 35.,12.,17.,18.,19.],
@@ -25,8 +39,25 @@
 # # Do it the dict way:
 # foo = PrepareForModel(example_data)
 # foo.make_dummy_df({"type" : "pinot_noir", "colour" : "red"})
+#
+# # Do it the fit/transform way:
+# foo = PrepareForModel(example_data)
+# foo.fit({"type" : "pinot_noir", "colour" : "red"})
+# foo.transform(new_data)
+# foo.transform(new_data, sparse = True), foo.columns
+#
+# # Do it a chunk at a time:
+# encode_chunks(lambda: pd.read_csv("wine.csv", chunksize = 10000), ["type", "colour"], "wine.npy")
+# X, _, columns = load_design("wine.npy")
+
+import json
+import os
 
+import numpy as np
 import pandas as pd
+import scipy.sparse
+
+from instrumentation import stage
 
 class PrepareForModel:
 
@@ -39,6 +70,8 @@ class PrepareForModel:
 
     Attributes:
         ref_levels (list): list of reference variables that are dropped from the dataframe.
+        levels (dict): for each dummy variable, the levels that are given a column, learned by fit
+        columns (list): names of the columns given by transform, learned by fit
     """
 
     def __init__(self, df):
@@ -47,10 +80,15 @@ class PrepareForModel:
         if not isinstance(df, pd.DataFrame):
             raise Exception("the df argument should be a pandas dataframe class or subclass")
 
-        self.df = df.copy()
-        self.df_orig = df.copy()
+        # encoding builds a new dataframe and never modifies df, so it isn't copied
+        self.df = df
+        self.df_orig = df
         self.ref_levels = []
 
+        self.levels = {}
+        self.kept_columns = []
+        self.columns = []
+
     def make_dummy_df(self, dummy_vars, cat_to_drop = 0, drop_cat = True, add_intercept = True):
         """
         Saves a pandas dataframe ready for statistical modelling with packages like statsmodel.
@@ -81,63 +119,323 @@ class PrepareForModel:
         ## example.make_dummy_df(['colour', 'type'], 0)
         """
 
-        # reset reference levels, if remaking then previous information would be there
-        self.ref_levels = []
+        self.fit(dummy_vars, cat_to_drop = cat_to_drop, drop_cat = drop_cat)
+        self.df = self.transform(self.df_orig, add_intercept = add_intercept)
 
-        # reset to original data.  Ensures that make_dummy_df can be rerun multiple times
-        self.df = self.df_orig.copy()
+        return self.df
 
-        # check if dummy_vars is a dict or a list to determine how to drop categories
-        if isinstance(dummy_vars, list):
-            drop_by_index = True
+    def fit(self, dummy_vars, cat_to_drop = 0, drop_cat = True):
+        """
+        Learns the levels of each variable to be converted to dummies, and the
+        reference level to drop, from the dataframe given to PrepareForModel.
 
-            # make sure that cat_to_drop is within the index range of the selected variables
-            for var in dummy_vars:
-                if self.df[var].nunique() < (cat_to_drop + 1):
-                    raise Exception("For column {} the number of categories was \
-lower than the specified index ({}) to drop.".format(var, cat_to_drop))
-        else:
-            drop_by_index = False
+        Arguments:
+            dummy_vars (list or dict): see make_dummy_df
+            cat_to_drop (int): see make_dummy_df
+            drop_cat (bool): see make_dummy_df
 
-        # loop through categorical columns in dummy_vars list/dict
-        for var in dummy_vars:
+        Return:
+            self
+        """
+
+        with stage("PrepareForModel.fit") as fit_stage:
+            fit_stage.add("items", self.df_orig.shape[0])
+
+            levels = {var : category_levels(self.df_orig[var]) for var in dummy_vars}
+            n_unique = {var : self.df_orig[var].nunique() for var in dummy_vars}
 
-            # convert given variable to a dummy variable
-            current_dummy = pd.DataFrame(self.df[var])
-            current_dummy = pd.get_dummies(current_dummy, prefix = var)
+            return self.fit_levels(dummy_vars, levels, n_unique, cat_to_drop = cat_to_drop, drop_cat = drop_cat)
 
+    def fit_levels(self, dummy_vars, levels, n_unique, cat_to_drop = 0, drop_cat = True):
+        """
+        Picks the reference level to drop from each variable's levels, as
+        fit does, when the levels have been collected some other way, for
+        example chunk by chunk by encode_chunks.
+
+        Arguments:
+            dummy_vars (list or dict): see make_dummy_df
+            levels (dict): every level of each variable, in the order of its columns
+            n_unique (dict): number of distinct values of each variable in the data
+            cat_to_drop (int): see make_dummy_df
+            drop_cat (bool): see make_dummy_df
+
+        Return:
+            self
+        """
 
-            # drop one level as specified by dummy_vars, if drop_cat is true
+        # reset reference levels, if refitting then previous information would be there
+        self.ref_levels = []
+        self.levels = {}
+
+        # check if dummy_vars is a dict or a list to determine how to drop categories
+        drop_by_index = isinstance(dummy_vars, list)
+
+        for var in dummy_vars:
+
+            var_levels = list(levels[var])
+
+            # as pd.get_dummies, the columns are the levels in sorted or category order
             if drop_cat == True:
 
                 # scenario where dummy_vars is a list
                 if drop_by_index == True:
-                    dummy_to_drop = current_dummy.columns[cat_to_drop]
-                    current_dummy = current_dummy.drop([dummy_to_drop], axis = 1)
 
-                    # keep note of the dropped level in ref_levels
-                    self.ref_levels.append(dummy_to_drop)
+                    # make sure that cat_to_drop is within the index range of the selected variables
+                    if n_unique[var] < (cat_to_drop + 1):
+                        raise Exception("For column {} the number of categories was \
+lower than the specified index ({}) to drop.".format(var, cat_to_drop))
+
+                    ref_level = var_levels[cat_to_drop]
 
                 # scenario where dummy_vars is a dict
-                if drop_by_index == False:
-                    dummy_to_drop = var + "_" + dummy_vars[var]
-                    current_dummy = current_dummy.drop([dummy_to_drop], axis = 1)
+                else:
+                    ref_level = dummy_vars[var]
+                    if ref_level not in var_levels:
+                        raise Exception("Column {} has no category {} to drop.".format(var, ref_level))
 
-                    # keep note of the dropped level in ref_levels
-                    self.ref_levels.append(dummy_to_drop)
+                # keep note of the dropped level in ref_levels
+                self.ref_levels.append(var + "_" + str(ref_level))
+                var_levels = [level for level in var_levels if level != ref_level]
 
-            # concat with original dataframe
-            self.df = pd.concat([self.df, current_dummy], axis=1)
+            self.levels[var] = var_levels
 
-        # drop pre-dummy categorical columns from original dataframe
-        if drop_by_index == True:
-            self.df = self.df.drop(dummy_vars, axis=1)
+        # the pre-dummy categorical columns are dropped and the dummies follow
+        # the other columns
+        self.kept_columns = [col for col in self.df_orig.columns if col not in self.levels]
+        self.columns = self.kept_columns + [var + "_" + str(level)
+                                            for var, levels in self.levels.items() for level in levels]
 
-        if drop_by_index == False:
-            self.df = self.df.drop(dummy_vars.keys(), axis=1)
+        return self
 
-        # if int add is true, add int
-        if add_intercept == True:
-            self.df['intercept'] = 1.0
+    def transform(self, df, add_intercept = True, sparse = False):
+        """
+        Encodes a dataframe with the levels learned by fit, giving the same
+        columns in the same order whatever levels df has.
 
-        return self.df
+        Arguments:
+            df (pd.DataFrame): dataframe with the columns of the fitted dataframe
+            add_intercept (bool): whether to add an intercept column of 1s, default True
+            sparse (bool): return a scipy.sparse CSR matrix of floats instead of
+                           a dataframe, in which case every column must be numeric.
+                           The column names are the columns attribute, followed by
+                           intercept if one is added.
+
+        Return:
+            Pandas Dataframe, or CSR matrix, with the dummy variables one hot encoded
+        """
+
+        missing = [col for col in self.kept_columns + list(self.levels) if col not in df.columns]
+        if len(missing) > 0:
+            raise Exception("the df argument is missing the fitted columns {}".format(missing))
+
+        with stage("PrepareForModel.transform", sparse = sparse) as transform_stage:
+            n_rows = df.shape[0]
+            transform_stage.add("items", n_rows)
+
+            if sparse == True:
+                blocks = [scipy.sparse.csr_matrix(df[self.kept_columns].astype(float).to_numpy())]
+                blocks += [dummy_matrix(df[var], levels, sparse = True) for var, levels in self.levels.items()]
+                if add_intercept == True:
+                    blocks.append(scipy.sparse.csr_matrix(np.ones((n_rows, 1))))
+
+                return scipy.sparse.hstack(blocks, format = "csr")
+
+            # build the result in one go from the kept columns and one block of
+            # dummies per variable, rather than concatenating copies
+            columns = {col : df[col] for col in self.kept_columns}
+            for var, levels in self.levels.items():
+                dummies = dummy_matrix(df[var], levels)
+                for position, level in enumerate(levels):
+                    columns[var + "_" + str(level)] = dummies[:, position]
+
+            encoded = pd.DataFrame(columns, index = df.index)
+
+            # if int add is true, add int
+            if add_intercept == True:
+                encoded['intercept'] = 1.0
+
+            return encoded
+
+def category_levels(series):
+    """
+    Levels of a categorical variable in the order pd.get_dummies gives them
+    columns: the categories of a categorical column, otherwise the sorted
+    distinct values.  Missing values aren't a level.
+    """
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        return list(series.cat.categories)
+
+    return sorted(series.dropna().unique())
+
+def dummy_matrix(series, levels, sparse = False):
+    """
+    One hot encodes a variable with given levels.  Values that aren't one of
+    the levels, including missing values and any dropped reference level,
+    are all zeros.
+
+    Arguments:
+        series (pd.Series): the variable
+        levels (list): the levels that are given a column, in order
+        sparse (bool): return a scipy.sparse CSR matrix of floats instead of
+                       an array of uint8
+
+    Return:
+        rows x levels array or CSR matrix of 0s and 1s
+    """
+    codes = pd.Categorical(series, categories = levels).codes
+    rows = np.flatnonzero(codes >= 0)
+
+    if sparse == True:
+        return scipy.sparse.csr_matrix((np.ones(len(rows)), (rows, codes[rows])),
+                                       shape = (len(codes), len(levels)))
+
+    dummies = np.zeros((len(codes), len(levels)), dtype = np.uint8)
+    dummies[rows, codes[rows]] = 1
+
+    return dummies
+
+def encode_chunks(read_chunks, dummy_vars, save_path, response = None, cat_to_drop = 0, drop_cat = True,
+                  add_intercept = True):
+    """
+    Encodes a dataset too large to hold in memory, a chunk at a time, into a
+    float64 .npy file that can be memory mapped.  A first pass over the
+    chunks collects the levels of each dummy variable, so the reference
+    levels are chosen as make_dummy_df would choose them for the whole
+    dataset, and a second pass writes each encoded chunk into the file.
+
+    The column names, response and reference levels are saved next to the
+    file, and load_design memory maps it all again.
+
+    Arguments:
+        read_chunks (function): called with no arguments once per pass, gives an
+                                iterator of dataframe chunks, for example
+                                lambda: iter_reviews(load_path, columns)
+        dummy_vars (list or dict): see make_dummy_df
+        save_path (str): path of the .npy file of the encoded predictors
+        response (str): optional encoded column, such as "recommendation_yes",
+                        saved to its own file instead of with the predictors
+        cat_to_drop (int): see make_dummy_df
+        drop_cat (bool): see make_dummy_df
+        add_intercept (bool): whether to add an intercept column of 1s, default True
+
+    Return:
+        the fitted PrepareForModel, with the levels and ref_levels used
+
+    Example:
+    ## prep = encode_chunks(lambda: iter_reviews("data/all_reviews.parquet", columns),
+    ##                      {"seat_type" : "Economy Class", "recommendation" : "no"},
+    ##                      "data/design.npy", response = "recommendation_yes", add_intercept = False)
+    ## X, y, columns = load_design("data/design.npy")
+    """
+
+    with stage("encode_chunks") as encode_stage:
+        # first pass, the layout of the chunks, the number of rows and the levels
+        layout = None
+        n_rows = 0
+        observed = {var : set() for var in dummy_vars}
+        categories = {var : set() for var in dummy_vars}
+        categorical = {var : True for var in dummy_vars}
+
+        for chunk in read_chunks():
+
+            if layout is None:
+                layout = chunk.iloc[:0]
+            n_rows += chunk.shape[0]
+
+            for var in dummy_vars:
+                observed[var].update(chunk[var].dropna().unique())
+                if isinstance(chunk[var].dtype, pd.CategoricalDtype):
+                    categories[var].add(tuple(chunk[var].cat.categories))
+                else:
+                    categorical[var] = False
+
+        if layout is None:
+            raise Exception("read_chunks gave no chunks to encode")
+
+        # a variable with the same categories in every chunk keeps their order, as
+        # for a single dataframe, otherwise the levels are sorted
+        levels = {}
+        for var in dummy_vars:
+            if categorical[var] and len(categories[var]) == 1:
+                levels[var] = list(next(iter(categories[var])))
+            else:
+                levels[var] = sorted(observed[var].union(*categories[var]))
+
+        prep = PrepareForModel(layout)
+        prep.fit_levels(dummy_vars, levels, {var : len(observed[var]) for var in dummy_vars},
+                        cat_to_drop = cat_to_drop, drop_cat = drop_cat)
+
+        predictors = prep.columns + (["intercept"] if add_intercept == True else [])
+        if response is not None:
+            if response not in predictors:
+                raise Exception("the response {} is not one of the encoded columns".format(response))
+            predictors.remove(response)
+
+        response_path, columns_path = design_paths(save_path)
+
+        design = np.lib.format.open_memmap(save_path, mode = "w+", dtype = np.float64,
+                                           shape = (n_rows, len(predictors)))
+        if response is not None:
+            response_values = np.lib.format.open_memmap(response_path, mode = "w+", dtype = np.float64,
+                                                        shape = (n_rows,))
+
+        # second pass, write each encoded chunk in place
+        start = 0
+        for chunk in read_chunks():
+
+            encoded = prep.transform(chunk, add_intercept = add_intercept)
+            stop = start + encoded.shape[0]
+            if stop > n_rows:
+                raise Exception("read_chunks gave more rows on the second pass than the first")
+
+            design[start:stop] = encoded[predictors].astype(float).to_numpy()
+            if response is not None:
+                response_values[start:stop] = encoded[response].astype(float).to_numpy()
+            start = stop
+
+        if start != n_rows:
+            raise Exception("read_chunks gave fewer rows on the second pass than the first")
+
+        encode_stage.add("items", n_rows)
+        encode_stage.add("bytes_written", design.nbytes)
+
+        design.flush()
+        if response is not None:
+            response_values.flush()
+
+        with open(columns_path, "w") as f:
+            json.dump({"columns" : predictors, "response" : response, "ref_levels" : prep.ref_levels}, f)
+
+        return prep
+
+def load_design(save_path):
+    """
+    Memory maps a design matrix saved by encode_chunks, read only, so that
+    it can be passed to the regression and bootstrap functions without
+    loading it.
+
+    Arguments:
+        save_path (str): path of the .npy file of the encoded predictors
+
+    Return:
+        (X, y, columns) memory mapped predictors, memory mapped response or
+        None if none was saved, and the names of the predictors
+    """
+    response_path, columns_path = design_paths(save_path)
+
+    with open(columns_path) as f:
+        saved = json.load(f)
+
+    X = np.load(save_path, mmap_mode = "r")
+    y = np.load(response_path, mmap_mode = "r") if saved["response"] is not None else None
+
+    return X, y, saved["columns"]
+
+def design_paths(save_path):
+    """
+    Paths of the response and of the column names saved alongside a design
+    matrix by encode_chunks.
+    """
+    base = os.path.splitext(save_path)[0]
+
+    return base + "_response.npy", base + "_columns.json"
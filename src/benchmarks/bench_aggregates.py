@@ -0,0 +1,129 @@
+#
+# bench_aggregates.py
+#
+# @author: Evan Yathon
+#
+# August 2019
+#
+# bench_aggregates times the review aggregate store (review_aggregates.py)
+# against the pandas groupbys over every review that the EDA notebook runs.
+# The reviews are --scale copies of the cleaned reviews for each of
+# --n_airlines airlines, each copy moved back a few years so that the history
+# grows, and the store is timed on
+#
+# - building it from all of the reviews
+# - adding a batch of --n_new new reviews, against regrouping every review
+# - monthly summaries and rating distributions of one airline and a slice,
+#   against the same groupbys over the reviews
+#
+# sample usage
+# python src/benchmarks/bench_aggregates.py --n_airlines 20 --scale 50
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from review_aggregates import ReviewAggregates
+from review_store import read_reviews
+
+def synthetic_reviews(reviews, n_airlines, scale):
+    """
+    synthetic_reviews copies the reviews scale times for each airline, moving
+    each copy back 3 years and marking its titles so every review is distinct.
+    """
+    copies = []
+    for airline in range(n_airlines):
+        for copy in range(scale):
+            copies.append(reviews.assign(
+                airline = "airline-{}".format(airline),
+                date_of_review = reviews["date_of_review"] - pd.DateOffset(years = 3 * copy),
+                title = reviews["title"].astype(str) + " #{}".format(copy)))
+
+    return pd.concat(copies, ignore_index = True)
+
+def best_time(function, repeat):
+    """
+    best_time runs a function repeat times.
+
+    Return:
+        (seconds of the fastest run, result of the last run)
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best, result
+
+def pandas_summary(reviews, start, airline, seat_type):
+    """
+    pandas_summary computes a monthly summary of one airline and seat type
+    directly from the reviews, as the notebook's groupbys would.
+    """
+    selected = reviews[(reviews["airline"] == airline) & (reviews["seat_type"] == seat_type) &
+                       (reviews["date_of_review"] >= start)]
+    months = selected["date_of_review"].dt.strftime("%Y-%m")
+
+    return selected.groupby(months).agg(reviews = ("title", "size"), review_value_mean = ("review_value", "mean"),
+                                        seat_comfort_rating_mean = ("seat_comfort_rating", "mean"))
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--load_path", default = "data/cleaned_gw_reviews.csv")
+    parser.add_argument("--n_airlines", type = int, default = 20)
+    parser.add_argument("--scale", type = int, default = 20)
+    parser.add_argument("--n_new", type = int, default = 1000)
+    parser.add_argument("--repeat", type = int, default = 5)
+    args = parser.parse_args()
+
+    reviews = synthetic_reviews(read_reviews(args.load_path), args.n_airlines, args.scale)
+    new_reviews = reviews.sample(args.n_new, random_state = 0).assign(
+        title = lambda df: df["title"] + " (new)")
+    history, new_reviews = reviews, new_reviews.reset_index(drop = True)
+
+    start = time.perf_counter()
+    aggregates = ReviewAggregates()
+    aggregates.update(history)
+    build = time.perf_counter() - start
+
+    sys.stdout.write("{} reviews, {} buckets, {} rating buckets, built in {:.2f}s\n".format(
+        aggregates.n_reviews, len(aggregates.cell_reviews), len(aggregates.rating_counts), build))
+
+    start = time.perf_counter()
+    assert aggregates.update(new_reviews) == len(new_reviews)
+    update = time.perf_counter() - start
+
+    combined = pd.concat([history, new_reviews], ignore_index = True)
+    regroup, _ = best_time(lambda: combined.groupby(
+        [combined["airline"], combined["date_of_review"].dt.strftime("%Y-%m"), "seat_type"],
+        observed = True)["review_value"].agg(["size", "mean"]), 1)
+
+    sys.stdout.write("add {} reviews: store {:.3f}s, regrouping every review {:.3f}s\n".format(
+        len(new_reviews), update, regroup))
+
+    query = {"start" : "2005-01", "airline" : "airline-0", "seat_type" : "Economy Class"}
+    store_time, summary = best_time(lambda: aggregates.summary(by = ["month"], **query), args.repeat)
+    pandas_time, expected = best_time(lambda: pandas_summary(combined, pd.Timestamp(query["start"]),
+                                                             query["airline"], query["seat_type"]), args.repeat)
+
+    assert (summary["reviews"].values == expected["reviews"].values).all()
+    assert np.allclose(summary["review_value_mean"].values, expected["review_value_mean"].astype(float).values,
+                       equal_nan = True)
+
+    sys.stdout.write("monthly summary of one airline: store {:.2f}ms, pandas {:.2f}ms\n".format(
+        store_time * 1e3, pandas_time * 1e3))
+
+    store_time, _ = best_time(lambda: aggregates.summary(by = ["airline", "reviewer_country"]), args.repeat)
+    sys.stdout.write("summary of every airline by reviewer country: store {:.2f}ms\n".format(store_time * 1e3))
+
+    store_time, _ = best_time(lambda: aggregates.distribution("seat_comfort_rating", by = ["recommendation"],
+                                                              **query), args.repeat)
+    sys.stdout.write("seat comfort distribution of one airline: store {:.2f}ms\n".format(store_time * 1e3))
@@ -0,0 +1,138 @@
+#
+# bench_bootstrap.py
+#
+# @author: Evan Yathon
+#
+# August 2019
+#
+# bench_bootstrap times parallel_bootstrap in bootstrap_skmodel.py against the
+# original one task per replicate pandas implementation (`bootstrap_model`)
+# in replicates per second, fitting the unpenalized newton-cg logistic
+# regression of the regression analysis notebook.  The batched IRLS fast path
+# `bootstrap_logistic` is timed too, after checking that its converged
+# replicates agree with parallel_bootstrap's and that at least
+# --min_converged of them converged, so the check compares something.
+#
+# The data is a generated classification problem about the size of the
+# notebook's design matrix by default.  Run with several --n_jobs to see how
+# parallel_bootstrap scales, its chunks of replicates per task can be set
+# with --chunk_size.
+#
+# sample usage
+# python src/benchmarks/bench_bootstrap.py
+# python src/benchmarks/bench_bootstrap.py --n_rows 5000 --n_features 20 --n_bootstraps 2000 --n_jobs 4
+
+import argparse
+import os
+import sys
+import time
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from joblib import Parallel, delayed
+from sklearn.datasets import make_classification
+from sklearn.linear_model import LogisticRegression
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from bootstrap_skmodel import bootstrap_logistic, bootstrap_model, parallel_bootstrap
+
+# the regression notebook's logit_params
+LOGIT_PARAMS = {"penalty" : "none",
+                "C" : 1.0,
+                "fit_intercept" : True,
+                "random_state" : 42,
+                "solver" : "newton-cg",
+                "max_iter" : 100}
+
+def make_design(n_rows, n_features, random_state = 0):
+    """
+    make_design generates predictors and a binary response.
+
+    Return:
+        (X, y) pandas dataframes with string column names
+    """
+    X, y = make_classification(n_samples = n_rows, n_features = n_features,
+                               n_informative = max(1, n_features // 2), flip_y = 0.2,
+                               random_state = random_state)
+
+    return (pd.DataFrame(X, columns = ["x{}".format(i) for i in range(n_features)]),
+            pd.DataFrame({"y" : y}))
+
+def legacy_bootstrap(X, y, n_bootstraps, n_jobs):
+    """
+    legacy_bootstrap runs bootstrap_model the way parallel_bootstrap originally did.
+    """
+    return np.array(Parallel(n_jobs = n_jobs, backend = "loky")(
+        delayed(bootstrap_model)(LogisticRegression, LOGIT_PARAMS, X, y, state) for state in range(n_bootstraps)))
+
+def time_bootstrap(bootstrap, repeat):
+    """
+    time_bootstrap runs a bootstrap several times.
+
+    Return:
+        (coefs, seconds) the coefficients of the last run and the best time of the runs
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        coefs = bootstrap()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return coefs, best
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_rows", type = int, default = 110)
+    parser.add_argument("--n_features", type = int, default = 9)
+    parser.add_argument("--n_bootstraps", type = int, default = 1000)
+    parser.add_argument("--n_jobs", type = int, default = 1)
+    parser.add_argument("--chunk_size", type = int, default = None)
+    parser.add_argument("--repeat", type = int, default = 3)
+    parser.add_argument("--min_converged", type = float, default = 0.5)
+    args = parser.parse_args()
+
+    # unpenalized fits of small resamples often don't converge, also silence
+    # the worker processes which inherit the environment
+    warnings.filterwarnings("ignore")
+    os.environ["PYTHONWARNINGS"] = "ignore"
+
+    X, y = make_design(args.n_rows, args.n_features)
+
+    runs = [
+        ("bootstrap_model per replicate", lambda: legacy_bootstrap(X, y, args.n_bootstraps, args.n_jobs)),
+        ("parallel_bootstrap", lambda: parallel_bootstrap(
+            LogisticRegression, LOGIT_PARAMS, X, y, args.n_bootstraps, n_jobs = args.n_jobs,
+            chunk_size = args.chunk_size)),
+        ("parallel_bootstrap, weights", lambda: parallel_bootstrap(
+            LogisticRegression, LOGIT_PARAMS, X, y, args.n_bootstraps, n_jobs = args.n_jobs,
+            chunk_size = args.chunk_size, use_weights = True)),
+        ("bootstrap_logistic", lambda: bootstrap_logistic(X, y, args.n_bootstraps)[0])
+    ]
+
+    sys.stdout.write("{} rows, {} features, {} replicates, {} jobs, best of {} runs\n".format(
+        args.n_rows, args.n_features, args.n_bootstraps, args.n_jobs, args.repeat))
+
+    sklearn_coefs = parallel_bootstrap(LogisticRegression, dict(LOGIT_PARAMS, tol = 1e-10, max_iter = 1000),
+                                       X, y, args.n_bootstraps, n_jobs = args.n_jobs)
+    batched_coefs, converged = bootstrap_logistic(X, y, args.n_bootstraps)
+    if converged.mean() < args.min_converged:
+        sys.stdout.write("only {:.1%} of bootstrap_logistic's replicates converged, below {:.1%}\n".format(
+            converged.mean(), args.min_converged))
+        sys.exit(1)
+    if not np.allclose(sklearn_coefs[converged], batched_coefs[converged], rtol = 1e-4, atol = 1e-6):
+        sys.stdout.write("bootstrap_logistic differs from parallel_bootstrap by up to {:.3g}\n".format(
+            np.abs(sklearn_coefs[converged] - batched_coefs[converged]).max()))
+        sys.exit(1)
+
+    sys.stdout.write("{:.1%} of replicates converged\n".format(converged.mean()))
+
+    legacy_time = None
+    for name, bootstrap in runs:
+        coefs, elapsed = time_bootstrap(bootstrap, args.repeat)
+        legacy_time = elapsed if legacy_time is None else legacy_time
+        sys.stdout.write("{:<32} {:.3f}s ({:.0f} replicates/s, {:.1f}x)\n".format(
+            name + ":", elapsed, args.n_bootstraps / elapsed, legacy_time / elapsed))
@@ -0,0 +1,136 @@
+#
+# bench_doc_topics.py
+#
+# @author: Evan Yathon
+#
+# August 2019
+#
+# bench_doc_topics times the batched document topic matrix in topic_model.py
+# against the original `get_correct_topics` of the topic modeling notebook,
+# which places the (topic, probability) tuples of get_document_topics into
+# an array one document at a time.  Note that get_correct_topics infers the
+# topics of the corpus twice, once to count the documents.
+#
+# Inference starts from random values, so the check that both give the same
+# probabilities is made against a single pass of get_document_topics started
+# from the same random state.
+#
+# A review topic model is trained on the preprocessed reviews of a topic
+# modeling csv, and the corpus is repeated --scale times to time inference on
+# more documents.
+#
+# sample usage
+# python src/benchmarks/bench_doc_topics.py
+# python src/benchmarks/bench_doc_topics.py --scale 1000 --repeat 3
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from gensim.corpora import Dictionary
+from gensim.models import LdaModel
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from review_store import read_reviews
+from topic_model import document_topics
+
+TOPIC_NAMES = ["review_luggage_seats", "review_time_delays", "review_food_bev_crew"]
+
+def get_correct_topics(lda_doc_topics, num_topics):
+    """
+    get_correct_topics as it was in the topic modeling notebook.
+    """
+    topic_prob_array = np.zeros((pd.DataFrame(lda_doc_topics).shape[0], num_topics))
+
+    for row_num, row in enumerate(lda_doc_topics):
+        for topic in row:
+            topic_prob_array[row_num, topic[0]] = topic[1]
+
+    return pd.DataFrame(topic_prob_array)
+
+def legacy_topics(lda, corpus):
+    """
+    legacy_topics gets the topics of a corpus the way the notebook originally did.
+    """
+    topic_prob_df = get_correct_topics(lda.get_document_topics(corpus), lda.num_topics)
+    topic_prob_df.columns = TOPIC_NAMES
+
+    return topic_prob_df
+
+def per_document_topics(lda, corpus):
+    """
+    per_document_topics places the probabilities of a single pass of
+    get_document_topics into a dataframe.
+    """
+    topic_prob_array = np.zeros((len(corpus), lda.num_topics))
+
+    for row_num, row in enumerate(lda.get_document_topics(corpus)):
+        for topic, prob in row:
+            topic_prob_array[row_num, topic] = prob
+
+    return pd.DataFrame(topic_prob_array, columns = TOPIC_NAMES)
+
+def batched_topics(lda, corpus):
+    """
+    batched_topics gets the topics of a corpus with document_topics.
+    """
+    return document_topics(lda, corpus, TOPIC_NAMES)
+
+def time_topics(get_topics, lda, corpus, repeat, state):
+    """
+    time_topics runs a topic extraction several times.  The model's random
+    state, used to start inference, is set to state before each run so that
+    every run gives the same probabilities.
+
+    Return:
+        (topics, seconds) the topics of the last run and the best time of the runs
+    """
+    best = None
+    for _ in range(repeat):
+        lda.random_state.set_state(state)
+        start = time.perf_counter()
+        topics = get_topics(lda, corpus)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return topics, best
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--load_path", default = "data/topic_modeling_gw_reviews.csv")
+    parser.add_argument("--scale", type = int, default = 100)
+    parser.add_argument("--repeat", type = int, default = 3)
+    args = parser.parse_args()
+
+    docs = [doc.split() for doc in read_reviews(args.load_path, columns = ["clean_review_text"])[
+        "clean_review_text"].fillna("")]
+    dictionary = Dictionary(docs)
+    corpus = [dictionary.doc2bow(doc) for doc in docs]
+
+    lda = LdaModel(corpus = corpus, id2word = dictionary, num_topics = len(TOPIC_NAMES),
+                   alpha = 0.5, eta = 0.01, passes = 5, random_state = 40)
+
+    corpus = corpus * args.scale
+    state = lda.random_state.get_state()
+
+    reference, _ = time_topics(per_document_topics, lda, corpus, 1, state)
+    batched, batched_time = time_topics(batched_topics, lda, corpus, args.repeat, state)
+
+    if not np.allclose(reference.values, batched.values):
+        sys.stdout.write("Topic probabilities differ by up to {:.3g}\n".format(
+            np.abs(reference.values - batched.values).max()))
+        sys.exit(1)
+
+    _, legacy_time = time_topics(legacy_topics, lda, corpus, args.repeat, state)
+
+    sys.stdout.write("{} documents, best of {} runs\n".format(len(corpus), args.repeat))
+    sys.stdout.write("get_correct_topics: {:.3f}s ({:.0f} documents/s)\n".format(
+        legacy_time, len(corpus) / legacy_time))
+    sys.stdout.write("document_topics:    {:.3f}s ({:.0f} documents/s)\n".format(
+        batched_time, len(corpus) / batched_time))
+    sys.stdout.write("speedup: {:.1f}x\n".format(legacy_time / batched_time))
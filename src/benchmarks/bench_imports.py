@@ -0,0 +1,188 @@
+#
+# bench_imports.py
+#
+# @author: Evan Yathon
+#
+# August 2019
+#
+# bench_imports times how long each module of src takes to import, the start
+# up cost paid by every short lived job, script and joblib worker that uses
+# it.  Each module is imported in a new interpreter with `python -X importtime`
+# and the run reports, best of --repeat runs:
+#
+# - the cumulative import time of the module and the wall time of the process
+# - which heavy packages (pandas, scikit-learn, gensim, spaCy...) the import
+#   pulled in, which should only be those the module can't work without
+# - the slowest top level packages it imported
+#
+# The results are saved as JSON, and with --compare checked against an
+# earlier run: the script exits with 1 if any module got slower to import by
+# more than --tolerance and --min_change seconds, or started importing a heavy
+# package it didn't before.
+#
+# sample usage
+# python src/benchmarks/bench_imports.py --output import_times.json
+# python src/benchmarks/bench_imports.py --modules scrape_reviews topic_model --repeat 10
+# python src/benchmarks/bench_imports.py --output new.json --compare import_times.json
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+MODULES = ["instrumentation", "page_cache", "review_store", "review_parser", "http_session", "scrape_reviews",
+           "scrape_airlines", "verify_reviews", "near_duplicates", "review_aggregates", "PrepareForModel",
+           "bootstrap_skmodel", "bootstrap_ci", "l1_path", "text_preprocessing", "topic_model", "pipeline"]
+
+# packages that take a noticeable part of a second or more to import
+HEAVY_PACKAGES = ["numpy", "pandas", "scipy", "sklearn", "joblib", "gensim", "spacy", "pyLDAvis", "lxml",
+                  "urllib3", "pyarrow"]
+
+# a line of -X importtime output, "import time: self [us] | cumulative | imported package"
+IMPORT_LINE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|( *)(\S+)\s*$")
+
+def main(modules, repeat, output = None, compare = None, tolerance = 0.2, min_change = 0.05, n_slowest = 5):
+
+    sys.path.append(SRC_DIR)
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+    from bench_suite import machine_info
+
+    results = []
+    for module in modules:
+        result = time_import(module, repeat, n_slowest)
+        write_result(result)
+        results.append(result)
+
+    report = {"machine" : machine_info(), "results" : results}
+
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(report, f, indent = 1)
+
+    if compare is not None:
+        with open(compare) as f:
+            baseline = json.load(f)
+        regressions = compare_results(baseline["results"], results, tolerance, min_change)
+        if len(regressions) > 0:
+            sys.exit(1)
+
+def time_import(module, repeat, n_slowest = 5):
+    """
+    time_import imports a module in a new interpreter repeat times.
+
+    Args:
+        module (str) : name of a module in src
+        repeat (int) : number of imports to take the best of
+        n_slowest (int) : number of the slowest top level packages to report
+
+    Return:
+        dict of the module's import time, process time, heavy packages
+        imported and slowest packages, with status "ok" or "failed"
+    """
+    code = "import sys; sys.path.insert(0, {!r}); import {}".format(os.path.abspath(SRC_DIR), module)
+
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        completed = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                                   stdout = subprocess.PIPE, stderr = subprocess.PIPE, universal_newlines = True)
+        wall = time.perf_counter() - start
+
+        if completed.returncode != 0:
+            return {"module" : module, "status" : "failed", "error" : completed.stderr.strip().splitlines()[-1:]}
+
+        runs.append((wall, parse_importtime(completed.stderr)))
+
+    # the run with the fastest import
+    wall, times = min(runs, key = lambda run: run[1].get(module, 0.0))
+
+    top_level = {name : seconds for name, seconds in times.items() if "." not in name and name != module}
+    slowest = sorted(top_level.items(), key = lambda item: item[1], reverse = True)[:n_slowest]
+
+    return {
+        "module" : module,
+        "status" : "ok",
+        "import_seconds" : times.get(module, 0.0),
+        "process_seconds" : wall,
+        "heavy_packages" : [package for package in HEAVY_PACKAGES if package in times],
+        "slowest" : [{"package" : name, "seconds" : seconds} for name, seconds in slowest]
+    }
+
+def parse_importtime(stderr):
+    """
+    parse_importtime reads the output of `python -X importtime`.
+
+    Return:
+        dict of the cumulative import time in seconds of every module imported
+    """
+    times = {}
+    for line in stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        if match is not None:
+            times[match.group(4)] = int(match.group(2)) / 1e6
+
+    return times
+
+def write_result(result):
+    """
+    write_result prints one result as a line of a table.
+    """
+    if result["status"] != "ok":
+        sys.stdout.write("{:<20} {}: {}\n".format(result["module"], result["status"], result.get("error")))
+    else:
+        sys.stdout.write("{:<20} {:.3f}s import  {:.3f}s process  heavy: {}\n".format(
+            result["module"], result["import_seconds"], result["process_seconds"],
+            ", ".join(result["heavy_packages"]) or "none"))
+    sys.stdout.flush()
+
+def compare_results(baseline, results, tolerance = 0.2, min_change = 0.05):
+    """
+    compare_results prints the change in import time of each module that was
+    imported in both runs.
+
+    Return:
+        list of the results that got slower by more than tolerance and
+        min_change seconds, or that import a heavy package the baseline didn't
+    """
+    previous = {result["module"] : result for result in baseline if result["status"] == "ok"}
+
+    regressions = []
+    for result in results:
+        if result["status"] != "ok" or result["module"] not in previous:
+            continue
+
+        before = previous[result["module"]]
+        ratio = result["import_seconds"] / max(before["import_seconds"], 1e-6)
+        new_packages = sorted(set(result["heavy_packages"]) - set(before["heavy_packages"]))
+
+        flag = ""
+        if ratio > 1 + tolerance and result["import_seconds"] - before["import_seconds"] > min_change:
+            flag += " REGRESSION"
+        if len(new_packages) > 0:
+            flag += " now imports " + ", ".join(new_packages)
+
+        sys.stdout.write("{:<20} {:.2f}x the baseline import time{}\n".format(result["module"], ratio, flag))
+        if flag:
+            regressions.append(result)
+
+    return regressions
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--modules", nargs = "+", default = MODULES)
+    parser.add_argument("--repeat", type = int, default = 5)
+    parser.add_argument("--n_slowest", type = int, default = 5)
+    parser.add_argument("--output", default = None)
+    parser.add_argument("--compare", default = None)
+    parser.add_argument("--tolerance", type = float, default = 0.2)
+    parser.add_argument("--min_change", type = float, default = 0.05)
+    args = parser.parse_args()
+
+    main(args.modules, args.repeat, output = args.output, compare = args.compare, tolerance = args.tolerance,
+         min_change = args.min_change, n_slowest = args.n_slowest)
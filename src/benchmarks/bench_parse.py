@@ -0,0 +1,109 @@
+#
+# bench_parse.py
+#
+# @author: Evan Yathon
+#
+# August 2019
+#
+# bench_parse times the single pass review parser in review_parser.py against
+# the original per field BeautifulSoup search (`parse_review` with
+# safe_extract/sibling_extract/star_extract in scrape_reviews.py), after
+# checking that both give the same rows.
+#
+# Pages are taken from a page cache written by scrape_reviews.py --cache_dir,
+# or rendered from a scraped csv with fixture_server.py when no cache is given.
+#
+# sample usage
+# python src/benchmarks/bench_parse.py
+# python src/benchmarks/bench_parse.py --cache_dir data/page_cache --repeat 5
+
+import argparse
+import glob
+import os
+import sys
+import time
+
+import pandas as pd
+from bs4 import BeautifulSoup
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from fixture_server import FixtureSite
+from review_parser import parse_reviews
+from scrape_reviews import parse_review
+
+def load_pages(cache_dir = None, load_path = "data/scraped_gw_reviews.csv", scale = 1):
+    """
+    load_pages reads saved review pages from a page cache, or renders them
+    from a scraped csv.
+
+    Args:
+        cache_dir (str) : directory of a PageCache, or None
+        load_path (str) : scraped csv used when there is no cache
+        scale (int) : number of times to repeat the pages
+
+    Return:
+        list of pages as bytes
+    """
+    if cache_dir is not None:
+        pages = []
+        for path in sorted(glob.glob(os.path.join(cache_dir, "objects", "*.html"))):
+            with open(path, "rb") as f:
+                pages.append(f.read())
+    else:
+        pages = FixtureSite({"germanwings" : pd.read_csv(load_path)}).pages["germanwings"]
+
+    return pages * scale
+
+def legacy_parse(pages):
+    """
+    legacy_parse parses pages the way scrape_reviews.py originally did.
+    """
+    rows = []
+    for page in pages:
+        for review in BeautifulSoup(page, features = "lxml").find_all("article", {"itemprop" : "review"}):
+            rows.append(parse_review(review))
+
+    return rows
+
+def time_parser(parser, pages, repeat):
+    """
+    time_parser runs a parser over the pages several times.
+
+    Return:
+        (rows, seconds) the rows of the last run and the best time of the runs
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rows = list(parser(pages))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return rows, best
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cache_dir", default = None)
+    parser.add_argument("--load_path", default = "data/scraped_gw_reviews.csv")
+    parser.add_argument("--scale", type = int, default = 1)
+    parser.add_argument("--repeat", type = int, default = 3)
+    args = parser.parse_args()
+
+    pages = load_pages(args.cache_dir, args.load_path, args.scale)
+
+    legacy_rows, legacy_time = time_parser(legacy_parse, pages, args.repeat)
+    new_rows, new_time = time_parser(parse_reviews, pages, args.repeat)
+
+    if legacy_rows != new_rows:
+        sys.stdout.write("Parsers disagree on {} of {} reviews\n".format(
+            sum(a != b for a, b in zip(legacy_rows, new_rows)) + abs(len(legacy_rows) - len(new_rows)),
+            len(legacy_rows)))
+        sys.exit(1)
+
+    sys.stdout.write("{} pages, {} reviews, best of {} runs\n".format(len(pages), len(new_rows), args.repeat))
+    sys.stdout.write("per field BeautifulSoup search: {:.3f}s ({:.0f} reviews/s)\n".format(
+        legacy_time, len(legacy_rows) / legacy_time))
+    sys.stdout.write("single pass lxml parser:        {:.3f}s ({:.0f} reviews/s)\n".format(
+        new_time, len(new_rows) / new_time))
+    sys.stdout.write("speedup: {:.1f}x\n".format(legacy_time / new_time))
@@ -0,0 +1,60 @@
+#
+# bench_scrape_airlines.py
+#
+# @author: Evan Yathon
+#
+# August 2019
+#
+# bench_scrape_airlines times scrape_airlines.py against a local fixture
+# server, so that no network is needed.  Every fake airline is a copy of the
+# scraped Germanwings reviews, and the server waits --latency seconds before
+# answering each request to mimic the round trip to the real website.
+#
+# sample usage
+# python src/benchmarks/bench_scrape_airlines.py --n_airlines 8 --latency 0.1 --n_workers 1 4 16 --n_processes 1 4
+
+import argparse
+import os
+import sys
+import time
+
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from fixture_server import FixtureSite, serve_fixture
+from scrape_airlines import scrape_airlines
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--load_path", default = "data/scraped_gw_reviews.csv")
+    parser.add_argument("--n_airlines", type = int, default = 8)
+    parser.add_argument("--scale", type = int, default = 1)
+    parser.add_argument("--latency", type = float, default = 0.05)
+    parser.add_argument("--n_workers", type = int, nargs = "+", default = [1, 4, 16])
+    parser.add_argument("--n_processes", type = int, nargs = "+", default = [1, 4])
+    args = parser.parse_args()
+
+    reviews = pd.concat([pd.read_csv(args.load_path)] * args.scale, ignore_index = True)
+    slugs = ["airline-{}".format(i) for i in range(args.n_airlines)]
+    site = FixtureSite(dict((slug, reviews) for slug in slugs))
+    server, base_url = serve_fixture(site, latency = args.latency)
+
+    n_pages = sum(len(pages) for pages in site.pages.values())
+    sys.stdout.write("{} airlines, {} pages, {} reviews, {:.3f}s latency\n".format(
+        len(slugs), n_pages, len(reviews) * len(slugs), args.latency))
+
+    for n_processes in args.n_processes:
+        for n_workers in args.n_workers:
+            start = time.perf_counter()
+            scraped = scrape_airlines(slugs, 0, n_workers = n_workers, n_processes = n_processes,
+                                      base_url = base_url)
+            elapsed = time.perf_counter() - start
+
+            assert all(len(df) == len(reviews) for df in scraped.values())
+
+            sys.stdout.write("n_workers {:>3}  n_processes {:>3}  {:.2f}s  {:.0f} pages/s\n".format(
+                n_workers, n_processes, elapsed, n_pages / elapsed))
+            sys.stdout.flush()
+
+    server.shutdown()
@@ -0,0 +1,353 @@
+#
+# bench_suite.py
+#
+# @author: Evan Yathon
+#
+# August 2019
+#
+# bench_suite times the hot paths of the analysis on a machine with no network
+# and writes the results as JSON, so that runs of different versions can be
+# compared:
+#
+# - parse: the review parser on pages rendered from the scraped csv by
+#   fixture_server.py, like the pages saved by a page cache
+# - preprocess: spaCy preprocessing of synthetic reviews, made by recombining
+#   the sentences of data/cleaned_gw_reviews.csv, for each --n_jobs
+# - lda, doc_topics: training an LDA model on synthetic preprocessed reviews,
+#   sampled from the words of the topic modeling csv, and inferring their topics
+# - make_dummy_df: dummy encoding a synthetic design with a many level column
+# - bootstrap: parallel_bootstrap of the notebook's logistic regression on a
+#   synthetic design, for each --n_jobs
+#
+# The corpora and designs are --scales times the size of the data, 1 and 100
+# by default, 10000 for a long run.  Each benchmark runs in its own process
+# and reports its throughput, best of --repeat runs, and the peak resident
+# memory of the process.  Benchmarks whose packages aren't installed, such as
+# a missing spaCy model, are reported as skipped.
+#
+# With --compare, the results are checked against those of an earlier run and
+# the script exits with 1 if any throughput dropped by more than --tolerance.
+#
+# sample usage
+# python src/benchmarks/bench_suite.py --output bench_results.json
+# python src/benchmarks/bench_suite.py --benchmarks parse lda --scales 1 100 10000 --n_jobs 1 2 4
+# python src/benchmarks/bench_suite.py --output new.json --compare bench_results.json
+
+import argparse
+import json
+import os
+import platform
+import re
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(SRC_DIR)
+
+BENCHMARKS = ["parse", "preprocess", "lda", "doc_topics", "make_dummy_df", "bootstrap"]
+
+# benchmarks that are run once for each number of jobs
+PARALLEL_BENCHMARKS = ["preprocess", "bootstrap"]
+
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+def main(benchmarks, scales, n_jobs, repeat, output = None, compare = None, tolerance = 0.2):
+
+    results = []
+    for name in benchmarks:
+        for scale in scales:
+            for jobs in (n_jobs if name in PARALLEL_BENCHMARKS else [1]):
+                result = run_in_process({"benchmark" : name, "scale" : scale, "n_jobs" : jobs, "repeat" : repeat})
+                write_result(result)
+                results.append(result)
+
+    report = {"machine" : machine_info(), "results" : results}
+
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(report, f, indent = 1)
+
+    if compare is not None:
+        with open(compare) as f:
+            baseline = json.load(f)
+        regressions = compare_results(baseline["results"], results, tolerance)
+        if len(regressions) > 0:
+            sys.exit(1)
+
+def run_in_process(spec):
+    """
+    run_in_process runs one benchmark in a new Python process, so that its
+    peak memory is its own.
+
+    Args:
+        spec (dict) : benchmark, scale, n_jobs and repeat
+
+    Return:
+        dict of the spec and its results, with status "ok", "skipped" or "failed"
+    """
+    completed = subprocess.run([sys.executable, os.path.abspath(__file__), "--run", json.dumps(spec)],
+                               stdout = subprocess.PIPE, stderr = subprocess.PIPE, universal_newlines = True)
+
+    lines = completed.stdout.strip().splitlines()
+    if completed.returncode != 0 or len(lines) == 0:
+        return dict(spec, status = "failed", error = completed.stderr.strip().splitlines()[-1:])
+
+    return json.loads(lines[-1])
+
+def run_benchmark(spec):
+    """
+    run_benchmark sets up and times one benchmark in this process.
+
+    Return:
+        dict of the spec and its results
+    """
+    setups = {"parse" : setup_parse, "preprocess" : setup_preprocess, "lda" : setup_lda,
+              "doc_topics" : setup_doc_topics, "make_dummy_df" : setup_make_dummy_df,
+              "bootstrap" : setup_bootstrap}
+
+    try:
+        run, n_items, unit = setups[spec["benchmark"]](spec["scale"], spec["n_jobs"])
+    except (ImportError, OSError) as e:
+        return dict(spec, status = "skipped", error = str(e))
+
+    setup_rss = peak_rss_mb()
+
+    best = None
+    for _ in range(spec["repeat"]):
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return dict(spec, status = "ok", seconds = best, items = n_items, unit = unit,
+                throughput = n_items / best, setup_rss_mb = setup_rss, peak_rss_mb = peak_rss_mb())
+
+def peak_rss_mb():
+    """
+    peak_rss_mb gives the peak resident memory of this process and of its
+    finished child processes, in megabytes.
+    """
+    # ru_maxrss is in kilobytes on Linux
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+    return max(own, children) / 1024.0
+
+# the benchmarks, each gives (run, number of items, unit of the items)
+
+def setup_parse(scale, n_jobs, load_path = "data/scraped_gw_reviews.csv"):
+    from fixture_server import FixtureSite
+    from review_parser import parse_reviews
+
+    pages = FixtureSite({"germanwings" : pd.read_csv(load_path)}).pages["germanwings"] * scale
+    n_reviews = sum(1 for _ in parse_reviews(pages[:len(pages) // scale]))
+
+    return (lambda: list(parse_reviews(pages))), n_reviews * scale, "reviews"
+
+def setup_preprocess(scale, n_jobs, load_path = "data/cleaned_gw_reviews.csv"):
+    from text_preprocessing import load_model, preprocess_texts
+
+    nlp = load_model("en")
+    reviews = pd.read_csv(load_path)
+    texts = synthetic_texts(reviews["review_text"].dropna(), len(reviews) * scale)
+
+    # no lemma cache, so every run preprocesses every text
+    return (lambda: preprocess_texts(texts, nlp, min_token_len = 3, n_process = n_jobs)), len(texts), "reviews"
+
+def setup_lda(scale, n_jobs, load_path = "data/topic_modeling_gw_reviews.csv"):
+    from gensim.corpora import Dictionary
+    from gensim.models import LdaModel
+
+    docs = synthetic_corpus(load_path, scale)
+    dictionary = Dictionary(docs)
+    corpus = [dictionary.doc2bow(doc) for doc in docs]
+
+    # the notebook's review topic model, with one pass over the corpus
+    run = lambda: LdaModel(corpus = corpus, id2word = dictionary, num_topics = 3, alpha = 0.5, eta = 0.01,
+                           passes = 1, random_state = 40)
+
+    return run, len(corpus), "documents"
+
+def setup_doc_topics(scale, n_jobs, load_path = "data/topic_modeling_gw_reviews.csv"):
+    from gensim.corpora import Dictionary
+    from gensim.models import LdaModel
+    from topic_model import document_topic_matrix
+
+    docs = synthetic_corpus(load_path, scale)
+    dictionary = Dictionary(docs)
+    corpus = [dictionary.doc2bow(doc) for doc in docs]
+
+    # trained on the unscaled corpus, only inference is timed
+    lda = LdaModel(corpus = corpus[:len(corpus) // scale], id2word = dictionary, num_topics = 3, alpha = 0.5,
+                   eta = 0.01, passes = 5, random_state = 40)
+
+    return (lambda: document_topic_matrix(lda, corpus)), len(corpus), "documents"
+
+def setup_make_dummy_df(scale, n_jobs, n_rows = 1000, random_state = 0):
+    from PrepareForModel import PrepareForModel
+
+    df = synthetic_reviews_design(n_rows * scale, random_state)
+    dummy_vars = {"seat_type" : "Economy Class", "recommendation" : "no", "route" : "route_0"}
+
+    return (lambda: PrepareForModel(df).make_dummy_df(dummy_vars)), df.shape[0], "rows"
+
+def setup_bootstrap(scale, n_jobs, n_bootstraps = 1000):
+    from sklearn.linear_model import LogisticRegression
+
+    from bench_bootstrap import LOGIT_PARAMS, make_design
+    from bootstrap_skmodel import parallel_bootstrap
+
+    # the notebook's design has 111 rows and 9 features
+    X, y = make_design(111 * scale, 9)
+
+    run = lambda: parallel_bootstrap(LogisticRegression, LOGIT_PARAMS, X, y, n_bootstraps, n_jobs = n_jobs)
+
+    return run, n_bootstraps, "replicates"
+
+# synthetic data, the same for every run
+
+def synthetic_texts(texts, n_texts, random_state = 0):
+    """
+    synthetic_texts makes new reviews by drawing sentences from the sentences
+    of real reviews, each with as many sentences as a random real review, so
+    that every text is different and a lemma cache can't skip any of them.
+
+    Return:
+        list of n_texts texts
+    """
+    rng = np.random.default_rng(random_state)
+
+    sentences = [SENTENCE_END.split(text) for text in texts]
+    pool = [sentence for review in sentences for sentence in review]
+    lengths = rng.choice([len(review) for review in sentences], size = n_texts)
+
+    return [" ".join(pool[i] for i in rng.integers(0, len(pool), size = length)) for length in lengths]
+
+def synthetic_corpus(load_path, scale, random_state = 0):
+    """
+    synthetic_corpus makes preprocessed reviews by drawing words from the
+    words of the clean_review_text column, with the lengths of real reviews.
+    The first len(data) documents are the real ones.
+
+    Return:
+        list of documents as lists of tokens, scale times the number of reviews
+    """
+    rng = np.random.default_rng(random_state)
+
+    docs = [text.split() for text in pd.read_csv(load_path)["clean_review_text"].fillna("")]
+    pool = np.array([token for doc in docs for token in doc])
+    lengths = rng.choice([len(doc) for doc in docs], size = len(docs) * (scale - 1))
+
+    tokens = pool[rng.integers(0, len(pool), size = lengths.sum())]
+    synthetic = np.split(tokens, np.cumsum(lengths)[:-1]) if len(lengths) > 0 else []
+
+    return docs + [list(doc) for doc in synthetic]
+
+def synthetic_reviews_design(n_rows, random_state = 0, n_routes = 500):
+    """
+    synthetic_reviews_design makes a dataframe shaped like the regression
+    notebook's reviews, with a route column of n_routes levels.
+    """
+    rng = np.random.default_rng(random_state)
+
+    return pd.DataFrame({
+        "review_value" : rng.integers(1, 11, size = n_rows).astype(float),
+        "value_for_money_rating" : rng.integers(1, 6, size = n_rows).astype(float),
+        "review_luggage_seats" : rng.random(n_rows),
+        "seat_type" : rng.choice(["Economy Class", "Business Class", "First Class", "Premium Economy"],
+                                 size = n_rows),
+        "route" : ["route_{}".format(i) for i in rng.integers(0, n_routes, size = n_rows)],
+        "recommendation" : rng.choice(["yes", "no"], size = n_rows)
+    })
+
+# output
+
+def machine_info():
+    """
+    machine_info describes the machine and versions a run was made with.
+    """
+    versions = {}
+    for package in ["numpy", "pandas", "sklearn", "gensim", "spacy", "joblib", "lxml"]:
+        try:
+            versions[package] = __import__(package).__version__
+        except ImportError:
+            versions[package] = None
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], stdout = subprocess.PIPE, stderr = subprocess.PIPE,
+                                universal_newlines = True, cwd = SRC_DIR).stdout.strip()
+    except OSError:
+        commit = None
+
+    return {
+        "python" : platform.python_version(),
+        "platform" : platform.platform(),
+        "cpu_count" : os.cpu_count(),
+        "commit" : commit,
+        "time" : time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "versions" : versions
+    }
+
+def write_result(result):
+    """
+    write_result prints one result as a line of a table.
+    """
+    label = "{benchmark} x{scale}, {n_jobs} jobs".format(**result)
+
+    if result["status"] != "ok":
+        sys.stdout.write("{:<32} {}: {}\n".format(label, result["status"], result.get("error")))
+    else:
+        sys.stdout.write("{:<32} {:.3f}s {:>12.0f} {}/s  peak {:.0f} MB\n".format(
+            label, result["seconds"], result["throughput"], result["unit"], result["peak_rss_mb"]))
+    sys.stdout.flush()
+
+def compare_results(baseline, results, tolerance = 0.2):
+    """
+    compare_results prints the change in throughput of each benchmark that
+    ran in both runs.
+
+    Return:
+        list of the results whose throughput dropped by more than tolerance
+    """
+    key = lambda result: (result["benchmark"], result["scale"], result["n_jobs"])
+    previous = {key(result) : result for result in baseline if result["status"] == "ok"}
+
+    regressions = []
+    for result in results:
+        if result["status"] != "ok" or key(result) not in previous:
+            continue
+
+        ratio = result["throughput"] / previous[key(result)]["throughput"]
+        flag = " REGRESSION" if ratio < 1 - tolerance else ""
+        sys.stdout.write("{:<32} {:.2f}x the baseline throughput{}\n".format(
+            "{} x{}, {} jobs".format(*key(result)), ratio, flag))
+        if flag:
+            regressions.append(result)
+
+    return regressions
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--benchmarks", nargs = "+", default = BENCHMARKS, choices = BENCHMARKS)
+    parser.add_argument("--scales", nargs = "+", type = int, default = [1, 100])
+    parser.add_argument("--n_jobs", nargs = "+", type = int, default = sorted({1, os.cpu_count() or 1}))
+    parser.add_argument("--repeat", type = int, default = 3)
+    parser.add_argument("--output", default = None)
+    parser.add_argument("--compare", default = None)
+    parser.add_argument("--tolerance", type = float, default = 0.2)
+    parser.add_argument("--run", default = None, help = argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run is not None:
+        # the worker process of run_in_process
+        sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+        sys.stdout.write(json.dumps(run_benchmark(json.loads(args.run))) + "\n")
+    else:
+        main(args.benchmarks, args.scales, args.n_jobs, args.repeat, output = args.output,
+             compare = args.compare, tolerance = args.tolerance)
@@ -0,0 +1,235 @@
+# bootstrap_ci.py
+#
+# @author: Evan Yathon
+#
+# August 2019
+#
+# This script contains BootstrapCI, which keeps running estimates of the
+# bootstrap confidence intervals of a model's coefficients as blocks of
+# bootstrapped coefficients arrive, and streaming_bootstrap, which runs
+# parallel_bootstrap's replicates in rounds until the intervals are known
+# well enough rather than for a fixed number of replicates.
+#
+# The mean and variance of each coefficient are kept exactly over every
+# replicate.  The quantiles are exact over a buffer of at most max_buffer
+# replicates, after which the buffer is a uniform random sample of all of
+# them, so memory doesn't grow with the number of replicates.
+#
+# The Monte-Carlo error of each interval endpoint is estimated from the order
+# statistics around it, and a run stops once every endpoint's error is below
+# tol standard deviations of its coefficient.
+#
+# Example usage:
+# ci = streaming_bootstrap(LogisticRegression, logit_params, X, y, tol = 0.05, max_bootstraps = 5000)
+# ci.quantile(0.025), ci.quantile(0.975), ci.n_bootstraps
+#
+# joblib and scikit-learn are imported by streaming_bootstrap, like in
+# bootstrap_skmodel.py, so that BootstrapCI can be used without them.
+
+import numpy as np
+
+from bootstrap_skmodel import as_arrays, bootstrap_block, bootstrap_chunk_size
+from instrumentation import stage
+
+class BootstrapCI:
+
+    """
+    BootstrapCI accumulates bootstrapped coefficients a block at a time.
+
+    Arguments:
+        n_features (int): number of coefficients of each replicate
+        quantiles (tuple): quantiles that are the interval endpoints
+        max_buffer (int): most replicates kept to estimate the quantiles from
+        random_state (int): seed of the buffer's sampling once it is full
+
+    Attributes:
+        n_bootstraps (int): number of replicates seen
+        mean (np.array): mean of each coefficient
+    """
+
+    def __init__(self, n_features, quantiles = (0.025, 0.975), max_buffer = 5000, random_state = 0):
+
+        self.n_features = n_features
+        self.quantiles = tuple(quantiles)
+        self.max_buffer = max_buffer
+        self.rng = np.random.default_rng(random_state)
+
+        self.n_bootstraps = 0
+        self.mean = np.zeros(n_features)
+        self.sum_sq = np.zeros(n_features)
+
+        self.buffer = np.empty((max_buffer, n_features))
+        self.n_buffered = 0
+
+    def update(self, coefs):
+        """
+        Adds a block of bootstrapped coefficients.
+
+        Arguments:
+            coefs (np.array): one row of coefficients per replicate
+        """
+        coefs = np.asarray(coefs, dtype = float).reshape(-1, self.n_features)
+        n_new = coefs.shape[0]
+        if n_new == 0:
+            return
+
+        # combine the block's mean and sum of squares with the running ones
+        block_mean = coefs.mean(axis = 0)
+        block_sum_sq = ((coefs - block_mean) ** 2).sum(axis = 0)
+        n_total = self.n_bootstraps + n_new
+        delta = block_mean - self.mean
+        self.mean = self.mean + delta * n_new / n_total
+        self.sum_sq = self.sum_sq + block_sum_sq + delta ** 2 * self.n_bootstraps * n_new / n_total
+
+        # fill the buffer, then keep a uniform sample of every replicate in it
+        n_fill = min(n_new, self.max_buffer - self.n_buffered)
+        self.buffer[self.n_buffered:self.n_buffered + n_fill] = coefs[:n_fill]
+        self.n_buffered += n_fill
+
+        for offset in range(n_fill, n_new):
+            slot = self.rng.integers(0, self.n_bootstraps + offset + 1)
+            if slot < self.max_buffer:
+                self.buffer[slot] = coefs[offset]
+
+        self.n_bootstraps = n_total
+
+    def std(self):
+        """
+        Standard deviation of each coefficient over the replicates.
+        """
+        if self.n_bootstraps < 2:
+            return np.full(self.n_features, np.nan)
+
+        return np.sqrt(self.sum_sq / (self.n_bootstraps - 1))
+
+    def quantile(self, q):
+        """
+        Estimate of a quantile of each coefficient.
+
+        Arguments:
+            q (float): the quantile, for example 0.025
+
+        Return:
+            array with the quantile of each coefficient
+        """
+        return np.quantile(self.buffer[:self.n_buffered], q, axis = 0)
+
+    def quantile_error(self, q):
+        """
+        Monte-Carlo standard error of a quantile estimate of each coefficient,
+        from the spread of the order statistics one binomial standard
+        deviation either side of the quantile's rank.
+
+        Arguments:
+            q (float): the quantile, for example 0.025
+
+        Return:
+            array with the standard error of each coefficient's quantile
+        """
+        n = self.n_buffered
+        if n < 2:
+            return np.full(self.n_features, np.inf)
+
+        spread = np.sqrt(n * q * (1.0 - q))
+        low = int(np.floor(n * q - spread))
+        high = int(np.ceil(n * q + spread))
+        if low < 0 or high > n - 1:
+            # too few replicates to have order statistics either side
+            return np.full(self.n_features, np.inf)
+
+        ordered = np.partition(self.buffer[:n], [low, high], axis = 0)
+
+        return (ordered[high] - ordered[low]) / 2.0
+
+    def converged(self, tol):
+        """
+        Whether every interval endpoint's Monte-Carlo error is below tol
+        standard deviations of its coefficient.
+        """
+        scale = self.std()
+        # coefficients that don't vary have no error
+        scale = np.where(scale > 0, scale, 1.0)
+
+        return all((self.quantile_error(q) / scale < tol).all() for q in self.quantiles)
+
+def streaming_bootstrap(skmodel, skmodel_args, X, y, tol = 0.05, max_bootstraps = 5000, min_bootstraps = 200,
+                        round_size = None, quantiles = (0.025, 0.975), max_buffer = 5000, n_jobs = -1,
+                        random_state = 0, use_weights = False):
+    """
+    Bootstraps a model's coefficients in rounds, accumulating them into a
+    BootstrapCI, until the interval endpoints' Monte-Carlo errors are below
+    tol or max_bootstraps replicates have been fit.  Replicate i is the same
+    as parallel_bootstrap's replicate i for the same random_state.
+
+    Parameters:
+        skmodel (sci-kit learn model object): for example, LogisiticRegression
+        skmodel_args (dict): dictionary of argument value pairs to unpack for use in skmodel
+        X (pandas dataframe or numpy array): dataframe/array of predictors
+        y (pandas dataframe, series or numpy array): response values
+        tol (float): largest Monte-Carlo error of an endpoint, as a fraction
+                     of the standard deviation of its coefficient
+        max_bootstraps (int): most replicates to fit
+        min_bootstraps (int): fewest replicates to fit before checking tol
+        round_size (int): replicates fit between checks, default
+                          min_bootstraps.  It doesn't depend on n_jobs, so
+                          the same random_state stops at the same replicate
+                          and gives the same interval for any n_jobs.
+        quantiles (tuple): quantiles that are the interval endpoints
+        max_buffer (int): most replicates kept for the quantiles
+        n_jobs (int): number of threads/cores to use
+        random_state (int): root seed of the replicates
+        use_weights (bool): see parallel_bootstrap
+
+    Return:
+        BootstrapCI of the replicates fit
+    """
+    from joblib import Parallel, delayed
+    from sklearn.utils.validation import has_fit_parameter
+
+    if max_bootstraps < 1:
+        raise ValueError("max_bootstraps must be at least 1, got {}".format(max_bootstraps))
+    if min_bootstraps > max_bootstraps:
+        raise ValueError("min_bootstraps ({}) can't be more than max_bootstraps ({})".format(min_bootstraps,
+                                                                                          max_bootstraps))
+
+    X_array, y_array = as_arrays(X, y)
+
+    if use_weights and not has_fit_parameter(skmodel(**skmodel_args), "sample_weight"):
+        raise ValueError("{} doesn't accept sample_weight, use_weights must be False".format(skmodel.__name__))
+
+    if round_size is None:
+        round_size = max(1, min_bootstraps)
+
+    # the same children as bootstrap_seeds(max_bootstraps, random_state),
+    # spawned a round at a time
+    root = np.random.SeedSequence(random_state)
+
+    ci = None
+
+    with stage("streaming_bootstrap", n_jobs = n_jobs, use_weights = use_weights) as bootstrap_stage, \
+         Parallel(n_jobs = n_jobs, backend = "loky", max_nbytes = 0, mmap_mode = "r") as parallel:
+
+        while ci is None or ci.n_bootstraps < max_bootstraps:
+
+            seeds = root.spawn(min(round_size, max_bootstraps - (0 if ci is None else ci.n_bootstraps)))
+            chunk_size = bootstrap_chunk_size(len(seeds), n_jobs)
+
+            blocks = parallel(
+                delayed(bootstrap_block)(skmodel, skmodel_args, X_array, y_array,
+                                         seeds[start:start + chunk_size], use_weights)
+                for start in range(0, len(seeds), chunk_size))
+
+            # the round is added in one update, so that how it was split
+            # between the workers doesn't change the result
+            coefs = np.concatenate(blocks)
+            if ci is None:
+                ci = BootstrapCI(coefs.shape[1], quantiles = quantiles, max_buffer = max_buffer,
+                                 random_state = random_state)
+            ci.update(coefs)
+
+            if ci.n_bootstraps >= min_bootstraps and ci.converged(tol):
+                break
+
+        bootstrap_stage.add("items", ci.n_bootstraps)
+
+    return ci
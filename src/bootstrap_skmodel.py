@@ -12,12 +12,34 @@
 # distribution of each coefficient in order to get estimates of
 # standard error.
 #
+# parallel_bootstrap converts X and y to contiguous numpy arrays once and
+# draws the rows of each bootstrap sample as indices, from a numpy Generator
+# seeded by its own child of a SeedSequence.  Each model is fit on the rows
+# indexed out of the arrays, or with use_weights on the original arrays
+# weighted by how many times each row was drawn, so that no resampled copy of
+# the data is made.  Replicate i always gets the same sample for a given
+# random_state, however many jobs are used.
+# bootstrap_model is kept as the original pandas implementation.
+#
+# The arrays are memory mapped once for all of the workers rather than
+# pickled with every task, and each task fits a chunk of replicates into a
+# preallocated block of coefficients, so that scheduling costs little next to
+# the fits and memory doesn't grow with the number of jobs.
+#
+# bootstrap_logistic is a fast path for logistic regression.  It represents a
+# batch of replicates as a (replicates x rows) matrix of bootstrap counts and
+# runs Newton's method (IRLS) for all of them at once with batched numpy
+# linear algebra, drawing the same samples as parallel_bootstrap.
+#
+# joblib, scipy, scikit-learn and pandas are imported by the functions that
+# use them, so importing the module, as every joblib worker does, stays cheap.
+#
 
 
-from joblib import Parallel, delayed
-import pandas as pd
 import numpy as np
 
+from instrumentation import stage
+
 def bootstrap_model(skmodel, skmodel_args, X, y, random_state):
     """
     Function for retrieving bootstrapped model coefficients in parallel
@@ -32,6 +54,7 @@ def bootstrap_model(skmodel, skmodel_args, X, y, random_state):
     Return:
         array of coefficients for each feature in X
     """
+    import pandas as pd
 
     if not (isinstance(X, pd.core.frame.DataFrame) or isinstance(X, np.ndarray)) and not (isinstance(y, pd.core.frame.DataFrame) or isinstance(y, np.ndarray)):
         raise TypeException("X and y must both be pandas dataframes.  Note that geopandas\
@@ -67,10 +90,97 @@ def bootstrap_model(skmodel, skmodel_args, X, y, random_state):
     return coefs
 
 
-def parallel_bootstrap(skmodel, skmodel_args, X, y, n_bootstraps, n_jobs = -1):
+def as_arrays(X, y):
+    """
+    Converts predictors and response to the contiguous float arrays that the
+    bootstrap engine indexes into.
+
+    Parameters:
+        X (pandas dataframe or numpy array): dataframe/array of predictors
+        y (pandas dataframe, series or numpy array): response values, a single column
+
+    Return:
+        (X, y) a C contiguous 2d array and a 1d array
+    """
+    import pandas as pd
+
+    if not isinstance(X, (pd.DataFrame, np.ndarray)) or not isinstance(y, (pd.DataFrame, pd.Series, np.ndarray)):
+        raise TypeError("X must be a pandas dataframe or numpy array, and y a pandas dataframe, series or numpy array")
+
+    X_array = np.ascontiguousarray(np.asarray(X, dtype = float))
+    y_array = np.ascontiguousarray(np.asarray(y)).ravel()
+
+    if X_array.shape[0] != y_array.shape[0]:
+        raise ValueError("X has {} rows but y has {}".format(X_array.shape[0], y_array.shape[0]))
+
+    return X_array, y_array
+
+def bootstrap_seeds(n_bootstraps, random_state = None):
     """
-    Wrapper for bootstrap_model to create multiple bootstrapped coefficients
-    in parallel.
+    Creates an independent seed for each bootstrap replicate.
+
+    Parameters:
+        n_bootstraps (int): number of replicates
+        random_state (int or np.random.SeedSequence): root seed, None for fresh entropy
+
+    Return:
+        list of n_bootstraps np.random.SeedSequence
+    """
+
+    root = random_state if isinstance(random_state, np.random.SeedSequence) else np.random.SeedSequence(random_state)
+
+    return root.spawn(n_bootstraps)
+
+def bootstrap_counts(n_rows, seed):
+    """
+    Draws a bootstrap sample as the number of times each row is drawn.
+
+    Parameters:
+        n_rows (int): number of rows in the data
+        seed (np.random.SeedSequence): seed of this replicate
+
+    Return:
+        array of n_rows counts that sum to n_rows
+    """
+
+    rows = np.random.default_rng(seed).integers(0, n_rows, n_rows)
+
+    return np.bincount(rows, minlength = n_rows)
+
+def bootstrap_fit(skmodel, skmodel_args, X, y, seed, use_weights = False):
+    """
+    Fits a model to one bootstrap sample of array data and returns its coefficients.
+
+    Parameters:
+        skmodel (sci-kit learn model object): for example, LogisiticRegression
+        skmodel_args (dict): dictionary of argument value pairs to unpack for use in skmodel
+        X (numpy array): contiguous array of predictors, from as_arrays
+        y (numpy array): 1d array of response values, from as_arrays
+        seed (np.random.SeedSequence): seed of this replicate
+        use_weights (bool): fit on all rows weighted by their bootstrap counts
+                            instead of on the resampled rows
+
+    Return:
+        array of coefficients for each feature in X
+    """
+
+    counts = bootstrap_counts(X.shape[0], seed)
+
+    model = skmodel(**skmodel_args)
+
+    if use_weights:
+        # rows that weren't drawn have a weight of zero
+        model.fit(X, y, sample_weight = counts)
+    else:
+        rows = np.repeat(np.arange(X.shape[0]), counts)
+        model.fit(X[rows], y[rows])
+
+    return model.coef_.flatten()
+
+def parallel_bootstrap(skmodel, skmodel_args, X, y, n_bootstraps, n_jobs = -1, random_state = 0,
+                       use_weights = False, chunk_size = None):
+    """
+    Creates multiple bootstrapped coefficients in parallel with bootstrap_fit.
 
     Parameters:
         skmodel (sci-kit learn model object): for example, LogisiticRegression
@@ -80,6 +190,13 @@ def parallel_bootstrap(skmodel, skmodel_args, X, y, n_bootstraps, n_jobs = -1):
         n_bootstraps (int): number of bootstraps to perform and estimate
                             coeffients from
         n_jobs (int): number of threads/cores to use
+        random_state (int): root seed of the replicates, the same seed always
+                            gives the same coefficients
+        use_weights (bool): fit on bootstrap counts as sample weights rather
+                            than resampled rows, which avoids copying wide
+                            data.  skmodel's fit must accept sample_weight.
+        chunk_size (int): number of replicates fit by each task, default a
+                          few tasks per job
 
     Return:
         n_bootstrap arrays of coefficients for each feature in X
@@ -99,8 +216,203 @@ def parallel_bootstrap(skmodel, skmodel_args, X, y, n_bootstraps, n_jobs = -1):
         parallel_bootstrap(LogisticRegression, skmodel_args = params,
                                         X = X, y = y, n_bootstraps = 500)
     """
+    from joblib import Parallel, delayed
+    from sklearn.utils.validation import has_fit_parameter
+
+    X_array, y_array = as_arrays(X, y)
+
+    if use_weights and not has_fit_parameter(skmodel(**skmodel_args), "sample_weight"):
+        raise ValueError("{} doesn't accept sample_weight, use_weights must be False".format(skmodel.__name__))
+
+    seeds = bootstrap_seeds(n_bootstraps, random_state)
+
+    if chunk_size is None:
+        chunk_size = bootstrap_chunk_size(n_bootstraps, n_jobs)
+    chunks = [seeds[start:start + chunk_size] for start in range(0, n_bootstraps, chunk_size)]
+
+    with stage("parallel_bootstrap", n_jobs = n_jobs, use_weights = use_weights) as bootstrap_stage:
+        bootstrap_stage.add("items", n_bootstraps)
+
+        # max_nbytes = 0 memory maps X and y once for the whole run, the workers
+        # only receive the file they're in
+        blocks = Parallel(n_jobs = n_jobs, backend = "loky", max_nbytes = 0, mmap_mode = "r")(
+            delayed(bootstrap_block)(skmodel, skmodel_args, X_array, y_array, chunk, use_weights)
+            for chunk in chunks)
+
+        return np.concatenate(blocks, axis = 0) if len(blocks) > 0 else np.empty((0, X_array.shape[1]))
+
+def bootstrap_block(skmodel, skmodel_args, X, y, seeds, use_weights = False):
+    """
+    Fits a chunk of bootstrap replicates, the work of one parallel task.
+
+    Parameters:
+        skmodel (sci-kit learn model object): for example, LogisiticRegression
+        skmodel_args (dict): dictionary of argument value pairs to unpack for use in skmodel
+        X (numpy array): array of predictors, from as_arrays
+        y (numpy array): 1d array of response values, from as_arrays
+        seeds (list): np.random.SeedSequence of each replicate
+        use_weights (bool): see bootstrap_fit
+
+    Return:
+        array of coefficients, one row per seed
+    """
+
+    coefs = None
+
+    for row, seed in enumerate(seeds):
+        replicate_coefs = bootstrap_fit(skmodel, skmodel_args, X, y, seed, use_weights)
+
+        # the number of coefficients is only known after the first fit
+        if coefs is None:
+            coefs = np.empty((len(seeds), replicate_coefs.shape[0]))
+        coefs[row] = replicate_coefs
+
+    return coefs
+
+def bootstrap_chunk_size(n_bootstraps, n_jobs, tasks_per_job = 4):
+    """
+    Picks the number of replicates fit by each task: large enough that
+    scheduling is cheap next to the fits, with a few tasks per worker so that
+    workers finishing early can take more.
+
+    Parameters:
+        n_bootstraps (int): number of replicates
+        n_jobs (int): number of jobs, as passed to joblib
+        tasks_per_job (int): number of tasks to aim for per worker
+
+    Return:
+        (int) replicates per task
+    """
+    from joblib import effective_n_jobs
+
+    n_tasks = effective_n_jobs(n_jobs) * tasks_per_job
+
+    return max(1, int(np.ceil(n_bootstraps / float(n_tasks))))
+
+def bootstrap_logistic(X, y, n_bootstraps, random_state = 0, fit_intercept = True, C = None,
+                       max_iter = 100, tol = 1e-8, batch_size = 500):
+    """
+    Bootstraps the coefficients of a logistic regression, fitting batches of
+    replicates together.  Gives the same samples, and to within tolerance the
+    same coefficients, as parallel_bootstrap with LogisticRegression.
+
+    Parameters:
+        X (pandas dataframe or numpy array): dataframe/array of predictors
+        y (pandas dataframe, series or numpy array): binary response values
+        n_bootstraps (int): number of bootstraps to perform and estimate
+                            coeffients from
+        random_state (int): root seed of the replicates, as in parallel_bootstrap
+        fit_intercept (bool): whether to fit an unpenalized intercept
+        C (float): inverse l2 regularization strength as in LogisticRegression,
+                   None for no penalty
+        max_iter (int): maximum number of Newton steps
+        tol (float): a replicate has converged once no coefficient changes by
+                     more than tol in a step
+        batch_size (int): number of replicates fit at once, memory use grows
+                          with batch_size times the number of rows, plus the
+                          number of rows times the number of coefficients
+                          squared for the Hessians
+
+    Return:
+        (coefs, converged) n_bootstrap arrays of coefficients for each feature
+        in X, and whether each replicate converged.  Replicates that didn't,
+        usually because their sample is separable and has no finite estimate,
+        keep their last coefficients.
+    """
+
+    X_array, y_array = as_arrays(X, y)
+    n_rows, n_features = X_array.shape
+
+    design = np.hstack([X_array, np.ones((n_rows, 1))]) if fit_intercept else X_array
+
+    # l2 penalty of each coefficient, the intercept isn't penalized
+    penalty = np.zeros(design.shape[1])
+    if C is not None:
+        penalty[:n_features] = 1.0 / C
+
+    seeds = bootstrap_seeds(n_bootstraps, random_state)
+
+    coefs = np.empty((n_bootstraps, n_features))
+    converged = np.zeros(n_bootstraps, dtype = bool)
+
+    with stage("bootstrap_logistic") as bootstrap_stage:
+        bootstrap_stage.add("items", n_bootstraps)
+
+        for start in range(0, n_bootstraps, batch_size):
+            batch = seeds[start:start + batch_size]
+            counts = np.array([bootstrap_counts(n_rows, seed) for seed in batch], dtype = float)
+
+            beta, batch_converged = batched_irls(design, y_array, counts, penalty, max_iter, tol)
+
+            coefs[start:start + len(batch)] = beta[:, :n_features]
+            converged[start:start + len(batch)] = batch_converged
+
+        return coefs, converged
+
+def batched_irls(design, y, weights, penalty, max_iter = 100, tol = 1e-8):
+    """
+    Fits a weighted logistic regression for each row of weights with Newton's
+    method, taking a step for every unconverged fit at once.
+
+    Parameters:
+        design (numpy array): rows x coefficients design matrix
+        y (numpy array): 1d array of binary response values
+        weights (numpy array): fits x rows matrix of row weights
+        penalty (numpy array): l2 penalty of each coefficient
+        max_iter (int): maximum number of Newton steps
+        tol (float): largest change in a coefficient at convergence
+
+    Return:
+        (beta, converged) fits x coefficients array and whether each fit converged
+    """
+    from scipy.special import expit
+
+    n_fits, n_coefs = weights.shape[0], design.shape[1]
+
+    beta = np.zeros((n_fits, n_coefs))
+    converged = np.zeros(n_fits, dtype = bool)
+
+    penalty_matrix = np.diag(penalty)
+
+    with np.errstate(over = "ignore", invalid = "ignore"):
+
+        for _ in range(max_iter):
+
+            active = np.flatnonzero(~converged)
+            if len(active) == 0:
+                break
+
+            active_beta, active_weights = beta[active], weights[active]
+
+            probs = expit(active_beta @ design.T)
+            gradient = (active_weights * (y - probs)) @ design - active_beta * penalty
+            curvature = active_weights * probs * (1.0 - probs)
+            # contracted through the rows x coefficients x coefficients
+            # products of the design, rather than a fits x coefficients x rows
+            # temporary that grows with the batch
+            hessian = np.einsum("bn,ni,nj->bij", curvature, design, design, optimize = True) + penalty_matrix
+
+            # the pseudo inverse takes the smallest step when the design has
+            # collinear columns, such as topic probabilities that sum to one
+            # next to the intercept, so the fits stay at the minimum norm
+            # solution that sklearn's newton-cg finds
+            step = np.matmul(np.linalg.pinv(hessian, rcond = 1e-12, hermitian = True),
+                             gradient[:, :, np.newaxis])[:, :, 0]
+
+            beta[active] = active_beta + step
+            converged[active] = np.abs(step).max(axis = 1) < tol
+
+    # a sample that is (quasi) separable has no finite maximum likelihood
+    # estimate, and Newton's steps don't shrink: each one moves the closest
+    # rows about one unit further from the boundary, so the coefficients grow
+    # without converging in max_iter steps.  Fitted probabilities near 0 or 1
+    # alone are no sign of separation, fits with a strong signal have them.
+    converged &= np.isfinite(beta).all(axis = 1)
 
-    bootstrapped_coefs = Parallel(n_jobs = n_jobs, backend = "loky")(
-        delayed(bootstrap_model)(skmodel, skmodel_args, X, y, state) for state in range(n_bootstraps))
+    # a sample of a single class is separable too, but once its fitted
+    # probabilities round to 1 the gradient is exactly zero and the step
+    # looks converged
+    positives = weights @ y
+    converged &= (positives > 0) & (positives < weights.sum(axis = 1))
 
-    return np.array(bootstrapped_coefs)
+    return beta, converged
@@ -0,0 +1,407 @@
+#
+# fixture_server.py
+#
+# @author: Evan Yathon
+#
+# August 2019
+#
+# fixture_server renders previously scraped reviews back into pages that are
+# laid out like the airlinequality.com review pages and serves them over a
+# local HTTP server.  This lets the scraper be run and timed end to end with
+# no network access and without bothering the real website.
+#
+# sample usage
+# python src/fixture_server.py data/scraped_gw_reviews.csv --port 8000
+#
+# then scrape the local copy with
+# python src/scrape_reviews.py data/local_reviews.csv 0 --airline_url http://127.0.0.1:8000/airline-reviews/germanwings/
+#
+# Pages are sent gzipped to clients that accept it, as the real website does.
+# --failure_rate answers that fraction of requests with a 503 and a
+# Retry-After header, to check that a scrape rides out a flaky server.
+#
+# python src/fixture_server.py data/scraped_gw_reviews.csv --port 8000 --failure_rate 0.2
+
+# utils
+import argparse
+import gzip
+import hashlib
+import html
+import math
+import random
+import sys
+import threading
+import time
+
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import pandas as pd
+
+# star rating columns and the class used in the review table for each
+STAR_FIELDS = [
+    ("seat_comfort", "Seat Comfort", "seat_comfort_rating"),
+    ("cabin_staff_service", "Cabin Staff Service", "cabin_staff_service_rating"),
+    ("food_and_beverages", "Food & Beverages", "food_and_beverages_rating"),
+    ("inflight_entertainment", "Inflight Entertainment", "inflight_entertainment_rating"),
+    ("ground_service", "Ground Service", "ground_service_rating"),
+    ("value_for_money", "Value For Money", "value_for_money_rating")
+]
+
+# text valued columns and the class used in the review table for each
+TEXT_FIELDS = [
+    ("aircraft", "Aircraft", "aircraft"),
+    ("type_of_traveller", "Type Of Traveller", "traveller_type"),
+    ("cabin_flown", "Seat Type", "seat_type"),
+    ("route", "Route", "route"),
+    ("date_flown", "Date Flown", "date_flown")
+]
+
+def is_missing(value):
+    """
+    is_missing checks for the missing values that pandas uses when reading a csv
+
+    Args:
+        value : any value from a parsed review row
+
+    Return:
+        True if the value is None or NaN, False otherwise
+    """
+    return value is None or (isinstance(value, float) and math.isnan(value))
+
+def split_on(segments, value, tag, from_right = False):
+    """
+    split_on finds value in the plain text segments of a sub header and splits
+    it out into its own tagged segment.
+
+    Args:
+        segments (list) : (tag, text) pairs, tag is None for plain text
+        value (str) : text to split out
+        tag (tuple) : (opening, closing) html tags to wrap value in
+        from_right (bool) : split out the last occurence instead of the first
+
+    Return:
+        list of (tag, text) pairs
+    """
+    if is_missing(value) or value == "":
+        return segments
+
+    order = range(len(segments) - 1, -1, -1) if from_right else range(len(segments))
+    for i in order:
+        segment_tag, text = segments[i]
+        index = -1
+        if segment_tag is None:
+            index = text.rfind(value) if from_right else text.find(value)
+        if index >= 0:
+            split = [(None, text[:index]), (tag, value), (None, text[index + len(value):])]
+            return segments[:i] + split + segments[i + 1:]
+
+    return segments
+
+def render_sub_header(row):
+    """
+    render_sub_header rebuilds the reviewer sub header from the scraped
+    `reviewer_country` column.  Note that BeautifulSoup collapses runs of
+    whitespace between tags, so the text scraped back from the fixture only
+    matches the original up to whitespace.
+
+    Args:
+        row (dict) : a scraped review
+
+    Return:
+        (str) html of the h3 sub header
+    """
+    text = row["reviewer_country"] if not is_missing(row["reviewer_country"]) else ""
+
+    segments = [(None, text)]
+    segments = split_on(segments, row["n_user_reviews"], ('<span class="userStatusReviewCount">', "</span>"))
+    segments = split_on(segments, row["reviewer_name"],
+                        ('<span itemprop="author"><span itemprop="name">', "</span></span>"))
+    segments = split_on(segments, row["date_of_review"], ('<time itemprop="datePublished">', "</time>"),
+                        from_right = True)
+
+    inner = "".join(html.escape(value) if tag is None else tag[0] + html.escape(value) + tag[1]
+                    for tag, value in segments if value != "")
+
+    return '<h3 class="text_sub_header userStatusWrapper">' + inner + "</h3>"
+
+def render_review(row):
+    """
+    render_review renders one scraped review as an `<article itemprop="review">`.
+
+    Args:
+        row (dict) : a scraped review
+
+    Return:
+        (str) html of the review
+    """
+    parts = ['<article itemprop="review" class="comp comp_media-review-rated list-item media">']
+
+    if not is_missing(row["review_value"]):
+        parts.append('<div class="rating-10"><span itemprop="ratingValue">{}</span>/'
+                     '<span itemprop="bestRating">10</span></div>'.format(int(row["review_value"])))
+
+    parts.append('<h2 class="text_header">{}</h2>'.format(html.escape(row["title"])))
+    parts.append(render_sub_header(row))
+    parts.append('<div class="text_content" itemprop="reviewBody">{}</div>'.format(
+        html.escape(row["review_text"] if not is_missing(row["review_text"]) else "")))
+
+    parts.append('<table class="review-ratings">')
+    for css_class, label, column in TEXT_FIELDS:
+        if not is_missing(row[column]):
+            parts.append('<tr><td class="review-rating-header {}">{}</td>'
+                         '<td class="review-value">{}</td></tr>'.format(css_class, label, html.escape(row[column])))
+
+    for css_class, label, column in STAR_FIELDS:
+        if not is_missing(row[column]):
+            stars = "".join('<span class="star fill">{}</span>'.format(star) if star <= row[column]
+                            else '<span class="star">{}</span>'.format(star) for star in range(1, 6))
+            parts.append('<tr><td class="review-rating-header {}">{}</td>'
+                         '<td class="review-rating-stars stars">{}</td></tr>'.format(css_class, label, stars))
+
+    parts.append('<tr><td class="review-rating-header recommended">Recommended</td>'
+                 '<td class="review-value rating-{0}">{0}</td></tr>'.format(html.escape(row["recommendation"])))
+    parts.append("</table></article>")
+
+    return "".join(parts)
+
+def render_pagination(slug, page, n_pages, window = 2):
+    """
+    render_pagination renders the page links shown under the reviews.  Like the
+    real website only a window of pages around the current one is linked, plus
+    the last page and a ">>" link to the next page.
+
+    Args:
+        slug (str) : airline slug, for example "germanwings"
+        page (int) : current page number, starting at 1
+        n_pages (int) : total number of pages
+        window (int) : number of page links shown either side of the current page
+
+    Return:
+        (str) html of the pagination
+    """
+    base = "/airline-reviews/{}/".format(slug)
+    link = '<li><a href="' + base + 'page/{0}/">{1}</a></li>'
+
+    shown = sorted(set([1, n_pages] + list(range(max(1, page - window), min(n_pages, page + window) + 1))))
+    items = ["<li><span>{}</span></li>".format(n) if n == page else link.format(n, n) for n in shown]
+
+    if page < n_pages:
+        items.append(link.format(page + 1, "&gt;&gt;"))
+
+    return '<article class="comp comp_reviews-pagination querylist-pagination"><ul>{}</ul></article>'.format(
+        "".join(items))
+
+class FixtureSite:
+    """
+    FixtureSite holds reviews for one or more airlines and renders them as
+    paginated review pages.
+
+    Arguments:
+        reviews (dict): airline slug mapped to a pandas dataframe of scraped reviews,
+                        in the column layout written by scrape_reviews.py
+        page_size (int): number of reviews on each page
+
+    Attributes:
+        pages (dict): airline slug mapped to a list of rendered pages (bytes)
+        last_modified (str): Last-Modified header sent with every page
+        n_requests (int): number of requests answered so far, including 304s
+                          and failures
+        n_failures (int): number of requests answered with a simulated failure
+    """
+
+    def __init__(self, reviews, page_size = 10):
+
+        self.page_size = page_size
+        self.pages = {}
+        self.last_modified = formatdate(time.time(), usegmt = True)
+        self.n_requests = 0
+        self.n_failures = 0
+        self.lock = threading.Lock()
+
+        for slug, df in reviews.items():
+            self.pages[slug] = self.render_airline(slug, df)
+
+    def render_airline(self, slug, df):
+        """
+        Renders every page for a single airline.
+
+        Arguments:
+            slug (str): airline slug used in the page urls
+            df (pd.DataFrame): scraped reviews for the airline
+
+        Return:
+            list of rendered pages as utf-8 bytes
+        """
+        rows = df.to_dict("records")
+        n_pages = max(1, int(math.ceil(len(rows) / float(self.page_size))))
+
+        pages = []
+        for page in range(1, n_pages + 1):
+            page_rows = rows[(page - 1) * self.page_size:page * self.page_size]
+            body = "".join(render_review(row) for row in page_rows)
+            document = "<html><head><title>{} Customer Reviews</title></head><body>{}{}</body></html>".format(
+                slug, body, render_pagination(slug, page, n_pages))
+            pages.append(document.encode("utf-8"))
+
+        return pages
+
+    def lookup(self, path):
+        """
+        Finds the rendered page for a request path.
+
+        Arguments:
+            path (str): path of the request, for example "/airline-reviews/germanwings/page/2/"
+
+        Return:
+            the page as bytes, or None if there is no such page
+        """
+        parts = [part for part in path.split("?")[0].split("/") if part]
+
+        if len(parts) < 2 or parts[0] != "airline-reviews" or parts[1] not in self.pages:
+            return None
+
+        page = 1
+        if len(parts) == 4 and parts[2] == "page" and parts[3].isdigit():
+            page = int(parts[3])
+        elif len(parts) != 2:
+            return None
+
+        pages = self.pages[parts[1]]
+        if page < 1 or page > len(pages):
+            return None
+
+        return pages[page - 1]
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+
+    """
+    ThreadingHTTPServer answers each connection in its own thread.  Python 3.7
+    has this built in as http.server.ThreadingHTTPServer.
+    """
+
+    daemon_threads = True
+
+def make_handler(site, latency = 0.0, failure_rate = 0.0, retry_after = 0, random_state = 0):
+    """
+    make_handler creates a request handler class bound to a FixtureSite.
+
+    Args:
+        site (FixtureSite) : the pages to serve
+        latency (float) : seconds to wait before answering each request, to
+                          mimic the round trip to the real website
+        failure_rate (float) : fraction of requests answered with a 503
+        retry_after (int) : seconds sent in the Retry-After header of a 503
+        random_state (int) : seed of which requests fail
+
+    Return:
+        a BaseHTTPRequestHandler subclass
+    """
+
+    rng = random.Random(random_state)
+
+    class FixtureHandler(BaseHTTPRequestHandler):
+
+        # keep-alive so that clients holding connections open behave like
+        # they would against the real website
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            if latency > 0:
+                time.sleep(latency)
+
+            with site.lock:
+                site.n_requests += 1
+                fail = failure_rate > 0 and rng.random() < failure_rate
+                site.n_failures += fail
+
+            if fail:
+                self.send_response(503)
+                self.send_header("Retry-After", str(retry_after))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+            page = site.lookup(self.path)
+            if page is None:
+                self.send_error(404)
+                return
+
+            # answer conditional requests for unchanged pages without the page
+            etag = '"{}"'.format(hashlib.sha1(page).hexdigest())
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+
+            compress = "gzip" in self.headers.get("Accept-Encoding", "")
+            if compress:
+                page = gzip.compress(page)
+
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            if compress:
+                self.send_header("Content-Encoding", "gzip")
+            self.send_header("Content-Length", str(len(page)))
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", site.last_modified)
+            self.end_headers()
+            self.wfile.write(page)
+
+        def log_message(self, format, *args):
+            # keep benchmark output clean
+            pass
+
+    return FixtureHandler
+
+def serve_fixture(site, host = "127.0.0.1", port = 0, latency = 0.0, failure_rate = 0.0, retry_after = 0):
+    """
+    serve_fixture starts a threaded HTTP server for a FixtureSite in a
+    background thread.
+
+    Args:
+        site (FixtureSite) : the pages to serve
+        host (str) : interface to bind
+        port (int) : port to bind, 0 picks a free port
+        latency (float) : seconds to wait before answering each request
+        failure_rate (float) : fraction of requests answered with a 503
+        retry_after (int) : seconds sent in the Retry-After header of a 503
+
+    Return:
+        (server, base_url) the running server, stop it with server.shutdown(),
+        and the url it can be reached at
+    """
+    server = ThreadingHTTPServer((host, port), make_handler(site, latency, failure_rate, retry_after))
+
+    thread = threading.Thread(target = server.serve_forever, daemon = True)
+    thread.start()
+
+    return server, "http://{}:{}".format(*server.server_address[:2])
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("load_path")
+    parser.add_argument("--slug", default = "germanwings")
+    parser.add_argument("--port", type = int, default = 8000)
+    parser.add_argument("--page_size", type = int, default = 10)
+    parser.add_argument("--latency", type = float, default = 0.0)
+    parser.add_argument("--failure_rate", type = float, default = 0.0)
+    parser.add_argument("--retry_after", type = int, default = 1)
+    args = parser.parse_args()
+
+    site = FixtureSite({args.slug : pd.read_csv(args.load_path)}, page_size = args.page_size)
+    server, base_url = serve_fixture(site, port = args.port, latency = args.latency,
+                                    failure_rate = args.failure_rate, retry_after = args.retry_after)
+
+    sys.stdout.write("Serving {} pages at {}/airline-reviews/{}/\n".format(
+        len(site.pages[args.slug]), base_url, args.slug))
+    sys.stdout.flush()
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,248 @@
+#
+# http_session.py
+#
+# @author: Evan Yathon
+#
+# August 2019
+#
+# http_session is the fetch layer of the scrapers.  An HttpSession keeps a
+# pool of keep-alive connections per host with urllib3, so pages after the
+# first reuse an open connection rather than paying a new TCP and TLS
+# handshake each.  Responses are asked for compressed and decoded as they're
+# read (gzip and deflate, and brotli when the brotli package is installed).
+#
+# Requests that fail with a connection error, a timeout or a 429/5xx status
+# are retried with exponential backoff and full jitter, waiting as long as the
+# server's Retry-After header asks instead when it sends one.  Every request
+# gives back a FetchResult with the status, body, size and latency rather than
+# raising, and FetchResult.raise_for_status() turns a failed one into a
+# FetchError for callers that can't carry on without the page.
+#
+# The retries, bytes and time of each request are counted for the
+# instrumented stages, see instrumentation.py.
+#
+# Example usage:
+# session = HttpSession(max_connections = 4)
+# result = session.get("https://www.airlinequality.com/airline-reviews/germanwings/")
+# result.status, len(result.content), result.latency, result.retries
+
+import random
+import time
+
+import urllib3
+
+from urllib3.exceptions import HTTPError, MaxRetryError
+from urllib3.util.retry import Retry
+
+from instrumentation import count
+
+try:
+    # urllib3 decodes brotli responses when the package is installed
+    import brotli
+    ACCEPT_ENCODING = ["gzip", "deflate", "br"]
+except ImportError:
+    ACCEPT_ENCODING = ["gzip", "deflate"]
+
+#`airlinequality.com` had a blocker for the default `urllib` agent, so a browser's agent is sent
+# Source:
+# https://stackoverflow.com/questions/16627227/http-error-403-in-python-3-web-scraping
+USER_AGENT = "Mozilla/5.0"
+
+# statuses that are worth trying again, rate limiting and server errors
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+class JitteredRetry(Retry):
+
+    """
+    JitteredRetry is urllib3's Retry with full jitter: each backoff is drawn
+    uniformly between 0 and the exponential backoff, so that workers that
+    failed together don't all retry together.  A Retry-After header is still
+    honored as it is, since the server asked for that wait.
+
+    Arguments:
+        backoff_max (float): longest backoff, in seconds
+    """
+
+    def __init__(self, *args, backoff_max = 60.0, **kwargs):
+
+        super().__init__(*args, **kwargs)
+        self.backoff_max = backoff_max
+
+    def new(self, **kwargs):
+
+        kwargs.setdefault("backoff_max", self.backoff_max)
+
+        return super().new(**kwargs)
+
+    def get_backoff_time(self):
+
+        backoff = min(self.backoff_max, super().get_backoff_time())
+
+        return random.uniform(0, backoff)
+
+class FetchError(Exception):
+
+    """
+    FetchError is raised by FetchResult.raise_for_status for a request that
+    still failed after its retries.
+
+    Attributes:
+        result (FetchResult): the failed request
+    """
+
+    def __init__(self, result):
+
+        super().__init__("GET {} failed after {} retries: {}".format(
+            result.url, result.retries, result.error if result.error is not None else result.status))
+        self.result = result
+
+class FetchResult:
+
+    """
+    FetchResult is the outcome of one request and its retries.
+
+    Attributes:
+        url (str): url requested
+        status (int): HTTP status of the last attempt, None if no answer was received
+        content (bytes): decoded body, empty if the request failed
+        headers (dict): response headers of the last attempt
+        n_bytes (int): size of the decoded body
+        latency (float): seconds from sending the request to reading the body,
+                         including the waits between retries
+        retries (int): number of attempts after the first
+        error (str): description of the failure, None if a response was received
+    """
+
+    def __init__(self, url, status, content = b"", headers = None, latency = 0.0, retries = 0, error = None):
+
+        self.url = url
+        self.status = status
+        self.content = content
+        self.headers = headers if headers is not None else {}
+        self.n_bytes = len(content)
+        self.latency = latency
+        self.retries = retries
+        self.error = error
+
+    @property
+    def ok(self):
+        """
+        Whether the page was received, or is unchanged since a conditional request.
+        """
+        return self.status is not None and (200 <= self.status < 300 or self.status == 304)
+
+    def raise_for_status(self):
+        """
+        Raises a FetchError unless the request was ok.
+
+        Return:
+            self
+        """
+        if not self.ok:
+            raise FetchError(self)
+
+        return self
+
+    def __repr__(self):
+        return "FetchResult(url = {!r}, status = {}, n_bytes = {}, latency = {:.3f}, retries = {})".format(
+            self.url, self.status, self.n_bytes, self.latency, self.retries)
+
+class HttpSession:
+
+    """
+    HttpSession fetches pages over pooled keep-alive connections, retrying
+    failed requests.  It is safe to share between threads.
+
+    Arguments:
+        max_connections (int): connections kept open to each host, set it to
+                               the number of threads sharing the session
+        retries (int): most attempts after the first
+        backoff_factor (float): the nth retry waits up to backoff_factor * 2 ** (n - 1) seconds
+        backoff_max (float): longest wait between attempts, unless the server
+                             asks for longer with Retry-After
+        connect_timeout (float): seconds to wait for a connection
+        read_timeout (float): seconds to wait for the server between bytes
+        headers (dict): headers sent with every request, on top of the
+                        User-Agent and Accept-Encoding
+    """
+
+    def __init__(self, max_connections = 1, retries = 5, backoff_factor = 1.0, backoff_max = 60.0,
+                 connect_timeout = 10.0, read_timeout = 30.0, headers = None):
+
+        self.retry = JitteredRetry(total = retries, backoff_factor = backoff_factor, backoff_max = backoff_max,
+                                   status_forcelist = RETRY_STATUSES, method_whitelist = ["GET"],
+                                   respect_retry_after_header = True, raise_on_status = False)
+        self.timeout = urllib3.Timeout(connect = connect_timeout, read = read_timeout)
+
+        request_headers = urllib3.make_headers(accept_encoding = ACCEPT_ENCODING, user_agent = USER_AGENT)
+        request_headers.update(headers or {})
+
+        # block = True makes threads wait for a free connection rather than
+        # opening connections that are thrown away after one request
+        self.pool = urllib3.PoolManager(num_pools = 4, maxsize = max_connections, block = True,
+                                        headers = request_headers, retries = self.retry,
+                                        timeout = self.timeout)
+
+    def get(self, url, headers = None):
+        """
+        Requests a page, retrying on connection errors, timeouts and 429/5xx
+        answers.
+
+        Args:
+            url (str) : url of the page
+            headers (dict) : additional request headers, for example for a
+                             conditional request
+
+        Return:
+            FetchResult, whose status is 304 if a conditional request's page
+            hasn't changed
+        """
+        start = time.perf_counter()
+
+        try:
+            response = self.pool.request("GET", url, headers = self.request_headers(headers))
+        except MaxRetryError as error:
+            # only raised once every retry has been used
+            return self.failed(url, start, self.retry.total, error.reason)
+        except HTTPError as error:
+            return self.failed(url, start, 0, error)
+
+        retries = len(response.retries.history) if response.retries is not None else 0
+        result = FetchResult(url, response.status, content = response.data, headers = dict(response.headers),
+                             latency = time.perf_counter() - start, retries = retries)
+
+        count("requests")
+        count("http_retries", retries)
+        count("bytes_fetched", result.n_bytes)
+        count("fetch_seconds", result.latency)
+
+        return result
+
+    def request_headers(self, headers):
+        """
+        The session's headers with the request's own added.
+        """
+        if not headers:
+            return None
+
+        request_headers = dict(self.pool.headers)
+        request_headers.update(headers)
+
+        return request_headers
+
+    def failed(self, url, start, retries, reason):
+        """
+        The result of a request that got no answer.
+        """
+        count("requests")
+        count("http_retries", retries)
+        count("http_failures")
+
+        return FetchResult(url, None, latency = time.perf_counter() - start, retries = retries,
+                           error = "{}: {}".format(type(reason).__name__, reason))
+
+    def clear(self):
+        """
+        Closes the session's open connections.
+        """
+        self.pool.clear()
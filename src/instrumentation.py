@@ -0,0 +1,461 @@
+#
+# instrumentation.py
+#
+# @author: Evan Yathon
+#
+# August 2019
+#
+# instrumentation records what each stage of the analysis costs: wall and CPU
+# time, items processed, counters such as bytes fetched or HTTP retries, and
+# peak memory.  Code marks a stage with `with stage("name") as s:` and counts
+# with `count("bytes_fetched", n)`.  A count is added to every stage open at
+# the time, from any thread, so the bytes fetched by the crawl's threads are
+# counted in the scrape stage.
+#
+# Nothing is recorded until configure() is called.  Until then stage() hands
+# back a shared object that does nothing and count() returns straight away.
+#
+# Stage records are appended to a JSON lines log, one line per stage, or
+# written as a Prometheus text file when the path ends in .prom, with the
+# totals of each stage name.  Stages named in `profile` are run under cProfile
+# and their stats saved to a .prof file, and stages named in `trace_memory`
+# are run under tracemalloc and their largest allocations saved to a .txt
+# file, both in profile_dir.
+#
+# configure() also sets the REVIEWS_METRICS* environment variables, so
+# processes started afterwards, such as the pipeline's workers, record their
+# stages to the same log.  A Prometheus file is per process, those started
+# afterwards write to <name>-<pid>.prom.
+#
+# Peak memory is the process's peak resident set size, which never goes down,
+# so it's the peak of the stage and everything run before it.  Under
+# tracemalloc the peak of the Python allocations within the stage is recorded
+# as well.
+#
+# Example usage:
+# configure("data/metrics.jsonl", profile = ["TopicModel.train"])
+# with stage("parse") as s:
+#     rows = list(parse_reviews(pages))
+#     s.add("items", len(rows))
+#
+# sample usage, from the command line
+# REVIEWS_METRICS=data/metrics.prom python src/scrape_reviews.py data/scraped_gw_reviews.csv 5
+
+import cProfile
+import json
+import os
+import re
+import sys
+import threading
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, where peak memory isn't recorded
+    resource = None
+
+from page_cache import atomic_write
+
+# environment variables read when the module is imported
+ENV_PATH = "REVIEWS_METRICS"
+ENV_PROFILE = "REVIEWS_METRICS_PROFILE"
+ENV_TRACE_MEMORY = "REVIEWS_METRICS_TRACE_MEMORY"
+ENV_PROFILE_DIR = "REVIEWS_METRICS_PROFILE_DIR"
+ENV_PID = "REVIEWS_METRICS_PID"
+
+# number of allocation sites saved by trace_memory
+TOP_ALLOCATIONS = 25
+
+class NullStage:
+
+    """
+    NullStage is what stage() gives when instrumentation is off, so that
+    instrumented code costs a function call and nothing more.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def add(self, name, value = 1):
+        pass
+
+NULL_STAGE = NullStage()
+
+class Stage:
+
+    """
+    Stage measures one run of a stage, from entering it to leaving it.
+
+    Arguments:
+        recorder (Recorder): recorder the stage reports to
+        name (str): name of the stage
+        labels (dict): extra fields saved with the record
+
+    Attributes:
+        counters (dict): counter name mapped to its total within the stage
+    """
+
+    def __init__(self, recorder, name, labels):
+
+        self.recorder = recorder
+        self.name = name
+        self.labels = labels
+        self.counters = {}
+        self.traced_peak = 0
+
+        self.profiler = None
+        self.started_tracing = False
+
+    def add(self, name, value = 1):
+        """
+        Adds to one of this stage's counters only, rather than to every open
+        stage as count() does.
+        """
+        with self.recorder.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def __enter__(self):
+
+        recorder = self.recorder
+
+        if recorder.matches(recorder.trace_memory, self.name) and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracing = True
+
+        recorder.open_stage(self)
+
+        # cProfile can't run inside another profiler
+        if recorder.matches(recorder.profile, self.name) and not recorder.profiling:
+            recorder.profiling = True
+            self.profiler = cProfile.Profile()
+
+        self.start = time.time()
+        self.wall_start = time.perf_counter()
+        self.cpu_start = time.process_time()
+
+        if self.profiler is not None:
+            self.profiler.enable()
+
+        return self
+
+    def __exit__(self, *exc):
+
+        if self.profiler is not None:
+            self.profiler.disable()
+
+        wall = time.perf_counter() - self.wall_start
+        cpu = time.process_time() - self.cpu_start
+
+        recorder = self.recorder
+        recorder.close_stage(self)
+
+        record = {
+            "stage" : self.name,
+            "pid" : os.getpid(),
+            "start" : self.start,
+            "wall_seconds" : wall,
+            "cpu_seconds" : cpu,
+            "peak_rss_mb" : peak_rss_mb(),
+            "counters" : self.counters
+        }
+        if self.traced_peak > 0:
+            record["peak_traced_mb"] = self.traced_peak / 2 ** 20
+        if exc[0] is not None:
+            record["error"] = exc[0].__name__
+        record.update(self.labels)
+
+        if self.profiler is not None:
+            self.profiler.dump_stats(recorder.output_path(self.name, ".prof"))
+            recorder.profiling = False
+
+        if self.started_tracing:
+            write_allocations(tracemalloc.take_snapshot(), recorder.output_path(self.name, ".txt"))
+            tracemalloc.stop()
+
+        recorder.record(record)
+
+        return False
+
+class Recorder:
+
+    """
+    Recorder keeps the open stages and writes the record of each stage as it
+    finishes.  The module's RECORDER is the one used by stage() and count().
+
+    Attributes:
+        enabled (bool): whether stages are recorded
+        path (str): JSON lines log or Prometheus .prom file written to
+        profile (set): names of stages to run under cProfile, "*" for all
+        trace_memory (set): names of stages to run under tracemalloc, "*" for all
+        profile_dir (str): directory of the profiles and allocations
+        totals (dict): stage name mapped to the totals of every run of it
+    """
+
+    def __init__(self):
+
+        self.lock = threading.Lock()
+        self.enabled = False
+        self.path = None
+        self.profile = set()
+        self.trace_memory = set()
+        self.profile_dir = None
+        self.open_stages = []
+        self.profiling = False
+        self.totals = {}
+        self.pid = os.getpid()
+
+    def configure(self, path = None, profile = (), trace_memory = (), profile_dir = None):
+
+        self.path = path
+        self.profile = set(profile)
+        self.trace_memory = set(trace_memory)
+        self.profile_dir = profile_dir if profile_dir is not None else \
+            os.path.dirname(path or "") or "."
+        self.enabled = True
+
+    def matches(self, names, name):
+        return name in names or "*" in names
+
+    def open_stage(self, stage):
+
+        with self.lock:
+            # a forked worker starts with a copy of its parent's stages and
+            # totals, which aren't its own
+            if os.getpid() != self.pid:
+                self.pid = os.getpid()
+                self.open_stages = []
+                self.profiling = False
+                self.totals = {}
+
+            self.update_traced_peaks()
+            self.open_stages.append(stage)
+
+    def close_stage(self, stage):
+
+        with self.lock:
+            self.update_traced_peaks()
+            self.open_stages.remove(stage)
+
+    def update_traced_peaks(self):
+        """
+        Folds the traced peak since the last stage opened or closed into every
+        open stage, then starts a new peak, so nested stages each get their own.
+        """
+        if not tracemalloc.is_tracing():
+            return
+
+        peak = tracemalloc.get_traced_memory()[1]
+        for stage in self.open_stages:
+            stage.traced_peak = max(stage.traced_peak, peak)
+
+        # reset_peak is new in Python 3.9, before it the peak is since tracing started
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+
+    def count(self, name, value):
+
+        with self.lock:
+            for stage in self.open_stages:
+                stage.counters[name] = stage.counters.get(name, 0) + value
+
+    def record(self, record):
+
+        with self.lock:
+            totals = self.totals.setdefault(record["stage"], {"runs" : 0, "wall_seconds" : 0.0,
+                                                              "cpu_seconds" : 0.0, "peak_rss_mb" : 0.0,
+                                                              "counters" : {}})
+            totals["runs"] += 1
+            totals["wall_seconds"] += record["wall_seconds"]
+            totals["cpu_seconds"] += record["cpu_seconds"]
+            totals["peak_rss_mb"] = max(totals["peak_rss_mb"], record["peak_rss_mb"] or 0.0)
+            for name, value in record["counters"].items():
+                totals["counters"][name] = totals["counters"].get(name, 0) + value
+
+            if self.path is None:
+                return
+
+            if self.path.endswith(".prom"):
+                atomic_write(self.prometheus_path(), prometheus_text(self.totals).encode("utf-8"))
+            else:
+                # a single write of a line to a file opened for appending, so
+                # that lines from several processes don't interleave
+                with open(self.path, "a") as f:
+                    f.write(json.dumps(record, default = str) + "\n")
+
+    def prometheus_path(self):
+        """
+        Path of this process's Prometheus file.
+        """
+        if os.environ.get(ENV_PID, str(os.getpid())) == str(os.getpid()):
+            return self.path
+
+        return "{}-{}.prom".format(self.path[:-len(".prom")], os.getpid())
+
+    def output_path(self, stage_name, extension):
+        """
+        Path of a profile or allocations file of a stage.
+        """
+        os.makedirs(self.profile_dir, exist_ok = True)
+        file_name = "{}-{}-{}{}".format(re.sub(r"[^\w.-]", "_", stage_name), os.getpid(),
+                                         int(time.time() * 1000), extension)
+
+        return os.path.join(self.profile_dir, file_name)
+
+RECORDER = Recorder()
+
+def configure(path = None, profile = (), trace_memory = (), profile_dir = None):
+    """
+    Turns instrumentation on for this process and the processes it starts.
+
+    Args:
+        path (str) : JSON lines log to append stage records to, or a
+                     Prometheus text file if it ends in .prom.  None keeps the
+                     records in memory only, in RECORDER.totals.
+        profile (iterable) : names of stages to run under cProfile, "*" for all
+        trace_memory (iterable) : names of stages to run under tracemalloc, "*" for all
+        profile_dir (str) : directory of the .prof and allocations files,
+                            default the directory of path
+    """
+    RECORDER.configure(path, profile, trace_memory, profile_dir)
+
+    os.environ[ENV_PATH] = path if path is not None else ""
+    os.environ[ENV_PROFILE] = ",".join(sorted(RECORDER.profile))
+    os.environ[ENV_TRACE_MEMORY] = ",".join(sorted(RECORDER.trace_memory))
+    os.environ[ENV_PROFILE_DIR] = RECORDER.profile_dir
+    os.environ[ENV_PID] = str(os.getpid())
+
+def configure_from_env():
+    """
+    Turns instrumentation on if REVIEWS_METRICS is set, as it is for the
+    processes started after configure().
+    """
+    if ENV_PATH not in os.environ:
+        return
+
+    RECORDER.configure(os.environ[ENV_PATH] or None,
+                       profile = split_names(os.environ.get(ENV_PROFILE, "")),
+                       trace_memory = split_names(os.environ.get(ENV_TRACE_MEMORY, "")),
+                       profile_dir = os.environ.get(ENV_PROFILE_DIR) or None)
+
+def stage(name, **labels):
+    """
+    stage gives a context manager measuring a stage, or one that does nothing
+    when instrumentation is off.
+
+    Args:
+        name (str) : name of the stage, for example "TopicModel.train"
+        labels : extra fields saved with the record
+
+    Return:
+        Stage, or NULL_STAGE
+    """
+    if not RECORDER.enabled:
+        return NULL_STAGE
+
+    return Stage(RECORDER, name, labels)
+
+def count(name, value = 1):
+    """
+    count adds to a counter of every open stage.
+
+    Args:
+        name (str) : name of the counter, for example "bytes_fetched"
+        value (number) : amount to add
+    """
+    if RECORDER.enabled:
+        RECORDER.count(name, value)
+
+def add_arguments(parser):
+    """
+    add_arguments adds the --metrics_path, --profile_stages and
+    --trace_memory_stages options to a script's argument parser.
+    """
+    parser.add_argument("--metrics_path", default = None,
+                        help = "JSON lines log of each stage's cost, or a .prom Prometheus text file")
+    parser.add_argument("--profile_stages", nargs = "*", default = [],
+                        help = "stages to run under cProfile, * for all")
+    parser.add_argument("--trace_memory_stages", nargs = "*", default = [],
+                        help = "stages to run under tracemalloc, * for all")
+
+def configure_from_args(args):
+    """
+    configure_from_args turns instrumentation on if any of the options added
+    by add_arguments was given.
+    """
+    if args.metrics_path is not None or len(args.profile_stages) > 0 or len(args.trace_memory_stages) > 0:
+        configure(args.metrics_path, profile = args.profile_stages, trace_memory = args.trace_memory_stages)
+
+def peak_rss_mb():
+    """
+    peak_rss_mb gives the peak resident set size of the process in megabytes,
+    None where it isn't available.
+    """
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # ru_maxrss is in bytes on macOS and kilobytes on Linux
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+def prometheus_text(totals):
+    """
+    prometheus_text gives the totals of each stage in the Prometheus text
+    exposition format.
+
+    Args:
+        totals (dict) : Recorder.totals
+
+    Return:
+        (str) the metrics, with a stage label
+    """
+    metrics = [("runs", "runs_total", "counter", "Number of runs of the stage."),
+               ("wall_seconds", "wall_seconds_total", "counter", "Wall time spent in the stage."),
+               ("cpu_seconds", "cpu_seconds_total", "counter", "CPU time of the process during the stage."),
+               ("peak_rss_mb", "peak_rss_bytes", "gauge", "Peak resident set size at the end of the stage.")]
+    counter_names = sorted({name for stage_totals in totals.values() for name in stage_totals["counters"]})
+
+    lines = []
+    for key, metric, metric_type, help_text in metrics:
+        lines += ["# HELP reviews_stage_{} {}".format(metric, help_text),
+                  "# TYPE reviews_stage_{} {}".format(metric, metric_type)]
+        for stage_name in sorted(totals):
+            value = totals[stage_name][key]
+            if key == "peak_rss_mb":
+                value = value * 2 ** 20
+            lines.append('reviews_stage_{}{{stage="{}"}} {}'.format(metric, escape_label(stage_name), value))
+
+    for name in counter_names:
+        metric = re.sub(r"[^a-zA-Z0-9_]", "_", name)
+        lines += ["# HELP reviews_stage_{}_total Total {} within the stage.".format(metric, name),
+                  "# TYPE reviews_stage_{}_total counter".format(metric)]
+        for stage_name in sorted(totals):
+            if name in totals[stage_name]["counters"]:
+                lines.append('reviews_stage_{}_total{{stage="{}"}} {}'.format(
+                    metric, escape_label(stage_name), totals[stage_name]["counters"][name]))
+
+    return "\n".join(lines) + "\n"
+
+def escape_label(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def write_allocations(snapshot, path):
+    """
+    write_allocations saves the lines that allocated the most memory still
+    held in a tracemalloc snapshot.
+    """
+    stats = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)]).statistics("lineno")
+
+    with open(path, "w") as f:
+        for stat in stats[:TOP_ALLOCATIONS]:
+            f.write("{}\n".format(stat))
+
+def split_names(value):
+    return [name for name in value.split(",") if name != ""]
+
+configure_from_env()
@@ -0,0 +1,345 @@
+# l1_path.py
+#
+# @author: Evan Yathon
+#
+# August 2019
+#
+# This script computes the regularization path of an L1 penalized logistic
+# regression, the coefficients at every value of C, for the feature
+# importance sweep of the regression analysis notebook.
+#
+# Rather than fitting a new liblinear model from zero for each C, the path is
+# fit from the strongest regularization to the weakest, each fit starting
+# from the coefficients of the one before.  Each fit is a proximal Newton
+# method: a weighted least squares approximation of the log loss plus the
+# penalty is minimized exactly on its small Gram matrix.  The objective
+# is liblinear's, C times the log loss plus the L1 norm of the coefficients
+# and the intercept, so the path matches the notebook's per C fits.
+#
+# stability_selection repeats the path on bootstrap resamples in parallel,
+# giving how often each feature is selected at each C.
+#
+# Example usage:
+# path = regularization_path(X, y, 6**np.linspace(-2, 8, 200))
+# path["importance_order"]
+# selection = stability_selection(X, y, 6**np.linspace(-2, 8, 200), n_resamples = 200)
+#
+# joblib, scipy and pandas are imported by the functions that use them, like
+# in bootstrap_skmodel.py.
+
+import numpy as np
+
+from bootstrap_skmodel import as_arrays, bootstrap_chunk_size, bootstrap_counts, bootstrap_seeds
+
+def l1_logistic_path(X, y, C_vals, sample_weight = None, fit_intercept = True, penalize_intercept = True,
+                     max_iter = 100, tol = 1e-6):
+    """
+    Fits an L1 penalized logistic regression at each value of C, warm
+    starting each fit from the neighbouring, more regularized one.
+
+    Parameters:
+        X (numpy array): array of predictors
+        y (numpy array): 1d array of binary response values
+        C_vals (array): inverse regularization strengths, in any order
+        sample_weight (numpy array): optional weight of each row, for
+                                     example bootstrap counts
+        fit_intercept (bool): whether to fit an intercept
+        penalize_intercept (bool): whether the intercept is penalized, as
+                                   liblinear does
+        max_iter (int): most Newton steps for each C
+        tol (float): largest change in a coefficient at convergence
+
+    Return:
+        (coefs, intercepts) array of coefficients with a row for each C in
+        the order of C_vals, and array of intercepts
+    """
+
+    C_vals = np.asarray(C_vals, dtype = float)
+    n_rows, n_features = X.shape
+
+    design = np.hstack([X, np.ones((n_rows, 1))]) if fit_intercept else X
+    weights = np.ones(n_rows) if sample_weight is None else np.asarray(sample_weight, dtype = float)
+
+    penalized = np.ones(design.shape[1], dtype = bool)
+    if fit_intercept and not penalize_intercept:
+        penalized[-1] = False
+
+    beta = np.zeros(design.shape[1])
+    path = np.empty((len(C_vals), design.shape[1]))
+
+    # from the strongest regularization, where few coefficients are non zero,
+    # to the weakest
+    for index in np.argsort(C_vals):
+        beta = fit_l1_logistic(design, y, weights, 1.0 / C_vals[index], penalized, beta, max_iter, tol)
+        path[index] = beta
+
+    if fit_intercept:
+        return path[:, :n_features], path[:, n_features]
+
+    return path, np.zeros(len(C_vals))
+
+def fit_l1_logistic(design, y, weights, alpha, penalized, beta, max_iter = 100, tol = 1e-6):
+    """
+    Minimizes the weighted log loss plus alpha times the L1 norm of the
+    penalized coefficients with proximal Newton steps.
+
+    Parameters:
+        design (numpy array): rows x coefficients design matrix
+        y (numpy array): 1d array of binary response values
+        weights (numpy array): weight of each row
+        alpha (float): L1 penalty, 1 / C
+        penalized (numpy array): whether each coefficient is penalized
+        beta (numpy array): starting coefficients
+        max_iter (int): most Newton steps
+        tol (float): largest change in a coefficient at convergence
+
+    Return:
+        array of fitted coefficients
+    """
+    from scipy.special import expit
+
+    beta = beta.copy()
+    thresholds = np.where(penalized, alpha, 0.0)
+    objective = l1_objective(design, y, weights, alpha, penalized, beta)
+
+    for _ in range(max_iter):
+
+        # weighted least squares approximation of the log loss around beta
+        probs = expit(design @ beta)
+        curvature = np.maximum(weights * probs * (1.0 - probs), 1e-10 * weights)
+        gram = (design.T * curvature) @ design
+        gradient = design.T @ (weights * (y - probs))
+
+        # its target, in terms of the Gram matrix: gram @ beta + gradient
+        target = gram @ beta + gradient
+
+        new_beta = solve_subproblem(gram, target, thresholds, beta, tol)
+
+        # halve the step until the objective doesn't increase
+        step = new_beta - beta
+        new_objective = l1_objective(design, y, weights, alpha, penalized, new_beta)
+        while new_objective > objective + 1e-12 and np.abs(step).max() > tol:
+            step = step / 2.0
+            new_beta = beta + step
+            new_objective = l1_objective(design, y, weights, alpha, penalized, new_beta)
+
+        beta, objective = new_beta, new_objective
+
+        if np.abs(step).max() < tol:
+            break
+
+    return beta
+
+def solve_subproblem(gram, target, thresholds, beta, tol, max_steps = None):
+    """
+    Minimizes 0.5 * b' gram b - target' b + sum(thresholds * |b|) exactly,
+    the L1 penalized quadratic of one proximal Newton step.
+
+    Writing b = u - v with u, v >= 0 makes it a quadratic program with only
+    non negativity constraints, which is solved with a primal active set
+    method starting from beta: the free variables take the unconstrained
+    Newton step, stopping at the first one to reach zero, and a variable at
+    zero is freed when its gradient says the objective decreases by doing so.
+
+    Coordinate descent, as glmnet uses, crawls on collinear columns such as
+    topic probabilities that sum to one next to the intercept.  There the
+    Gram matrix is singular and only the L1 norm changes along its null
+    space, so the active set method moves along the null space until a
+    coefficient reaches zero instead.
+
+    Parameters:
+        gram (numpy array): coefficients x coefficients positive semi definite matrix
+        target (numpy array): linear term
+        thresholds (numpy array): L1 penalty of each coefficient
+        beta (numpy array): starting coefficients
+        tol (float): largest gradient violation at the solution
+        max_steps (int): most active set changes, default 10 times the
+                         number of coefficients
+
+    Return:
+        array of coefficients
+    """
+
+    n_coefs = len(beta)
+    if max_steps is None:
+        max_steps = 10 * n_coefs
+
+    hessian = np.block([[gram, -gram], [-gram, gram]])
+    linear = np.concatenate([thresholds - target, thresholds + target])
+    z = np.concatenate([np.maximum(beta, 0.0), np.maximum(-beta, 0.0)])
+    free = z > 0
+    # whether z minimizes the quadratic over the free variables
+    stationary = False
+
+    for _ in range(max_steps):
+
+        gradient = hessian @ z + linear
+
+        if not stationary and free.any():
+            eigenvalues, eigenvectors = np.linalg.eigh(hessian[np.ix_(free, free)])
+            rank = eigenvalues > 1e-12 * max(eigenvalues[-1], 1e-300)
+            projected = eigenvectors.T @ gradient[free]
+
+            # the part of the gradient in the null space of the Hessian, along
+            # which the objective decreases linearly until a variable reaches
+            # zero, otherwise the Newton step
+            step = np.zeros(len(z))
+            null_part = eigenvectors[:, ~rank] @ projected[~rank]
+            unbounded = np.abs(null_part).max(initial = 0.0) > tol
+            if unbounded:
+                step[free] = -null_part
+            else:
+                step[free] = -eigenvectors[:, rank] @ (projected[rank] / eigenvalues[rank])
+
+            if np.abs(step).max() > tol * 1e-3:
+
+                # step to the first variable that reaches zero, or the full Newton step
+                shrinking = step < 0
+                ratios = np.full(len(z), np.inf)
+                ratios[shrinking] = -z[shrinking] / step[shrinking]
+                length = ratios.min()
+                if not unbounded:
+                    length = min(length, 1.0)
+
+                if not np.isfinite(length):
+                    # no variable bounds the decrease, the quadratic has no minimum
+                    break
+
+                z = z + length * step
+                reached = shrinking & (ratios <= length)
+                z[reached] = 0.0
+                free[reached] = False
+
+                # a full Newton step needs no other, which also stops rounding
+                # errors from taking endless tiny steps
+                stationary = not unbounded and not reached.any()
+                continue
+
+        # optimal unless moving a variable off zero decreases the objective
+        blocked = np.where(free, np.inf, gradient)
+        if blocked.min() >= -tol:
+            break
+        free[np.argmin(blocked)] = True
+        stationary = False
+
+    return z[:n_coefs] - z[n_coefs:]
+
+def l1_objective(design, y, weights, alpha, penalized, beta):
+    """
+    Weighted log loss plus alpha times the L1 norm of the penalized coefficients.
+    """
+    margins = design @ beta
+    log_loss = np.logaddexp(0.0, margins) - y * margins
+
+    return weights @ log_loss + alpha * np.abs(beta[penalized]).sum()
+
+def regularization_path(X, y, C_vals, fit_intercept = True, penalize_intercept = True, max_iter = 100,
+                        tol = 1e-6):
+    """
+    Computes the L1 regularization path of a logistic regression and the
+    feature importances it gives.
+
+    Parameters:
+        X (pandas dataframe or numpy array): dataframe/array of predictors
+        y (pandas dataframe, series or numpy array): binary response values
+        C_vals (array): inverse regularization strengths
+        fit_intercept (bool): whether to fit an intercept
+        penalize_intercept (bool): whether the intercept is penalized, as
+                                   liblinear does
+        max_iter (int): most Newton steps for each C
+        tol (float): largest change in a coefficient at convergence
+
+    Return:
+        dict with
+            coefs : pandas dataframe of coefficients, a row per feature and a
+                    column per C named as in the notebook, "C_<C to 3 places>"
+            intercepts : array of the intercept at each C
+            entry_C : pandas series of the smallest C at which each feature
+                      has a non zero coefficient, NaN if it never does
+            feature_importance_value : pandas series of the number of C
+                                       values at which each feature is zero
+            importance_order : features from the most to the least important,
+                               the most important being non zero at the most C
+    """
+    import pandas as pd
+
+    X_array, y_array = as_arrays(X, y)
+    feature_names = list(X.columns) if isinstance(X, pd.DataFrame) else list(range(X_array.shape[1]))
+
+    coefs, intercepts = l1_logistic_path(X_array, y_array, C_vals, fit_intercept = fit_intercept,
+                                         penalize_intercept = penalize_intercept, max_iter = max_iter, tol = tol)
+
+    C_df = pd.DataFrame(coefs.T, index = feature_names, columns = ["C_" + str(round(C, 3)) for C in C_vals])
+
+    nonzero = coefs != 0
+    sorted_C = np.sort(np.asarray(C_vals, dtype = float))
+    entry_C = pd.Series([sorted_C[np.flatnonzero(nonzero[np.argsort(C_vals), j])[0]]
+                         if nonzero[:, j].any() else np.nan for j in range(len(feature_names))],
+                        index = feature_names)
+
+    return {
+        "coefs" : C_df,
+        "intercepts" : intercepts,
+        "entry_C" : entry_C,
+        "feature_importance_value" : (C_df == 0).sum(axis = 1),
+        "importance_order" : (C_df != 0).sum(axis = 1).sort_values(ascending = False).index.tolist()
+    }
+
+def stability_paths(X, y, C_vals, seeds, fit_intercept = True, penalize_intercept = True, max_iter = 100,
+                    tol = 1e-6):
+    """
+    Computes which features are selected along the path for each of a chunk
+    of bootstrap resamples, the work of one parallel task.
+
+    Return:
+        boolean array of resamples x C values x features, True where the
+        coefficient is non zero
+    """
+
+    selected = np.empty((len(seeds), len(C_vals), X.shape[1]), dtype = bool)
+
+    for row, seed in enumerate(seeds):
+        coefs, _ = l1_logistic_path(X, y, C_vals, sample_weight = bootstrap_counts(X.shape[0], seed),
+                                    fit_intercept = fit_intercept, penalize_intercept = penalize_intercept,
+                                    max_iter = max_iter, tol = tol)
+        selected[row] = coefs != 0
+
+    return selected
+
+def stability_selection(X, y, C_vals, n_resamples = 100, n_jobs = -1, random_state = 0, fit_intercept = True,
+                        penalize_intercept = True, max_iter = 100, tol = 1e-6):
+    """
+    Repeats the regularization path on bootstrap resamples in parallel and
+    gives how often each feature is selected.  Resample i is the same sample
+    as replicate i of parallel_bootstrap for the same random_state.
+
+    Parameters:
+        X (pandas dataframe or numpy array): dataframe/array of predictors
+        y (pandas dataframe, series or numpy array): binary response values
+        C_vals (array): inverse regularization strengths
+        n_resamples (int): number of bootstrap resamples
+        n_jobs (int): number of threads/cores to use
+        random_state (int): root seed of the resamples
+        fit_intercept, penalize_intercept, max_iter, tol: see regularization_path
+
+    Return:
+        pandas dataframe of the fraction of resamples in which each feature
+        (row) is selected at each C (column, named as in regularization_path)
+    """
+    from joblib import Parallel, delayed
+    import pandas as pd
+
+    X_array, y_array = as_arrays(X, y)
+    feature_names = list(X.columns) if isinstance(X, pd.DataFrame) else list(range(X_array.shape[1]))
+
+    seeds = bootstrap_seeds(n_resamples, random_state)
+    chunk_size = bootstrap_chunk_size(n_resamples, n_jobs)
+
+    blocks = Parallel(n_jobs = n_jobs, backend = "loky", max_nbytes = 0, mmap_mode = "r")(
+        delayed(stability_paths)(X_array, y_array, C_vals, seeds[start:start + chunk_size], fit_intercept,
+                                 penalize_intercept, max_iter, tol)
+        for start in range(0, n_resamples, chunk_size))
+
+    selection = np.concatenate(blocks, axis = 0).mean(axis = 0)
+
+    return pd.DataFrame(selection.T, index = feature_names, columns = ["C_" + str(round(C, 3)) for C in C_vals])
@@ -0,0 +1,460 @@
+#
+# near_duplicates.py
+#
+# @author: Evan Yathon
+#
+# August 2019
+#
+# near_duplicates finds reviews that are almost the same, such as reposts,
+# reviews edited after they were published and reviews scraped again with a
+# different "✅ Trip Verified |" prefix, without comparing every pair.
+#
+# Each review is normalized as verify_reviews matches them (unicode, case,
+# whitespace and the verified prefixes), and split into overlapping shingles
+# of shingle_size bytes.  A MinHash signature of num_perm values estimates the
+# Jaccard similarity of two reviews' shingles as the fraction of values they
+# share.  The signatures of a batch of reviews are computed together with
+# numpy, one (num_perm x shingles) array of hashes reduced to its minimum
+# per review.  The hash functions are multiply-shift hashes of the 32 bit
+# hash of each shingle, which only need 64 bit multiplications that wrap
+# around and a shift, rather than a modulo.
+#
+# Signatures are split into bands of rows, and reviews whose values agree on
+# all the rows of any band are put in the same bucket.  The number of bands
+# is picked so that pairs above the threshold almost always share a bucket
+# and pairs well below it rarely do, so only the reviews in a bucket with a
+# query are compared, and finding every duplicate pair takes time roughly
+# linear in the number of reviews.
+#
+# Example usage:
+# index = NearDuplicateIndex(threshold = 0.8).build(review_documents(reviews), keys = reviews.index)
+# index.duplicate_pairs()
+# index.insert(review_documents(new_reviews), keys = new_reviews.index)
+# index.query_many(given["review_text"])
+# reviews[~index.duplicate_groups().duplicated()]
+
+import json
+
+import numpy as np
+import pandas as pd
+
+from verify_reviews import normalize_text
+
+# signature value of a review with no text, which the minimum of a
+# review's hashes all but never is
+EMPTY_VALUE = np.iinfo(np.uint32).max
+
+# most hashes computed at once while making signatures
+CHUNK_SIZE = 1 << 22
+
+class NearDuplicateIndex:
+
+    """
+    NearDuplicateIndex keeps the MinHash signatures of documents in LSH
+    buckets, to find the documents similar to a new one, or every similar pair.
+
+    Arguments:
+        threshold (float): Jaccard similarity above which documents are duplicates
+        num_perm (int): number of hash functions in each signature, more gives
+                        a better estimate of the similarity
+        shingle_size (int): bytes in each shingle, at most 7
+        bands (int): number of LSH bands, which must divide num_perm.  By
+                     default the one that best separates pairs around threshold.
+        random_state (int): seed of the hash functions, indexes only agree on
+                            signatures made with the same seed
+
+    Attributes:
+        keys (list): key of each document, in the order they were added
+        signatures (np.array): signature of each document, one row per key
+    """
+
+    def __init__(self, threshold = 0.8, num_perm = 128, shingle_size = 5, bands = None, random_state = 0):
+
+        if shingle_size > 7:
+            raise ValueError("shingle_size must be at most 7, the shingle hashes are kept in 64 bits")
+
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.bands = bands if bands is not None else lsh_bands(threshold, num_perm)
+        self.random_state = random_state
+
+        if num_perm % self.bands != 0:
+            raise ValueError("bands ({}) must divide num_perm ({})".format(self.bands, num_perm))
+        self.rows = num_perm // self.bands
+
+        rng = np.random.RandomState(random_state)
+        # odd multipliers and offsets of the multiply-shift hash functions
+        self.multipliers = rng.randint(1, 1 << 62, size = num_perm, dtype = np.int64).astype(np.uint64) * \
+            np.uint64(4) + np.uint64(1)
+        self.offsets = rng.randint(0, 1 << 62, size = num_perm, dtype = np.int64).astype(np.uint64) * np.uint64(4)
+        # odd multipliers that fold each band's rows into one bucket key
+        self.band_multipliers = rng.randint(1, 1 << 62, size = self.rows, dtype = np.int64).astype(np.uint64) | np.uint64(1)
+
+        self.clear()
+
+    def clear(self):
+        """
+        Removes every document.
+        """
+        self.keys = []
+        self.signatures = np.empty((0, self.num_perm), dtype = np.uint32)
+        self.buckets = [{} for _ in range(self.bands)]
+
+    def signatures_of(self, documents):
+        """
+        Computes the MinHash signatures of documents without adding them.
+
+        Arguments:
+            documents (iterable): texts, normalized here with normalize_text
+
+        Return:
+            array of signatures, one row per document
+        """
+        texts = [normalize_text(document).encode("utf-8") for document in documents]
+        signatures = np.full((len(texts), self.num_perm), EMPTY_VALUE, dtype = np.uint32)
+
+        # batches of documents whose shingles fit in a chunk of hashes
+        batch = []
+        batch_size = 0
+        for position, text in enumerate(texts):
+            if len(text) == 0:
+                continue
+            if len(batch) > 0 and (batch_size + len(text)) * self.num_perm > CHUNK_SIZE:
+                self.fill_signatures(signatures, batch, texts)
+                batch, batch_size = [], 0
+            batch.append(position)
+            batch_size += len(text)
+
+        if len(batch) > 0:
+            self.fill_signatures(signatures, batch, texts)
+
+        return signatures
+
+    def fill_signatures(self, signatures, batch, texts):
+        """
+        Fills in the signatures of a batch of documents, from one array of
+        every hash function applied to every shingle of the batch.
+        """
+        hashes, starts = self.shingle_hashes([texts[position] for position in batch])
+
+        # the top 32 bits of multiplier * hash + offset, modulo 2 ** 64
+        permuted = np.multiply.outer(self.multipliers, hashes)
+        permuted += self.offsets[:, np.newaxis]
+        permuted >>= np.uint64(32)
+
+        signatures[batch] = np.minimum.reduceat(permuted, starts, axis = 1).T
+
+    def shingle_hashes(self, texts):
+        """
+        Hashes every shingle of several texts at once, as a rolling polynomial
+        over the bytes of the texts joined together, leaving out the shingles
+        that straddle two texts.
+
+        Arguments:
+            texts (list): normalized texts encoded as utf-8, none empty
+
+        Return:
+            (hashes, starts) the 32 bit hash of every shingle, text by text,
+            and the position of each text's first shingle
+        """
+        size = self.shingle_size
+
+        # a text shorter than a shingle is one shingle
+        texts = [text.ljust(size, b"\0") for text in texts]
+        lengths = np.array([len(text) for text in texts])
+        data = np.frombuffer(b"".join(texts), dtype = np.uint8).astype(np.uint64)
+
+        n_windows = len(data) - size + 1
+        hashes = np.zeros(n_windows, dtype = np.uint64)
+        for offset in range(size):
+            hashes = hashes * np.uint64(257) + data[offset:offset + n_windows]
+
+        # the last size - 1 windows of each text run into the next one
+        ends = np.cumsum(lengths)
+        straddling = (ends[:, np.newaxis] - size + 1 + np.arange(size - 1)[np.newaxis, :]).ravel()
+        keep = np.ones(n_windows, dtype = bool)
+        keep[straddling[straddling < n_windows]] = False
+        hashes = hashes[keep]
+
+        # fold to 32 bits
+        hashes = (hashes ^ (hashes >> np.uint64(32))) & np.uint64(0xFFFFFFFF)
+        starts = np.concatenate([[0], np.cumsum(lengths - size + 1)[:-1]])
+
+        return hashes, starts
+
+    def band_keys(self, signatures):
+        """
+        Bucket keys of each band of signatures.
+
+        Return:
+            (documents x bands) array of keys
+        """
+        bands = signatures.reshape(len(signatures), self.bands, self.rows).astype(np.uint64)
+
+        # wraps around 64 bits, and documents whose keys collide are told
+        # apart by their estimated similarity
+        return (bands * self.band_multipliers).sum(axis = 2)
+
+    def build(self, documents, keys = None):
+        """
+        Replaces the index's documents.
+
+        Arguments:
+            documents (iterable): texts, see review_documents for reviews
+            keys (iterable): key of each document, such as a dataframe's
+                             index, by default its position
+
+        Return:
+            self
+        """
+        self.clear()
+        self.insert(documents, keys)
+
+        return self
+
+    def insert(self, documents, keys = None):
+        """
+        Adds documents, for example newly scraped reviews, to the index.
+
+        Arguments:
+            documents (iterable): texts
+            keys (iterable): key of each document, by default continuing the
+                             positions of those already in the index
+
+        Return:
+            self
+        """
+        documents = list(documents)
+        keys = list(keys) if keys is not None else list(range(len(self.keys), len(self.keys) + len(documents)))
+        if len(keys) != len(documents):
+            raise ValueError("got {} keys for {} documents".format(len(keys), len(documents)))
+
+        signatures = self.signatures_of(documents)
+        start = len(self.keys)
+
+        self.keys.extend(keys)
+        self.signatures = np.vstack([self.signatures, signatures])
+
+        band_keys = self.band_keys(signatures)
+        not_empty = signatures[:, 0] != EMPTY_VALUE
+        for band, buckets in enumerate(self.buckets):
+            for position, band_key in zip(np.flatnonzero(not_empty), band_keys[not_empty, band].tolist()):
+                buckets.setdefault(band_key, []).append(start + position)
+
+        return self
+
+    def candidates(self, signature):
+        """
+        Positions of the documents that share a bucket with a signature.
+        """
+        if signature[0] == EMPTY_VALUE:
+            return np.empty(0, dtype = int)
+
+        band_keys = self.band_keys(signature[np.newaxis, :])[0].tolist()
+        positions = set()
+        for buckets, band_key in zip(self.buckets, band_keys):
+            positions.update(buckets.get(band_key, ()))
+
+        return np.array(sorted(positions), dtype = int)
+
+    def query(self, document, threshold = None):
+        """
+        Finds the documents in the index similar to a document.
+
+        Arguments:
+            document (str): text to look for
+            threshold (float): smallest estimated Jaccard similarity, by
+                               default the index's threshold
+
+        Return:
+            pandas dataframe with the key and estimated jaccard of each
+            similar document, most similar first
+        """
+        matches = self.query_many([document], threshold = threshold)
+
+        return matches.drop(columns = "query").reset_index(drop = True)
+
+    def query_many(self, documents, threshold = None, keys = None):
+        """
+        Finds the documents in the index similar to each of several
+        documents, for example the given reviews against the scraped ones.
+
+        Arguments:
+            documents (iterable): texts to look for
+            threshold (float): smallest estimated Jaccard similarity
+            keys (iterable): key of each document looked for, by default its position
+
+        Return:
+            pandas dataframe with the query key, the key of the similar
+            document in the index and their estimated jaccard
+        """
+        threshold = self.threshold if threshold is None else threshold
+        documents = list(documents)
+        keys = list(keys) if keys is not None else list(range(len(documents)))
+
+        rows = []
+        for query_key, signature in zip(keys, self.signatures_of(documents)):
+            positions = self.candidates(signature)
+            if len(positions) == 0:
+                continue
+            jaccard = (self.signatures[positions] == signature).mean(axis = 1)
+            for position in np.argsort(-jaccard, kind = "stable"):
+                if jaccard[position] >= threshold:
+                    rows.append((query_key, self.keys[positions[position]], jaccard[position]))
+
+        return pd.DataFrame(rows, columns = ["query", "key", "jaccard"])
+
+    def candidate_pairs(self):
+        """
+        Pairs of positions of documents that share at least one bucket.
+
+        Return:
+            (pairs x 2) array of positions, the smaller first
+        """
+        n_keys = len(self.keys)
+        encoded = [np.empty(0, dtype = np.int64)]
+
+        for buckets in self.buckets:
+            for positions in buckets.values():
+                if len(positions) > 1:
+                    first, second = np.triu_indices(len(positions), k = 1)
+                    positions = np.asarray(positions, dtype = np.int64)
+                    # positions are added in order, so first is the smaller
+                    encoded.append(positions[first] * n_keys + positions[second])
+
+        # each pair once, however many bands it shares
+        encoded = np.unique(np.concatenate(encoded))
+
+        return np.column_stack([encoded // n_keys, encoded % n_keys]).astype(int)
+
+    def duplicate_pairs(self, threshold = None):
+        """
+        Every pair of documents in the index above a similarity threshold.
+
+        Arguments:
+            threshold (float): smallest estimated Jaccard similarity
+
+        Return:
+            pandas dataframe with key_a, key_b and jaccard, key_a added first
+        """
+        threshold = self.threshold if threshold is None else threshold
+        pairs = self.candidate_pairs()
+
+        jaccard = (self.signatures[pairs[:, 0]] == self.signatures[pairs[:, 1]]).mean(axis = 1)
+        pairs, jaccard = pairs[jaccard >= threshold], jaccard[jaccard >= threshold]
+
+        return pd.DataFrame({"key_a" : [self.keys[position] for position in pairs[:, 0]],
+                             "key_b" : [self.keys[position] for position in pairs[:, 1]],
+                             "jaccard" : jaccard})
+
+    def duplicate_groups(self, threshold = None):
+        """
+        Groups documents that are linked by a chain of duplicate pairs.
+
+        Arguments:
+            threshold (float): smallest estimated Jaccard similarity
+
+        Return:
+            pandas series indexed by key, holding the key of the first added
+            document of its group.  A document without duplicates is its own group.
+        """
+        threshold = self.threshold if threshold is None else threshold
+        pairs = self.candidate_pairs()
+        jaccard = (self.signatures[pairs[:, 0]] == self.signatures[pairs[:, 1]]).mean(axis = 1)
+
+        # union find, always keeping the earlier position as the root
+        parent = list(range(len(self.keys)))
+
+        def root(position):
+            while parent[position] != position:
+                parent[position] = parent[parent[position]]
+                position = parent[position]
+            return position
+
+        for first, second in pairs[jaccard >= threshold].tolist():
+            first_root, second_root = root(first), root(second)
+            if first_root != second_root:
+                parent[max(first_root, second_root)] = min(first_root, second_root)
+
+        return pd.Series([self.keys[root(position)] for position in range(len(self.keys))],
+                         index = self.keys, name = "group")
+
+    def save(self, save_path):
+        """
+        Saves the signatures and settings to a .npz file.  The keys are saved
+        as json, so they must be strings or numbers.
+        """
+        settings = {"threshold" : self.threshold, "num_perm" : self.num_perm,
+                    "shingle_size" : self.shingle_size, "bands" : self.bands,
+                    "random_state" : self.random_state}
+
+        np.savez(save_path, signatures = self.signatures,
+                 keys = np.array(json.dumps([key.item() if hasattr(key, "item") else key for key in self.keys])),
+                 settings = np.array(json.dumps(settings)))
+
+    @classmethod
+    def load(cls, load_path):
+        """
+        Loads an index saved by save, rebuilding its buckets.
+        """
+        with np.load(load_path) as saved:
+            index = cls(**json.loads(str(saved["settings"])))
+            signatures = saved["signatures"]
+            keys = json.loads(str(saved["keys"]))
+
+        index.keys = keys
+        index.signatures = signatures
+
+        band_keys = index.band_keys(signatures)
+        not_empty = signatures[:, 0] != EMPTY_VALUE
+        for band, buckets in enumerate(index.buckets):
+            for position, band_key in zip(np.flatnonzero(not_empty), band_keys[not_empty, band].tolist()):
+                buckets.setdefault(band_key, []).append(position)
+
+        return index
+
+def review_documents(reviews, columns = ("title", "review_text")):
+    """
+    review_documents joins the columns of each review that are compared.
+
+    Args:
+        reviews (pd.DataFrame) : reviews
+        columns (iterable) : text columns to join, missing values are left out
+
+    Return:
+        list of the joined text of each review
+    """
+    texts = reviews[list(columns)].astype(object).where(reviews[list(columns)].notna(), "")
+
+    return [" ".join(str(value) for value in row if value != "") for row in texts.itertuples(index = False)]
+
+def lsh_bands(threshold, num_perm):
+    """
+    lsh_bands picks the number of bands that best separates pairs of documents
+    either side of threshold.  With b bands of r rows, a pair of similarity s
+    shares a bucket with probability 1 - (1 - s^r)^b.  The chosen b gives the
+    least probability of pairing documents below threshold plus of missing
+    pairs above it.
+
+    Args:
+        threshold (float) : Jaccard similarity of duplicates
+        num_perm (int) : values in a signature
+
+    Return:
+        (int) number of bands, a divisor of num_perm
+    """
+    similarity = np.linspace(0, 1, 1001)
+    below, above = similarity < threshold, similarity >= threshold
+
+    best_bands, best_error = 1, np.inf
+    for bands in range(1, num_perm + 1):
+        if num_perm % bands != 0:
+            continue
+        rows = num_perm // bands
+        paired = 1 - (1 - similarity ** rows) ** bands
+        error = paired[below].mean() * threshold + (1 - paired[above]).mean() * (1 - threshold)
+        if error < best_error:
+            best_bands, best_error = bands, error
+
+    return best_bands
@@ -0,0 +1,185 @@
+#
+# page_cache.py
+#
+# @author: Evan Yathon
+#
+# August 2019
+#
+# page_cache keeps the raw html of every scraped page on disk so that a crawl
+# can be resumed or repeated without downloading pages again.  Pages are
+# stored by the hash of their content, with a small index entry per url that
+# remembers which content the url returned along with the ETag and
+# Last-Modified headers needed to ask the server whether it has changed.
+#
+# Layout of the cache directory:
+#   objects/<sha1 of page content>.html
+#   index/<sha1 of url>.json
+#
+# Example usage:
+# cache = PageCache("data/page_cache", max_age = 3600)
+# entry = cache.get(url)
+# if entry is None or not cache.is_fresh(entry):
+#     ... fetch the page, sending cache.conditional_headers(entry) ...
+#     cache.put(url, content, etag, last_modified)
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+class PageCache:
+
+    """
+    PageCache is a content addressed on disk store of fetched pages, indexed
+    by url.
+
+    Arguments:
+        cache_dir (str): directory to keep the cache in, created if needed
+        max_age (float): pages fetched less than max_age seconds ago are used
+                         without contacting the server.  None means always
+                         revalidate with the server.
+    """
+
+    def __init__(self, cache_dir, max_age = None):
+
+        self.cache_dir = cache_dir
+        self.max_age = max_age
+
+        os.makedirs(os.path.join(cache_dir, "objects"), exist_ok = True)
+        os.makedirs(os.path.join(cache_dir, "index"), exist_ok = True)
+
+    def index_path(self, url):
+        """
+        Path of the index entry for a url.
+        """
+        return os.path.join(self.cache_dir, "index", hashlib.sha1(url.encode("utf-8")).hexdigest() + ".json")
+
+    def object_path(self, digest):
+        """
+        Path of the page content with the given sha1 digest.
+        """
+        return os.path.join(self.cache_dir, "objects", digest + ".html")
+
+    def get(self, url):
+        """
+        Looks up the index entry for a url.
+
+        Arguments:
+            url (str): url of the page
+
+        Return:
+            dict with keys url, digest, etag, last_modified and fetched_at,
+            or None if the url isn't cached or its content is missing
+        """
+        try:
+            with open(self.index_path(url)) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if not os.path.exists(self.object_path(entry["digest"])):
+            return None
+
+        return entry
+
+    def read(self, entry):
+        """
+        Reads the cached content of an index entry.
+
+        Arguments:
+            entry (dict): entry returned by get
+
+        Return:
+            (bytes) the cached page
+        """
+        with open(self.object_path(entry["digest"]), "rb") as f:
+            return f.read()
+
+    def is_fresh(self, entry):
+        """
+        Whether an entry is young enough to be used without asking the server.
+        """
+        return self.max_age is not None and time.time() - entry["fetched_at"] < self.max_age
+
+    def conditional_headers(self, entry):
+        """
+        Builds the headers for a conditional request, so that the server can
+        answer 304 Not Modified instead of sending the page again.
+
+        Arguments:
+            entry (dict): entry returned by get, or None
+
+        Return:
+            dict of request headers
+        """
+        headers = {}
+
+        if entry is not None:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        return headers
+
+    def put(self, url, content, etag = None, last_modified = None):
+        """
+        Stores a fetched page.
+
+        Arguments:
+            url (str): url of the page
+            content (bytes): html of the page
+            etag (str): ETag header of the response, if any
+            last_modified (str): Last-Modified header of the response, if any
+
+        Return:
+            the new index entry
+        """
+        digest = hashlib.sha1(content).hexdigest()
+
+        if not os.path.exists(self.object_path(digest)):
+            atomic_write(self.object_path(digest), content)
+
+        entry = {
+            "url" : url,
+            "digest" : digest,
+            "etag" : etag,
+            "last_modified" : last_modified,
+            "fetched_at" : time.time()
+        }
+        atomic_write(self.index_path(url), json.dumps(entry).encode("utf-8"))
+
+        return entry
+
+    def touch(self, entry):
+        """
+        Marks an entry as fetched now, after the server confirmed that it
+        hasn't changed.
+
+        Arguments:
+            entry (dict): entry returned by get
+
+        Return:
+            the updated index entry
+        """
+        entry = dict(entry, fetched_at = time.time())
+        atomic_write(self.index_path(entry["url"]), json.dumps(entry).encode("utf-8"))
+
+        return entry
+
+def atomic_write(path, content):
+    """
+    atomic_write writes to a temporary file and renames it into place, so that
+    a crash part way through never leaves a truncated file in the cache.
+
+    Args:
+        path (str) : destination path
+        content (bytes) : content to write
+    """
+    tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+
+    with open(tmp_path, "wb") as f:
+        f.write(content)
+
+    os.replace(tmp_path, path)
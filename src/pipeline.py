@@ -0,0 +1,535 @@
+#
+# pipeline.py
+#
+# @author: Evan Yathon
+#
+# August 2019
+#
+# pipeline runs the analysis after scraping (verify and clean, text
+# preprocessing, the two topic models, regression and the report) as Python
+# stages rather than papermill notebooks in sequence.  Each stage is a
+# function with declared inputs, outputs and parameters, and its outputs are
+# cached under a hash of
+#
+# - the content of the source files, or the hashes of the upstream stages
+#   whose outputs it reads
+# - its parameters
+# - its code, the source of the stage function and of the modules it uses
+#
+# so a rerun skips every stage whose inputs, parameters and code haven't
+# changed, and an edit to the report only reruns the report.  Stages whose
+# inputs are ready run at the same time on --n_workers processes, such as the
+# review text and title topic models.
+#
+# Scraping isn't a stage, since its input is the live website: the pipeline
+# starts from a scraped reviews file, and only reruns when its content changes.
+# The versions of installed packages aren't part of the hash, so rerun the
+# affected stages with --force after upgrading spaCy, gensim or scikit-learn.
+#
+# Layout of the cache directory:
+#   <stage>/<hash>/ the outputs of a stage, and manifest.json, for each hash
+#
+# sample usage
+# python src/pipeline.py data/scraped_gw_reviews.csv data/given_4U_reviews.txt --cache_dir data/pipeline_cache
+# python src/pipeline.py data/scraped_gw_reviews.csv data/given_4U_reviews.txt --cache_dir data/pipeline_cache --n_workers 2 --export_dir data/pipeline
+#
+# --force reruns some stages whatever is cached, and --n_process,
+# --token_cache_dir and --n_jobs are passed to the stages that use them
+# without changing the hashes, as they don't change the outputs.
+#
+# --metrics_path records the time and peak memory of each stage, and of the
+# steps within it, to a JSON lines log, see instrumentation.py.  The workers
+# write to the same log.
+
+import argparse
+import hashlib
+import inspect
+import json
+import os
+import shutil
+import sys
+import time
+
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+import pandas as pd
+
+import instrumentation
+
+from review_store import list_columns, read_reviews, write_reviews
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def main(reviews_path, given_path, cache_dir, n_workers = 1, export_dir = None, force = (), options = None):
+
+    results = run_pipeline({"reviews" : reviews_path, "given" : given_path}, cache_dir, options = options,
+                           n_workers = n_workers, force = force, log = sys.stdout)
+
+    if export_dir is not None:
+        export_outputs(results, export_dir, ["topic_modeling", "regression", "report"])
+        sys.stdout.write("Exported the final outputs to {}\n".format(export_dir))
+        sys.stdout.flush()
+
+class Stage:
+
+    """
+    Stage is one step of the pipeline.
+
+    Arguments:
+        name (str): name of the stage, and of its directory in the cache
+        function (function): called with the path of each input and output,
+                             and the parameters and options, as keyword arguments
+        inputs (dict): argument name mapped to a source name, or to
+                       "<stage>.<output>" for an output of another stage
+        outputs (dict): argument name mapped to the file or directory name of
+                        the output within the stage's cache directory
+        params (dict): parameters, part of the hash
+        code (list): modules in src, or functions, whose source is part of the
+                     hash along with the stage function's
+        options (list): names of run options passed to the function that don't
+                        change its outputs, such as a number of processes, so
+                        aren't part of the hash
+    """
+
+    def __init__(self, name, function, inputs, outputs, params = None, code = (), options = ()):
+
+        self.name = name
+        self.function = function
+        self.inputs = inputs
+        self.outputs = outputs
+        self.params = params if params is not None else {}
+        self.code = list(code)
+        self.options = list(options)
+
+    def upstream(self):
+        """
+        Names of the stages whose outputs this stage reads.
+        """
+        return {ref.split(".")[0] for ref in self.inputs.values() if "." in ref}
+
+    def code_hash(self):
+        """
+        Hash of the source of the stage function and of its declared code.
+        """
+        digest = hashlib.sha1(inspect.getsource(self.function).encode("utf-8"))
+
+        for code in self.code:
+            if callable(code):
+                digest.update(inspect.getsource(code).encode("utf-8"))
+            else:
+                with open(os.path.join(SRC_DIR, code), "rb") as f:
+                    digest.update(f.read())
+
+        return digest.hexdigest()
+
+    def key(self, input_keys, params):
+        """
+        Hash of everything the stage's outputs depend on.
+
+        Arguments:
+            input_keys (dict): input argument name mapped to the hash of the
+                               source file, or of the upstream stage and output
+            params (dict): the stage's parameters
+
+        Return:
+            sha1 hex digest
+        """
+        description = {
+            "stage" : self.name,
+            "inputs" : input_keys,
+            "params" : params,
+            "code" : self.code_hash()
+        }
+
+        return hashlib.sha1(json.dumps(description, sort_keys = True, default = str).encode("utf-8")).hexdigest()
+
+def run_pipeline(sources, cache_dir, stages = None, params = None, options = None, n_workers = 1,
+                 force = (), log = None):
+    """
+    Runs the stages whose outputs aren't cached, each as soon as its inputs
+    are ready, on up to n_workers processes.
+
+    Arguments:
+        sources (dict): source name mapped to the path of the file, for
+                        example {"reviews" : ..., "given" : ...}
+        cache_dir (str): directory of the cached outputs, created if needed
+        stages (list): the stages, default those of pipeline_stages()
+        params (dict): stage name mapped to parameters that replace the
+                       stage's defaults
+        options (dict): run options, passed to the stages that declare them
+        n_workers (int): most stages to run at once
+        force (iterable): names of stages to rerun even if cached
+        log (file): where to write which stages ran or were cached, if given
+
+    Return:
+        dict of stage name mapped to a dict of output name and path
+    """
+
+    stages = pipeline_stages() if stages is None else stages
+    params = params if params is not None else {}
+    options = dict(DEFAULT_OPTIONS, **(options if options is not None else {}))
+    force = set(force)
+
+    source_keys = {name : file_hash(path) for name, path in sources.items()}
+
+    keys = {}
+    results = {}
+    running = {}
+    pending = list(stages)
+
+    executor = ProcessPoolExecutor(max_workers = n_workers) if n_workers > 1 else None
+
+    try:
+        while len(pending) > 0 or len(running) > 0:
+
+            # start every stage whose upstream stages are done
+            for stage in [stage for stage in pending if stage.upstream() <= set(results)]:
+                pending.remove(stage)
+
+                input_keys = {arg : source_keys[ref] if ref in source_keys else keys[ref.split(".")[0]] + "." + ref
+                              for arg, ref in stage.inputs.items()}
+                stage_params = dict(stage.params, **params.get(stage.name, {}))
+                keys[stage.name] = stage.key(input_keys, stage_params)
+                stage_dir = os.path.join(cache_dir, stage.name, keys[stage.name])
+                outputs = {arg : os.path.join(stage_dir, name) for arg, name in stage.outputs.items()}
+
+                if stage.name not in force and os.path.exists(os.path.join(stage_dir, "manifest.json")):
+                    results[stage.name] = outputs
+                    write_log(log, "{:<16} cached {}\n".format(stage.name, keys[stage.name][:12]))
+                    continue
+
+                inputs = {arg : sources[ref] if ref in sources else
+                          results[ref.split(".")[0]][ref.split(".", 1)[1]]
+                          for arg, ref in stage.inputs.items()}
+                stage_options = {name : options[name] for name in stage.options}
+                args = (stage, stage_dir, inputs, stage_params, stage_options)
+
+                write_log(log, "{:<16} running {}\n".format(stage.name, keys[stage.name][:12]))
+                if executor is None:
+                    results[stage.name] = run_stage(*args)
+                    write_log(log, "{:<16} done\n".format(stage.name))
+                else:
+                    running[executor.submit(run_stage, *args)] = stage
+
+            if len(running) > 0:
+                finished, _ = wait(running, return_when = FIRST_COMPLETED)
+                for future in finished:
+                    stage = running.pop(future)
+                    results[stage.name] = future.result()
+                    write_log(log, "{:<16} done\n".format(stage.name))
+
+            elif len(pending) > 0 and not any(stage.upstream() <= set(results) for stage in pending):
+                missing = {ref for stage in pending for ref in stage.upstream()} - set(results) - \
+                          {stage.name for stage in pending}
+                raise ValueError("stages {} read the outputs of unknown stages {}".format(
+                    [stage.name for stage in pending], sorted(missing)))
+
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    return results
+
+def run_stage(stage, stage_dir, inputs, params, options):
+    """
+    Runs a stage into a temporary directory, then renames it into place with
+    its manifest, so an interrupted stage is never taken as cached.
+
+    Return:
+        dict of output name and path
+    """
+    tmp_dir = "{}.{}.tmp".format(stage_dir, os.getpid())
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    start = time.time()
+    with instrumentation.stage("pipeline." + stage.name):
+        stage.function(**inputs, **{arg : os.path.join(tmp_dir, name) for arg, name in stage.outputs.items()},
+                       **params, **options)
+
+    with open(os.path.join(tmp_dir, "manifest.json"), "w") as f:
+        json.dump({"stage" : stage.name, "params" : params, "inputs" : inputs,
+                   "outputs" : stage.outputs, "seconds" : time.time() - start}, f, default = str)
+
+    # a forced rerun replaces the cached outputs
+    if os.path.exists(stage_dir):
+        shutil.rmtree(stage_dir)
+    os.replace(tmp_dir, stage_dir)
+
+    return {arg : os.path.join(stage_dir, name) for arg, name in stage.outputs.items()}
+
+def export_outputs(results, export_dir, stage_names):
+    """
+    Copies the outputs of some stages out of the cache.
+
+    Arguments:
+        results (dict): returned by run_pipeline
+        export_dir (str): directory to copy to, created if needed
+        stage_names (list): stages whose outputs are copied
+    """
+    os.makedirs(export_dir, exist_ok = True)
+
+    for name in stage_names:
+        for path in results[name].values():
+            destination = os.path.join(export_dir, os.path.basename(path))
+            if os.path.isdir(path):
+                if os.path.exists(destination):
+                    shutil.rmtree(destination)
+                shutil.copytree(path, destination)
+            else:
+                shutil.copyfile(path, destination)
+
+def file_hash(path, block_size = 1 << 20):
+    """
+    file_hash gives the sha1 hex digest of a file's content.
+    """
+    digest = hashlib.sha1()
+
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+def write_log(log, message):
+    if log is not None:
+        log.write(message)
+        log.flush()
+
+# the stages, in the order of the notebooks
+
+def clean_stage(reviews, given, cleaned, verification, encoding, near_duplicate_threshold):
+    """
+    Verifies the scraped reviews against the given reviews and cleans them,
+    as the verify and clean notebook does, dropping near duplicate reviews.
+    """
+    from near_duplicates import NearDuplicateIndex, review_documents
+    from verify_reviews import read_given_reviews, verify_reviews
+
+    scraped = read_reviews(reviews)
+    result = verify_reviews(scraped, read_given_reviews(given, encoding = encoding))
+    counts = {name : len(result[name]) for name in ["matched", "missing", "new"]}
+
+    # incremental scrapes append the newest reviews to the end of the file, so
+    # sort them newest first for the newest of each group to be its first
+    scraped = scraped.sort_values("date_of_review", ascending = False, kind = "mergesort").reset_index(drop = True)
+    index = NearDuplicateIndex(threshold = near_duplicate_threshold).build(review_documents(scraped))
+
+    # given reviews that differ from a scraped review by more than whitespace
+    counts["near_matched"] = index.query_many(result["missing"]["review_text"])["query"].nunique()
+
+    # the first, so the newest, review of each group is kept
+    duplicated = index.duplicate_groups().duplicated().values
+    counts["near_duplicates"] = int(duplicated.sum())
+
+    with open(verification, "w") as f:
+        json.dump(counts, f)
+
+    write_reviews(clean_reviews(scraped[~duplicated]), cleaned)
+
+def clean_reviews(reviews):
+    """
+    Keeps only the country of the reviewer_country column, which is scraped
+    with its brackets, for example "(Germany)".
+    """
+    # pattern matches any characters between brackets
+    countries = reviews["reviewer_country"].astype(str).str.findall(r"\((.*)\)").str[0]
+
+    return reviews.assign(reviewer_country = countries)
+
+def preprocess_stage(cleaned, tokens, model, min_token_len, n_process, token_cache_dir):
+    """
+    Preprocesses the review text and titles with spaCy, as the topic
+    modeling notebook does.
+    """
+    from text_preprocessing import load_model, preprocess_texts
+
+    reviews = read_reviews(cleaned, columns = ["review_text", "title"])
+    nlp = load_model(model)
+
+    pd.DataFrame({
+        "clean_review_text" : preprocess_texts(reviews["review_text"], nlp, min_token_len = min_token_len,
+                                               n_process = n_process, cache_dir = token_cache_dir),
+        "clean_title" : preprocess_texts(reviews["title"], nlp, min_token_len = min_token_len,
+                                         n_process = n_process, cache_dir = token_cache_dir)
+    }).to_parquet(tokens, index = False)
+
+def topics_stage(tokens, topics, model_dir, column, topic_names, alpha, eta, passes, random_state):
+    """
+    Fits a topic model to a column of preprocessed text and saves the topic
+    probabilities of every review.  The model is saved with the outputs.
+    """
+    from topic_model import TopicModel
+
+    docs = pd.read_parquet(tokens, columns = [column])[column].fillna("")
+
+    topic_model = TopicModel(model_dir, topic_names, alpha = alpha, eta = eta, passes = passes,
+                             random_state = random_state)
+    topic_model.fit(docs, retrain = True).to_parquet(topics, index = False)
+
+def merge_stage(cleaned, tokens, review_topics, title_topics, reviews):
+    """
+    Adds the preprocessed text and topic probabilities to the cleaned reviews,
+    the dataset the topic modeling notebook saves for the regression.
+    """
+    merged = pd.concat([read_reviews(cleaned).reset_index(drop = True), pd.read_parquet(tokens),
+                        pd.read_parquet(review_topics), pd.read_parquet(title_topics)], axis = 1)
+
+    write_reviews(merged, reviews)
+
+def regression_stage(reviews, results, coefs, cutoff_date, drop_cols, dummy_vars, response, C_vals,
+                     logit_params, tol, max_bootstraps, random_state, n_jobs):
+    """
+    Fits the regression analysis notebook's models: the L1 regularization
+    path for the feature importances, the unpenalized logistic regression for
+    the coefficients, and their bootstrap confidence intervals.
+    """
+    from sklearn.linear_model import LogisticRegression
+
+    from bootstrap_ci import streaming_bootstrap
+    from l1_path import regularization_path
+    from PrepareForModel import PrepareForModel
+
+    # the review text and titles are summarized by the topic columns
+    text_cols = ["title", "review_text", "clean_review_text", "clean_title"]
+    data = read_reviews(reviews, columns = [col for col in list_columns(reviews) if col not in text_cols])
+
+    data = data[data["date_of_review"] < cutoff_date]
+    data = data.drop([col for col in drop_cols if col in data.columns], axis = 1).dropna()
+
+    encoded = PrepareForModel(data).make_dummy_df(dummy_vars, add_intercept = False)
+    X = encoded.drop([response], axis = 1)
+    y = encoded[[response]]
+
+    reg_path = regularization_path(X, y, C_vals)
+    logit = LogisticRegression(**logit_params).fit(X, y.values.ravel())
+    boot_ci = streaming_bootstrap(LogisticRegression, logit_params, X, y, tol = tol,
+                                  max_bootstraps = max_bootstraps, random_state = random_state, n_jobs = n_jobs)
+
+    pd.DataFrame({
+        "variable_name" : X.columns,
+        "coefficient_estimate" : logit.coef_.flatten(),
+        "feature_importance_value" : reg_path["feature_importance_value"].values,
+        "quantile2.5" : boot_ci.quantile(0.025),
+        "quantile97.5" : boot_ci.quantile(0.975),
+        "n_bootstraps" : boot_ci.n_bootstraps
+    }).to_csv(results, index = False)
+
+    reg_path["coefs"].to_csv(coefs)
+
+def report_stage(verification, results, report):
+    """
+    Writes the verification counts and the regression results as markdown.
+    """
+    with open(verification) as f:
+        counts = json.load(f)
+
+    table = pd.read_csv(results).sort_values(by = "feature_importance_value")
+    columns = ["variable_name", "coefficient_estimate", "quantile2.5", "quantile97.5", "feature_importance_value"]
+
+    lines = ["# Regression Results", "",
+             "{matched} given reviews were found in the scraped reviews, {missing} were missing and "
+             "{new} scraped reviews are newer.".format(**counts), "",
+             "{} near duplicate reviews were dropped.".format(counts.get("near_duplicates", 0)), "",
+             "The features are ordered from the most to the least important.  The 95% confidence "
+             "intervals come from {} bootstrap replicates.".format(table["n_bootstraps"].iloc[0]), "",
+             "| " + " | ".join(columns) + " |",
+             "|" + "---|" * len(columns)]
+    for _, row in table.iterrows():
+        lines.append("| {} | {:.3f} | {:.3f} | {:.3f} | {} |".format(*[row[col] for col in columns]))
+
+    with open(report, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+# run options that don't change any outputs, so they are left out of the
+# stage hashes.  streaming_bootstrap fits the same replicates in the same
+# rounds for any n_jobs, and a change to that would change bootstrap_ci.py,
+# which is part of the regression stage's hash.
+DEFAULT_OPTIONS = {"n_process" : 1, "token_cache_dir" : None, "n_jobs" : -1}
+
+def pipeline_stages():
+    """
+    The stages of the analysis, with the parameters of the notebooks.
+
+    Return:
+        list of Stage
+    """
+    topic_code = ["topic_model.py", "review_store.py"]
+
+    return [
+        Stage("clean", clean_stage,
+              inputs = {"reviews" : "reviews", "given" : "given"},
+              outputs = {"cleaned" : "cleaned_gw_reviews.parquet", "verification" : "verification.json"},
+              params = {"encoding" : "cp1252", "near_duplicate_threshold" : 0.8},
+              code = ["verify_reviews.py", "review_store.py", "near_duplicates.py", clean_reviews]),
+        Stage("preprocess", preprocess_stage,
+              inputs = {"cleaned" : "clean.cleaned"},
+              outputs = {"tokens" : "tokens.parquet"},
+              params = {"model" : "en", "min_token_len" : 3},
+              code = ["text_preprocessing.py", "review_store.py"],
+              options = ["n_process", "token_cache_dir"]),
+        Stage("review_topics", topics_stage,
+              inputs = {"tokens" : "preprocess.tokens"},
+              outputs = {"topics" : "review_topics.parquet", "model_dir" : "review_model"},
+              params = {"column" : "clean_review_text",
+                        "topic_names" : ["review_luggage_seats", "review_time_delays", "review_food_bev_crew"],
+                        "alpha" : 0.5, "eta" : 0.01, "passes" : 5, "random_state" : 40},
+              code = topic_code),
+        Stage("title_topics", topics_stage,
+              inputs = {"tokens" : "preprocess.tokens"},
+              outputs = {"topics" : "title_topics.parquet", "model_dir" : "title_model"},
+              params = {"column" : "clean_title",
+                        "topic_names" : ["title_money_value", "title_staff_delays"],
+                        "alpha" : 0.9, "eta" : 0.1, "passes" : 5, "random_state" : 40},
+              code = topic_code),
+        Stage("topic_modeling", merge_stage,
+              inputs = {"cleaned" : "clean.cleaned", "tokens" : "preprocess.tokens",
+                        "review_topics" : "review_topics.topics", "title_topics" : "title_topics.topics"},
+              outputs = {"reviews" : "topic_modeling_gw_reviews.parquet"},
+              code = ["review_store.py"]),
+        Stage("regression", regression_stage,
+              inputs = {"reviews" : "topic_modeling.reviews"},
+              outputs = {"results" : "regression_results.csv", "coefs" : "l1_path_coefs.csv"},
+              params = {"cutoff_date" : "2016-02-08",
+                        "drop_cols" : ["n_user_reviews", "reviewer_name", "reviewer_country", "date_of_review",
+                                       "aircraft", "traveller_type", "route", "date_flown",
+                                       "ground_service_rating", "inflight_entertainment_rating",
+                                       "seat_comfort_rating", "cabin_staff_service_rating",
+                                       "food_and_beverages_rating"],
+                        "dummy_vars" : {"seat_type" : "Economy Class", "recommendation" : "no"},
+                        "response" : "recommendation_yes",
+                        "C_vals" : (6 ** np.linspace(-2, 8, 11)).tolist(),
+                        "logit_params" : {"penalty" : "none", "C" : 1.0, "fit_intercept" : True,
+                                          "random_state" : 42, "solver" : "newton-cg", "max_iter" : 100},
+                        "tol" : 0.1, "max_bootstraps" : 5000, "random_state" : 42},
+              code = ["review_store.py", "PrepareForModel.py", "l1_path.py", "bootstrap_ci.py",
+                      "bootstrap_skmodel.py"],
+              options = ["n_jobs"]),
+        Stage("report", report_stage,
+              inputs = {"verification" : "clean.verification", "results" : "regression.results"},
+              outputs = {"report" : "regression_results.md"})
+    ]
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("reviews_path")
+    parser.add_argument("given_path")
+    parser.add_argument("--cache_dir", default = "data/pipeline_cache")
+    parser.add_argument("--n_workers", type = int, default = 1)
+    parser.add_argument("--export_dir", default = None)
+    parser.add_argument("--force", nargs = "*", default = [])
+    parser.add_argument("--n_process", type = int, default = 1)
+    parser.add_argument("--token_cache_dir", default = None)
+    parser.add_argument("--n_jobs", type = int, default = -1)
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+
+    instrumentation.configure_from_args(args)
+
+    main(args.reviews_path, args.given_path, args.cache_dir, n_workers = args.n_workers,
+         export_dir = args.export_dir, force = args.force,
+         options = {"n_process" : args.n_process, "token_cache_dir" : args.token_cache_dir,
+                    "n_jobs" : args.n_jobs})
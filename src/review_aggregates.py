@@ -0,0 +1,549 @@
+#
+# review_aggregates.py
+#
+# @author: Evan Yathon
+#
+# August 2019
+#
+# review_aggregates keeps the counts behind the over time views of the EDA
+# notebook (recommendations and review values over time, the category ratings
+# and the reviewer country breakdowns) so they don't have to be recomputed
+# from every review on each run.  Reviews are bucketed by
+#
+#   airline, month of review, seat_type, traveller_type, reviewer_country, recommendation
+#
+# and each bucket keeps its number of reviews and, for every rating column, how
+# many reviews gave each value.  Counts, means and distributions of any time
+# window and slice are sums over the buckets, which are far fewer than the
+# reviews, so a query is a few numpy bincounts over the buckets and takes
+# milliseconds however long the review history is.
+#
+# New reviews are added with `update`, whose work grows with the number of new
+# reviews rather than the size of the store: each value of a dimension gets a
+# code that never changes, a bucket is found by its codes in a dict and new
+# buckets are appended.  The store keeps a 64 bit hash of each review's
+# airline, date, reviewer, title and text, so reviews that were already
+# counted are skipped and feeding it a whole file again changes nothing.  The
+# text is hashed as well as the scraper's key because distinct reviews can
+# share a date and a generic title such as "Germanwings customer review".  A
+# review that is edited after it was counted is counted again.
+#
+# Missing values, and reviews without a date, are kept in an "unknown" bucket.
+# Reviewer countries are read either cleaned ("Germany") or as scraped, from
+# the brackets of the reviewer line.
+#
+# Layout of the store directory:
+#   aggregates.npz, the codes and counts of the buckets and the review hashes
+#   state.json, the values of each dimension, written last so that an
+#               interrupted save is rebuilt rather than loaded
+#
+# Example usage:
+# aggregates = ReviewAggregates("data/aggregates")
+# if not aggregates.load():
+#     aggregates.update_from_file("data/all_reviews.parquet")
+# aggregates.update(new_reviews, airline = "germanwings")
+# aggregates.save()
+# aggregates.summary(by = ["month"], start = "2012-01", end = "2015-12", airline = "germanwings")
+# aggregates.distribution("seat_comfort_rating", by = ["recommendation"], seat_type = "Economy Class")
+
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from instrumentation import stage
+from page_cache import atomic_write
+from review_store import RATING_COLUMNS, iter_reviews, list_columns, to_typed
+
+# dimensions that the reviews are bucketed by
+DIMENSIONS = ["airline", "month", "seat_type", "traveller_type", "reviewer_country", "recommendation"]
+
+# columns read from a saved dataset to aggregate it
+AGGREGATE_COLUMNS = ["airline", "date_of_review", "reviewer_name", "title", "review_text", "seat_type",
+                     "traveller_type", "reviewer_country", "recommendation"] + RATING_COLUMNS
+
+MISSING = "unknown"
+
+STATE_VERSION = 1
+
+ARRAYS = ["cell_codes", "cell_reviews", "rating_cells", "rating_fields", "rating_values", "rating_counts",
+          "review_keys"]
+
+class ReviewAggregates:
+
+    """
+    ReviewAggregates keeps review and rating counts per month and slice,
+    updated as new reviews arrive.
+
+    Arguments:
+        aggregate_dir (str): directory to keep the store in, created if
+                             needed.  None keeps the store in memory only.
+
+    Attributes:
+        categories (dict): values of each dimension, in the order of their codes
+        cell_codes (np.array): buckets x dimensions array of value codes
+        cell_reviews (np.array): number of reviews in each bucket
+        rating_cells (np.array): bucket of each rating count
+        rating_fields (np.array): index in RATING_COLUMNS of each rating count
+        rating_values (np.array): rating value of each rating count
+        rating_counts (np.array): number of reviews of the bucket that gave
+                                  the value for the rating
+        review_keys (np.array): sorted uint64 hashes of the reviews counted
+    """
+
+    def __init__(self, aggregate_dir = None):
+
+        self.aggregate_dir = aggregate_dir
+
+        self.categories = {dimension : [] for dimension in DIMENSIONS}
+        self.cell_codes = np.zeros((0, len(DIMENSIONS)), dtype = np.int32)
+        self.cell_reviews = np.zeros(0, dtype = np.int64)
+        self.rating_cells = np.zeros(0, dtype = np.int64)
+        self.rating_fields = np.zeros(0, dtype = np.int8)
+        self.rating_values = np.zeros(0, dtype = np.int16)
+        self.rating_counts = np.zeros(0, dtype = np.int64)
+        self.review_keys = np.zeros(0, dtype = np.uint64)
+        self.index()
+
+        if aggregate_dir is not None:
+            os.makedirs(aggregate_dir, exist_ok = True)
+
+    @property
+    def n_reviews(self):
+        """
+        Number of reviews counted.
+        """
+        return len(self.review_keys)
+
+    def index(self):
+        """
+        Builds the lookups from values to codes, and from codes to buckets and
+        rating counts.
+        """
+        self.codes = {dimension : {value : code for code, value in enumerate(values)}
+                      for dimension, values in self.categories.items()}
+        self.cell_rows = {key : row for row, key in enumerate(map(tuple, self.cell_codes.tolist()))}
+        self.rating_rows = {key : row for row, key in enumerate(zip(self.rating_cells.tolist(),
+                                                                     self.rating_fields.tolist(),
+                                                                     self.rating_values.tolist()))}
+
+    def path(self, name):
+        """
+        Path of one of the store's files.
+        """
+        return os.path.join(self.aggregate_dir, name)
+
+    def load(self):
+        """
+        Loads the saved store, if there is a complete one.
+
+        Return:
+            True if the store was loaded, False otherwise
+        """
+        try:
+            with open(self.path("state.json")) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return False
+
+        if state.get("version") != STATE_VERSION or state.get("fields") != RATING_COLUMNS:
+            return False
+
+        with np.load(self.path("aggregates.npz")) as arrays:
+            for name in ARRAYS:
+                setattr(self, name, arrays[name])
+
+        self.categories = state["categories"]
+        self.index()
+
+        return True
+
+    def save(self):
+        """
+        Saves the store.  The state is written last, so an interrupted save is
+        rebuilt rather than loaded.
+        """
+        if os.path.exists(self.path("state.json")):
+            os.remove(self.path("state.json"))
+
+        with open(self.path("aggregates.npz"), "wb") as f:
+            np.savez(f, **{name : getattr(self, name) for name in ARRAYS})
+
+        state = {"version" : STATE_VERSION, "fields" : RATING_COLUMNS, "categories" : self.categories,
+                 "n_reviews" : self.n_reviews, "n_cells" : len(self.cell_reviews)}
+        atomic_write(self.path("state.json"), json.dumps(state).encode("utf-8"))
+
+    def update(self, reviews, airline = None):
+        """
+        Adds the reviews that haven't been counted yet to the store.
+
+        Arguments:
+            reviews (pd.DataFrame): reviews as scraped, cleaned or read with
+                                    read_reviews
+            airline (str): airline of the reviews, used when there is no
+                           airline column
+
+        Return:
+            number of reviews added
+        """
+        with stage("ReviewAggregates.update") as update_stage:
+
+            typed = to_typed(reviews.reset_index(drop = True))
+            airlines = airline_column(typed, airline)
+
+            keys = review_hashes(typed, airlines)
+
+            # the first of any repeated review, that hasn't been counted before
+            _, first = np.unique(keys, return_index = True)
+            new = np.zeros(len(keys), dtype = bool)
+            new[first] = True
+            new &= ~sorted_contains(self.review_keys, keys)
+
+            if not new.any():
+                return 0
+
+            typed = typed[new].reset_index(drop = True)
+            dimensions = dimension_frame(typed, airlines[new].reset_index(drop = True))
+
+            codes = np.column_stack([self.encode(dimension, dimensions[dimension].values)
+                                     for dimension in DIMENSIONS])
+            cells = self.add_cells(codes)
+
+            for field, column in enumerate(RATING_COLUMNS):
+                if column not in typed.columns:
+                    continue
+                rated = typed[column].notna().values
+                values = typed[column].values[rated].astype(np.int64)
+                self.add_ratings(cells[rated], field, values)
+
+            self.review_keys = np.union1d(self.review_keys, keys[new])
+
+            update_stage.add("items", int(new.sum()))
+
+            return int(new.sum())
+
+    def encode(self, dimension, values):
+        """
+        The codes of the values of a dimension, giving new values the next
+        codes.  Codes never change, so the buckets already counted keep theirs.
+        """
+        inverse, uniques = pd.factorize(values)
+        codes = self.codes[dimension]
+
+        for value in uniques:
+            if value not in codes:
+                codes[value] = len(self.categories[dimension])
+                self.categories[dimension].append(value)
+
+        return np.array([codes[value] for value in uniques], dtype = np.int32)[inverse]
+
+    def add_cells(self, codes):
+        """
+        Counts a review in the bucket of each row of dimension codes,
+        appending the buckets not seen before.
+
+        Return:
+            numpy array of the bucket of each row
+        """
+        distinct, inverse, counts = np.unique(codes, axis = 0, return_inverse = True, return_counts = True)
+        rows = self.find_rows(self.cell_rows, map(tuple, distinct.tolist()), len(self.cell_reviews))
+
+        added = rows >= len(self.cell_reviews)
+        self.cell_codes = np.concatenate([self.cell_codes, distinct[added].astype(np.int32)])
+        self.cell_reviews = np.concatenate([self.cell_reviews, np.zeros(int(added.sum()), dtype = np.int64)])
+        self.cell_reviews[rows] += counts
+
+        return rows[inverse.ravel()]
+
+    def add_ratings(self, cells, field, values):
+        """
+        Counts the values given for a rating in each bucket, appending the
+        (bucket, rating, value) counts not seen before.
+        """
+        pairs, counts = np.unique(np.column_stack([cells, values]), axis = 0, return_counts = True)
+        keys = ((cell, field, value) for cell, value in pairs.tolist())
+        rows = self.find_rows(self.rating_rows, keys, len(self.rating_counts))
+
+        added = rows >= len(self.rating_counts)
+        self.rating_cells = np.concatenate([self.rating_cells, pairs[added, 0]])
+        self.rating_fields = np.concatenate([self.rating_fields, np.full(int(added.sum()), field, dtype = np.int8)])
+        self.rating_values = np.concatenate([self.rating_values, pairs[added, 1].astype(np.int16)])
+        self.rating_counts = np.concatenate([self.rating_counts, np.zeros(int(added.sum()), dtype = np.int64)])
+        self.rating_counts[rows] += counts
+
+    @staticmethod
+    def find_rows(rows, keys, n_rows):
+        """
+        The row of each of the distinct keys, giving new keys the rows after
+        n_rows in order.
+        """
+        found = []
+        for key in keys:
+            row = rows.get(key)
+            if row is None:
+                row = rows[key] = n_rows
+                n_rows += 1
+            found.append(row)
+
+        return np.array(found, dtype = np.int64)
+
+    def update_from_file(self, load_path, airline = None, chunksize = 100000):
+        """
+        Adds the reviews of a saved dataset, reading only the columns that are
+        aggregated, a chunk at a time.
+
+        Arguments:
+            load_path (str): path of a .parquet, .arrow/.feather or .csv file
+            airline (str): airline of the reviews, used when there is no
+                           airline column
+            chunksize (int): rows per chunk of a csv file
+
+        Return:
+            number of reviews added
+        """
+        columns = [column for column in AGGREGATE_COLUMNS if column in list_columns(load_path)]
+
+        return sum(self.update(chunk, airline = airline)
+                   for chunk in iter_reviews(load_path, columns = columns, chunksize = chunksize))
+
+    def select(self, start, end, filters):
+        """
+        Which buckets are in a window of months and a slice.
+
+        Return:
+            boolean numpy array
+        """
+        mask = np.ones(len(self.cell_reviews), dtype = bool)
+
+        if start is not None or end is not None:
+            start, end = month_of(start), month_of(end)
+            months = [code for code, month in enumerate(self.categories["month"])
+                      if month != MISSING and (start is None or month >= start) and (end is None or month <= end)]
+            mask &= np.isin(self.cell_codes[:, DIMENSIONS.index("month")], months)
+
+        for dimension, values in filters.items():
+            if dimension not in DIMENSIONS:
+                raise ValueError("{} isn't one of the dimensions {}".format(dimension, DIMENSIONS))
+            if isinstance(values, str) or not hasattr(values, "__iter__"):
+                values = [values]
+            codes = [self.codes[dimension][value] for value in values if value in self.codes[dimension]]
+            mask &= np.isin(self.cell_codes[:, DIMENSIONS.index(dimension)], codes)
+
+        return mask
+
+    def group_codes(self, by):
+        """
+        A single code for the combination of the by dimensions of each bucket.
+        """
+        if len(by) == 0:
+            return np.zeros(len(self.cell_reviews), dtype = np.int64)
+
+        codes = [self.cell_codes[:, DIMENSIONS.index(dimension)].astype(np.int64) for dimension in by]
+        sizes = [max(1, len(self.categories[dimension])) for dimension in by]
+
+        return np.ravel_multi_index(codes, sizes)
+
+    def group_index(self, groups, by):
+        """
+        The index of a result, from the distinct codes of its groups.
+        """
+        if len(by) == 0:
+            return pd.Index(["all"] * len(groups), name = "all")
+
+        sizes = [max(1, len(self.categories[dimension])) for dimension in by]
+        levels = np.unravel_index(groups, sizes)
+        labels = [np.array(self.categories[dimension], dtype = object)[level] for dimension, level in zip(by, levels)]
+
+        if len(by) == 1:
+            return pd.Index(labels[0], name = by[0])
+
+        return pd.MultiIndex.from_arrays(labels, names = by)
+
+    def summary(self, by = ("month",), start = None, end = None, **filters):
+        """
+        Counts the reviews and recommendations, and averages each rating,
+        of a window of months and a slice.
+
+        Arguments:
+            by (list): dimensions to group by, empty for a single row
+            start (str): first month, "YYYY-MM" or any date in it, None for
+                         no limit.  Reviews without a date are only included
+                         when neither start nor end is given.
+            end (str): last month, included
+            filters: dimension mapped to a value or a list of values to keep,
+                     for example airline = "germanwings"
+
+        Return:
+            pandas dataframe with a row per group, sorted, and the columns
+            reviews, recommended, recommendation_rate and, for each rating
+            column, <rating>_count and <rating>_mean
+        """
+        by = list(by)
+
+        mask = self.select(start, end, filters)
+        cell_groups = self.group_codes(by)
+        groups, inverse = np.unique(cell_groups[mask], return_inverse = True)
+        n_groups = len(groups)
+
+        reviews = self.cell_reviews[mask].astype(np.float64)
+        is_yes = self.cell_codes[mask, DIMENSIONS.index("recommendation")] == self.codes["recommendation"].get("yes")
+
+        counts = np.bincount(inverse, weights = reviews, minlength = n_groups).astype(np.int64)
+        recommended = np.bincount(inverse, weights = reviews * is_yes, minlength = n_groups).astype(np.int64)
+
+        columns = {"reviews" : counts, "recommended" : recommended}
+        with np.errstate(invalid = "ignore", divide = "ignore"):
+            columns["recommendation_rate"] = recommended / counts
+
+        # each rating count is in the group of its bucket
+        rated = mask[self.rating_cells]
+        rating_groups = np.searchsorted(groups, cell_groups[self.rating_cells[rated]])
+        fields = self.rating_fields[rated]
+        rating_counts = self.rating_counts[rated].astype(np.float64)
+        rating_totals = rating_counts * self.rating_values[rated]
+
+        for field, column in enumerate(RATING_COLUMNS):
+            rows = fields == field
+            field_counts = np.bincount(rating_groups[rows], weights = rating_counts[rows], minlength = n_groups)
+            field_totals = np.bincount(rating_groups[rows], weights = rating_totals[rows], minlength = n_groups)
+            columns[column + "_count"] = field_counts.astype(np.int64)
+            with np.errstate(invalid = "ignore", divide = "ignore"):
+                columns[column + "_mean"] = np.where(field_counts > 0, field_totals / field_counts, np.nan)
+
+        return pd.DataFrame(columns, index = self.group_index(groups, by)).sort_index()
+
+    def distribution(self, field, by = ("recommendation",), start = None, end = None, **filters):
+        """
+        Counts the reviews that gave each value of a rating, in a window of
+        months and a slice.
+
+        Arguments:
+            field (str): rating column, for example "seat_comfort_rating"
+            by (list): dimensions to group by, empty for a single row
+            start, end, filters: as for summary
+
+        Return:
+            pandas dataframe of counts with a row per group, sorted, and a
+            column per rating value
+        """
+        by = list(by)
+
+        rated = self.select(start, end, filters)[self.rating_cells]
+        rated &= self.rating_fields == RATING_COLUMNS.index(field)
+
+        groups, inverse = np.unique(self.group_codes(by)[self.rating_cells[rated]], return_inverse = True)
+        values = self.rating_values[rated]
+        rating_values = np.unique(values)
+        columns = np.searchsorted(rating_values, values)
+
+        counts = np.bincount(inverse * len(rating_values) + columns,
+                             weights = self.rating_counts[rated].astype(np.float64),
+                             minlength = len(groups) * len(rating_values))
+
+        return pd.DataFrame(counts.reshape(len(groups), len(rating_values)).astype(np.int64),
+                            index = self.group_index(groups, by),
+                            columns = pd.Index(rating_values, name = "value")).sort_index()
+
+def update_store(aggregate_dir, reviews, airline = None, saved_path = None):
+    """
+    update_store adds new reviews to the store in a directory and saves it.
+    When there is no complete store there yet, it is built from every review
+    in saved_path instead, if given, which should include the new reviews.
+
+    Args:
+        aggregate_dir (str) : directory of the store
+        reviews (pd.DataFrame) : the new reviews
+        airline (str) : airline of the reviews, used when there is no airline column
+        saved_path (str) : path of all of the reviews saved so far
+
+    Return:
+        the updated ReviewAggregates
+    """
+    aggregates = ReviewAggregates(aggregate_dir)
+
+    if aggregates.load() or saved_path is None:
+        aggregates.update(reviews, airline = airline)
+    else:
+        aggregates.update_from_file(saved_path, airline = airline)
+
+    aggregates.save()
+
+    return aggregates
+
+def airline_column(typed, airline):
+    """
+    The airline of each review, as strings.
+    """
+    if "airline" in typed.columns:
+        airlines = typed["airline"].astype("object").where(typed["airline"].notna(), airline)
+    else:
+        airlines = pd.Series(airline, index = typed.index, dtype = "object")
+
+    return airlines.fillna(MISSING).astype(str)
+
+def review_hashes(typed, airlines):
+    """
+    review_hashes gives a 64 bit hash of each review's airline, date of review,
+    reviewer name, title and text.
+
+    Return:
+        numpy array of uint64
+    """
+    def text(column):
+        if column not in typed.columns:
+            return pd.Series("", index = typed.index)
+        return typed[column].astype("object").fillna("").astype(str)
+
+    dates = typed["date_of_review"].dt.strftime("%Y-%m-%d").astype("object").fillna("")
+    keys = (airlines + "\x1f" + dates + "\x1f" + text("reviewer_name") + "\x1f" + text("title") + "\x1f" +
+            text("review_text"))
+
+    return np.array([int.from_bytes(hashlib.sha1(key.encode("utf-8")).digest()[:8], "little") for key in keys],
+                    dtype = np.uint64)
+
+def dimension_frame(typed, airlines):
+    """
+    The bucket of each review, a string column per dimension.
+    """
+    def text(column):
+        if column not in typed.columns:
+            return pd.Series(MISSING, index = typed.index)
+        return typed[column].astype("object")
+
+    countries = text("reviewer_country")
+    # scraped reviewer lines hold the country between brackets
+    scraped = countries.str.contains("\n", regex = False).fillna(False).astype(bool)
+    countries = countries.where(~scraped, countries.str.extract(r"\((.*)\)", expand = False))
+
+    dimensions = pd.DataFrame({
+        "airline" : airlines.values,
+        "month" : typed["date_of_review"].dt.strftime("%Y-%m").astype("object").values,
+        "seat_type" : text("seat_type").values,
+        "traveller_type" : text("traveller_type").values,
+        "reviewer_country" : countries.str.strip().values,
+        "recommendation" : text("recommendation").values
+    }, index = typed.index)
+
+    return dimensions.fillna(MISSING).astype(str)
+
+def sorted_contains(sorted_values, values):
+    """
+    Whether each of values is in sorted_values, by binary search.
+    """
+    if len(sorted_values) == 0:
+        return np.zeros(len(values), dtype = bool)
+
+    positions = np.minimum(np.searchsorted(sorted_values, values), len(sorted_values) - 1)
+
+    return sorted_values[positions] == values
+
+def month_of(value):
+    """
+    The "YYYY-MM" month of a date, or of a month given as "YYYY-MM".
+    """
+    if value is None:
+        return None
+
+    return pd.Timestamp(value).strftime("%Y-%m")
@@ -0,0 +1,226 @@
+#
+# review_parser.py
+#
+# @author: Evan Yathon
+#
+# August 2019
+#
+# review_parser extracts the reviews from airlinequality.com review pages in a
+# single pass over each review.  Rather than searching a review once for every
+# field, each element is looked at once and dispatched on its tag and class,
+# with the `review-rating-header <field>` cells telling which field the next
+# table cell holds.
+#
+# Pages are parsed with lxml's incremental parser, and each review's elements
+# are cleared as soon as it has been read, so parse_reviews can stream rows
+# from any number of pages while only holding one page in memory.
+#
+# The extracted values are the same as those of `parse_review` in
+# scrape_reviews.py, which is kept as the reference implementation.
+#
+# Example usage:
+# for row in parse_reviews(pages):
+#     print(row["title"], row["recommendation"])
+
+import io
+import time
+
+from lxml import etree
+
+from instrumentation import count
+
+# values of `review-rating-header <field>` holding text, and their column
+TEXT_FIELDS = {
+    "aircraft" : "aircraft",
+    "type_of_traveller" : "traveller_type",
+    "cabin_flown" : "seat_type",
+    "route" : "route",
+    "date_flown" : "date_flown",
+    "recommended" : "recommendation"
+}
+
+# values of `review-rating-header <field>` holding stars out of 5, and their column
+STAR_FIELDS = {
+    "seat_comfort" : "seat_comfort_rating",
+    "cabin_staff_service" : "cabin_staff_service_rating",
+    "food_and_beverages" : "food_and_beverages_rating",
+    "inflight_entertainment" : "inflight_entertainment_rating",
+    "ground_service" : "ground_service_rating",
+    "value_for_money" : "value_for_money_rating"
+}
+
+# (tag, attribute, attribute value) of the elements whose text is a column
+ELEMENT_FIELDS = {
+    ("h2", "class", "text_header") : "title",
+    ("span", "itemprop", "ratingValue") : "review_value",
+    ("span", "class", "userStatusReviewCount") : "n_user_reviews",
+    ("span", "itemprop", "name") : "reviewer_name",
+    ("h3", "class", "text_sub_header userStatusWrapper") : "reviewer_country",
+    ("time", "itemprop", "datePublished") : "date_of_review",
+    ("div", "class", "text_content") : "review_text"
+}
+
+# whitespace that BeautifulSoup collapses when a string is made up only of it
+ASCII_SPACES = "\x20\x0a\x09\x0c\x0d"
+
+# columns of a parsed review, in order
+REVIEW_COLUMNS = ["title", "review_value", "n_user_reviews", "reviewer_name", "reviewer_country",
+                  "date_of_review", "review_text", "aircraft", "traveller_type", "seat_type", "route",
+                  "date_flown", "seat_comfort_rating", "cabin_staff_service_rating",
+                  "food_and_beverages_rating", "inflight_entertainment_rating", "ground_service_rating",
+                  "value_for_money_rating", "recommendation"]
+
+def parse_reviews(pages, encoding = "utf-8"):
+    """
+    parse_reviews is a generator over the reviews of several pages.  Pages are
+    only read as rows are requested, so pages can come straight from a crawl.
+    The pages parsed and the time spent parsing them are counted for the
+    instrumented stages.
+
+    Args:
+        pages (iterable) : html of each review page as bytes
+        encoding (str) : encoding of the pages
+
+    Return:
+        generator of dicts with a value for each column in REVIEW_COLUMNS
+    """
+    for page in pages:
+        start = time.perf_counter()
+        rows = list(parse_page(page, encoding))
+        count("pages_parsed")
+        count("parse_seconds", time.perf_counter() - start)
+
+        for row in rows:
+            yield row
+
+def parse_page(page, encoding = "utf-8"):
+    """
+    parse_page is a generator over the reviews on one page.
+
+    Args:
+        page (bytes) : html of a review page
+        encoding (str) : encoding of the page
+
+    Return:
+        generator of dicts with a value for each column in REVIEW_COLUMNS
+    """
+    events = etree.iterparse(io.BytesIO(page), events = ("end",), tag = "article",
+                             html = True, encoding = encoding)
+
+    for _, article in events:
+
+        if article.get("itemprop") == "review":
+            yield parse_article(article)
+
+            # free the review's elements now that it's been read, including
+            # the references to it kept by its earlier siblings
+            article.clear()
+            while article.getprevious() is not None:
+                del article.getparent()[0]
+
+def parse_article(article):
+    """
+    parse_article walks the elements of one review once, filling in each
+    column as its element is found.  Like BeautifulSoup's find, the first
+    matching element is used for each column.
+
+    Args:
+        article (Element) : lxml element of an `<article itemprop="review">`
+
+    Return:
+        (dict) a value for each column in REVIEW_COLUMNS, None where missing
+    """
+    row = dict.fromkeys(REVIEW_COLUMNS)
+
+    # the field the next td holds, following a review-rating-header td
+    pending = None
+
+    for element in article.iter():
+
+        tag = element.tag
+        if not isinstance(tag, str):
+            # comments and processing instructions
+            continue
+
+        if tag == "td":
+            css_class = normalized_class(element)
+
+            if pending is not None:
+                field, is_stars = pending
+                pending = None
+                if row[field] is None:
+                    row[field] = count_stars(element) if is_stars else element_text(element)
+
+            elif css_class.startswith("review-rating-header "):
+                header = css_class[len("review-rating-header "):]
+                if header in TEXT_FIELDS:
+                    pending = (TEXT_FIELDS[header], False)
+                elif header in STAR_FIELDS:
+                    pending = (STAR_FIELDS[header], True)
+            continue
+
+        if tag not in ("h2", "h3", "span", "time", "div"):
+            continue
+
+        field = ELEMENT_FIELDS.get((tag, "class", normalized_class(element)))
+        if field is None:
+            field = ELEMENT_FIELDS.get((tag, "itemprop", element.get("itemprop")))
+
+        if field is not None and row[field] is None:
+            row[field] = element_text(element)
+
+    return row
+
+def parse_pagination(page, encoding = "utf-8"):
+    """
+    parse_pagination reads the pagination under the reviews.  The last page is
+    always linked, so the largest page number shown is the number of pages.
+
+    Args:
+        page (bytes) : html of a review page
+        encoding (str) : encoding of the page
+
+    Return:
+        (n_pages, next_href) the number of pages, or None if there is no
+        pagination, and the href of the ">>" link, or None on the last page
+    """
+    root = etree.fromstring(page, etree.HTMLParser(encoding = encoding))
+    if root is None:
+        return None, None
+
+    numbers = [int(text.strip()) for text in root.xpath(
+        "//article[contains(concat(' ', normalize-space(@class), ' '), ' comp_reviews-pagination ')]"
+        "//*[self::a or self::span]/text()") if text.strip().isdigit()]
+
+    next_hrefs = root.xpath("//a[normalize-space(.) = '>>']/@href")
+
+    return (max(numbers) if len(numbers) > 0 else None), (next_hrefs[0] if len(next_hrefs) > 0 else None)
+
+def normalized_class(element):
+    """
+    normalized_class joins an element's classes with single spaces, which is
+    the form BeautifulSoup compares multi word class strings against.
+    """
+    return " ".join(element.get("class", "").split())
+
+def element_text(element):
+    """
+    element_text gives the same text as BeautifulSoup's `.text`: the text of
+    the element and its descendants, where strings that are only whitespace
+    are collapsed to a single newline or space.
+    """
+    parts = []
+
+    for text in element.itertext():
+        if text.strip(ASCII_SPACES) == "":
+            text = "\n" if "\n" in text else " "
+        parts.append(text)
+
+    return "".join(parts)
+
+def count_stars(element):
+    """
+    count_stars counts the `<span class="star fill">` tags of a star rating,
+    the number of filled stars being the rating.
+    """
+    return sum(1 for span in element.iter("span") if normalized_class(span) == "star fill")
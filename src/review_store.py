@@ -0,0 +1,272 @@
+#
+# review_store.py
+#
+# @author: Evan Yathon
+#
+# August 2019
+#
+# review_store reads and writes the reviews datasets passed between the
+# pipeline stages (scraping, verify and clean, topic modeling and regression)
+# with real column types instead of all strings:
+#
+# - categories for the repeated text columns such as aircraft and seat_type
+# - small nullable integers for the review value and star ratings
+# - datetimes for the review and flown dates
+#
+# The format is picked from the file extension.  `.parquet` and
+# `.arrow`/`.feather` keep the types on disk and allow loading only some of
+# the columns, `.csv` is still supported and is typed as it is read.
+#
+# Example usage:
+# reviews = read_reviews("data/scraped_gw_reviews.csv")
+# write_reviews(reviews, "data/scraped_gw_reviews.parquet")
+# ratings = read_reviews("data/scraped_gw_reviews.parquet", columns = ["date_of_review", "review_value"])
+# for chunk in iter_reviews("data/all_reviews.parquet", columns = ["seat_type", "review_value"]):
+#     ...
+
+import os
+import re
+
+from datetime import datetime
+
+import pandas as pd
+
+# repeated text values stored as categories
+CATEGORY_COLUMNS = ["aircraft", "seat_type", "traveller_type", "route", "reviewer_country",
+                    "recommendation", "airline"]
+
+# review value out of 10 and star ratings out of 5
+RATING_COLUMNS = ["review_value", "seat_comfort_rating", "cabin_staff_service_rating",
+                  "food_and_beverages_rating", "inflight_entertainment_rating",
+                  "ground_service_rating", "value_for_money_rating"]
+RATING_DTYPE = "Int8"
+
+DATE_COLUMNS = ["date_of_review", "date_flown"]
+
+# formats of the dates as cleaned, and as scraped ("1st July 2019", "June 2019")
+# once the ordinal suffix has been removed
+DATE_FORMATS = ["%Y-%m-%d", "%Y-%m-%d %H:%M:%S", "%d %B %Y", "%B %Y"]
+
+ORDINAL_SUFFIX = re.compile(r"(\d+)(st|nd|rd|th)\b")
+
+def read_reviews(load_path, columns = None):
+    """
+    read_reviews loads a reviews dataset with typed columns.
+
+    Args:
+        load_path (str) : path of a .parquet, .arrow/.feather or .csv file
+        columns (list) : columns to load, default all of them.  For parquet
+                         and arrow files the other columns are never read.
+
+    Return:
+        pandas dataframe of reviews
+    """
+    file_format = storage_format(load_path)
+
+    if file_format == "parquet":
+        return pd.read_parquet(load_path, columns = columns)
+
+    if file_format == "arrow":
+        return pd.read_feather(load_path, columns = columns)
+
+    reviews = pd.read_csv(load_path, usecols = columns)
+    if columns is not None:
+        reviews = reviews[columns]
+
+    return to_typed(reviews)
+
+def iter_reviews(load_path, columns = None, chunksize = 100000):
+    """
+    iter_reviews reads a reviews dataset a chunk at a time with typed
+    columns, for datasets too large to load at once.  Csv files are read
+    chunksize rows at a time, parquet files a row group at a time and arrow
+    files a record batch at a time.
+
+    The categories of a category column can differ between chunks, as they
+    are the values present in each chunk.
+
+    Args:
+        load_path (str) : path of a .parquet, .arrow/.feather or .csv file
+        columns (list) : columns to load, default all of them
+        chunksize (int) : rows per chunk of a csv file
+
+    Return:
+        generator of pandas dataframes of reviews
+    """
+    file_format = storage_format(load_path)
+
+    if file_format == "parquet":
+        import pyarrow.parquet as pq
+        parquet_file = pq.ParquetFile(load_path)
+        for row_group in range(parquet_file.num_row_groups):
+            yield parquet_file.read_row_group(row_group, columns = columns).to_pandas()
+
+    elif file_format == "arrow":
+        import pyarrow as pa
+        import pyarrow.ipc as ipc
+        reader = ipc.open_file(load_path)
+        for batch in range(reader.num_record_batches):
+            chunk = pa.Table.from_batches([reader.get_batch(batch)]).to_pandas()
+            yield chunk if columns is None else chunk[columns]
+
+    else:
+        for chunk in pd.read_csv(load_path, usecols = columns, chunksize = chunksize):
+            if columns is not None:
+                chunk = chunk[columns]
+            yield to_typed(chunk)
+
+def write_reviews(reviews, save_path):
+    """
+    write_reviews saves a reviews dataset, typing its columns first when the
+    format keeps the types.
+
+    Args:
+        reviews (pd.DataFrame) : reviews to save
+        save_path (str) : path of a .parquet, .arrow/.feather or .csv file
+    """
+    file_format = storage_format(save_path)
+
+    if file_format == "parquet":
+        to_typed(reviews).to_parquet(save_path, index = False)
+    elif file_format == "arrow":
+        to_typed(reviews).reset_index(drop = True).to_feather(save_path)
+    else:
+        reviews.to_csv(save_path, index = False)
+
+def append_reviews(reviews, save_path):
+    """
+    append_reviews adds reviews to the end of a saved dataset.  Csv files are
+    appended to in place, other formats are read and written back.
+
+    Args:
+        reviews (pd.DataFrame) : reviews to add, with the saved dataset's columns
+        save_path (str) : path of the saved dataset
+    """
+    if storage_format(save_path) == "csv":
+        reviews.to_csv(save_path, mode = "a", header = False, index = False)
+    else:
+        saved = read_reviews(save_path)
+        combined = pd.concat([saved, to_typed(reviews)[saved.columns]], ignore_index = True)
+        write_reviews(combined, save_path)
+
+def list_columns(load_path):
+    """
+    list_columns gives the column names of a saved dataset without loading it.
+
+    Args:
+        load_path (str) : path of a .parquet, .arrow/.feather or .csv file
+
+    Return:
+        list of column names
+    """
+    file_format = storage_format(load_path)
+
+    if file_format == "parquet":
+        import pyarrow.parquet as pq
+        return pq.read_schema(load_path).names
+
+    if file_format == "arrow":
+        import pyarrow.ipc as ipc
+        return ipc.open_file(load_path).schema.names
+
+    return pd.read_csv(load_path, nrows = 0).columns.tolist()
+
+def to_typed(reviews):
+    """
+    to_typed converts the known columns of a reviews dataframe to their types.
+    Other columns, such as the review text or topic probabilities, are left
+    as they are.  The input dataframe isn't modified.
+
+    Args:
+        reviews (pd.DataFrame) : reviews as scraped or read from csv
+
+    Return:
+        pandas dataframe with typed columns
+    """
+    # a shallow copy, so that replacing columns doesn't copy the others
+    typed = reviews.copy(deep = False)
+
+    for column in typed.columns:
+
+        if column in CATEGORY_COLUMNS:
+            typed[column] = typed[column].astype("category")
+
+        elif column in RATING_COLUMNS:
+            typed[column] = pd.to_numeric(typed[column], errors = "coerce").round().astype(RATING_DTYPE)
+
+        elif column in DATE_COLUMNS:
+            typed[column] = parse_review_dates(typed[column])
+
+    return typed
+
+def parse_review_dates(values):
+    """
+    parse_review_dates converts cleaned or scraped dates to datetimes, trying
+    each of DATE_FORMATS in turn rather than inferring the format of every
+    value.  Values in none of the formats become NaT.
+
+    Args:
+        values (pd.Series) : dates as strings, or already datetimes
+
+    Return:
+        pandas series of datetimes
+    """
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values
+
+    text = values.astype("object").where(values.notna())
+    text = text.str.replace(ORDINAL_SUFFIX, r"\1", regex = True).str.strip()
+
+    parsed = pd.Series(pd.NaT, index = values.index, dtype = "datetime64[ns]")
+
+    for date_format in DATE_FORMATS:
+        missing = parsed.isna() & text.notna()
+        if not missing.any():
+            break
+        parsed[missing] = pd.to_datetime(text[missing], format = date_format, errors = "coerce")
+
+    return parsed
+
+def normalize_date(value):
+    """
+    normalize_date gives a single date in the form "YYYY-MM-DD", whether it is
+    a datetime or a cleaned or scraped string, so that dates can be compared
+    across formats.  Strings in none of DATE_FORMATS are returned unchanged.
+
+    Args:
+        value (str or datetime) : the date
+
+    Return:
+        (str) the normalized date, "" for a missing date
+    """
+    if value is None or value is pd.NaT or (isinstance(value, float) and value != value):
+        return ""
+
+    if isinstance(value, datetime):
+        return value.strftime("%Y-%m-%d")
+
+    text = ORDINAL_SUFFIX.sub(r"\1", str(value)).strip()
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(text, date_format).strftime("%Y-%m-%d")
+        except ValueError:
+            pass
+
+    return str(value)
+
+def storage_format(path):
+    """
+    storage_format picks the file format from a path's extension.
+
+    Return:
+        "parquet", "arrow" or "csv"
+    """
+    extension = os.path.splitext(path)[1].lower()
+
+    if extension in (".parquet", ".pq"):
+        return "parquet"
+
+    if extension in (".arrow", ".feather", ".ipc"):
+        return "arrow"
+
+    return "csv"
@@ -0,0 +1,239 @@
+#
+# scrape_airlines.py
+#
+# @author: Evan Yathon
+#
+# August 2019
+#
+# scrape_airlines scrapes the reviews of several airlines on airlinequality.com
+# at once.  It is built on the pieces of scrape_reviews.py and runs as a
+# producer/consumer pipeline:
+#
+# - a pool of threads fetches pages for every airline, sharing one rate limiter
+#   since every airline is on the same host
+# - each page is handed to a pool of processes to be parsed as soon as it
+#   arrives, so parsing overlaps with the rest of the crawl
+#
+# Fetching scales with --n_workers (up to the rate limit) and parsing with
+# --n_processes.  The reviews of each airline are saved to their own file and
+# all reviews, with an `airline` column, to all_reviews.  --format picks csv,
+# or parquet/arrow to keep the column types (see review_store.py).
+#
+# sample usage
+# python src/scrape_airlines.py data/airlines 5 germanwings eurowings lufthansa --n_workers 4
+# python src/scrape_airlines.py data/airlines 5 germanwings eurowings --format parquet
+#
+# --aggregate_dir adds the reviews to the monthly counts kept there for the EDA
+# views, see review_aggregates.py.
+#
+# python src/scrape_airlines.py data/airlines 5 germanwings eurowings --aggregate_dir data/aggregates
+#
+# Pages that fail with a 429 or 5xx answer, or a dropped connection, are
+# retried with backoff (see http_session.py), as set by --retries and
+# --timeout.  An airline with a page that still fails is left out: the other
+# airlines are saved and the script exits with 1, naming the airlines that
+# failed so that they can be scraped again.
+
+# utils
+import argparse
+import os
+import sys
+
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+import pandas as pd
+
+from http_session import FetchError, HttpSession
+from page_cache import PageCache
+from review_aggregates import update_store
+from review_parser import REVIEW_COLUMNS, parse_page, parse_pagination
+from review_store import write_reviews
+from scrape_reviews import RateLimiter, fetch_page, page_url
+
+BASE_URL = "https://www.airlinequality.com"
+
+def main(save_dir, sleep_time, slugs, n_workers = 4, n_processes = None, base_url = BASE_URL,
+         cache_dir = None, cache_max_age = 3600, file_format = "csv", aggregate_dir = None, retries = 5,
+         timeout = 30.0):
+
+    sys.stdout.write("Scraping reviews of {} airlines.\n".format(len(slugs)))
+    sys.stdout.flush()
+
+    reviews = scrape_airlines(slugs, sleep_time, n_workers = n_workers, n_processes = n_processes,
+                              base_url = base_url, cache_dir = cache_dir, cache_max_age = cache_max_age,
+                              retries = retries, timeout = timeout)
+
+    if len(reviews) > 0:
+        sys.stdout.write("Saving reviews of {} airlines to {}\n".format(len(reviews), save_dir))
+        sys.stdout.flush()
+
+        combined = save_airlines(reviews, save_dir, file_format)
+
+        if aggregate_dir is not None:
+            update_store(aggregate_dir, combined)
+
+    failed = [slug for slug in slugs if slug not in reviews]
+    if len(failed) > 0:
+        sys.stderr.write("Failed to scrape {}\n".format(", ".join(failed)))
+        sys.exit(1)
+
+def airline_url(slug, base_url = BASE_URL):
+    """
+    airline_url builds the url of the first review page of an airline.
+
+    Args:
+        slug (str) : airline name as it appears in the website's urls, for example "germanwings"
+        base_url (str) : scheme and host of the website
+
+    Return:
+        (str) url of the first review page
+    """
+    return "{}/airline-reviews/{}/".format(base_url.rstrip("/"), slug)
+
+def parse_page_rows(page):
+    """
+    parse_page_rows parses all of the reviews on a page.  Run in the parsing
+    processes, so it returns a list rather than a generator.
+    """
+    return list(parse_page(page))
+
+def scrape_airlines(slugs, sleep_time, n_workers = 4, n_processes = None, base_url = BASE_URL,
+                    cache_dir = None, cache_max_age = 3600, retries = 5, timeout = 30.0):
+    """
+    scrape_airlines fetches and parses every review page of several airlines.
+
+    The first page of every airline is requested first.  Once a first page
+    arrives the rest of that airline's pages are queued on the same fetch
+    pool, and every fetched page is sent to the parse pool straight away.
+
+    An airline with a page that can't be fetched after its retries is left
+    out of the result, and the rest of its pages are dropped, so that one
+    failed page doesn't lose the other airlines.
+
+    Args:
+        slugs (list) : airline slugs, for example ["germanwings", "eurowings"]
+        sleep_time (float) : seconds between requests, shared by all workers
+        n_workers (int) : number of requests in flight at once
+        n_processes (int) : number of parsing processes, default one per core
+        base_url (str) : scheme and host of the website
+        cache_dir (str) : optional directory of an on disk page cache
+        cache_max_age (float) : seconds that cached pages are used without a request
+        retries (int) : attempts after the first for a page that fails
+        timeout (float) : seconds to wait for a page's answer
+
+    Return:
+        dict of airline slug mapped to a pandas dataframe of its reviews, for
+        the airlines whose pages were all fetched
+    """
+    rate_limiter = RateLimiter(1.0 / sleep_time if sleep_time > 0 else None)
+    cache = PageCache(cache_dir, max_age = cache_max_age) if cache_dir is not None else None
+
+    # every airline is on the same host, so the workers share one pool of
+    # kept alive connections
+    session = HttpSession(max_connections = n_workers, retries = retries, read_timeout = timeout)
+
+    # parsed rows of each page, by airline then page number
+    parsed_pages = dict((slug, {}) for slug in slugs)
+
+    # airlines with a page that couldn't be fetched
+    failed = set()
+
+    with ThreadPoolExecutor(max_workers = n_workers) as fetch_pool, \
+         ProcessPoolExecutor(max_workers = n_processes) as parse_pool:
+
+        def fetch(slug, page_number, url):
+            return fetch_pool.submit(fetch_page, url, rate_limiter, cache, session), (slug, page_number)
+
+        # futures mapped to the (slug, page number) they belong to
+        fetching = dict(fetch(slug, 1, airline_url(slug, base_url)) for slug in slugs)
+        parsing = {}
+
+        while len(fetching) > 0 or len(parsing) > 0:
+
+            done, _ = wait(list(fetching) + list(parsing), return_when = FIRST_COMPLETED)
+
+            for future in done:
+
+                if future in fetching:
+                    slug, page_number = fetching.pop(future)
+                    if slug in failed or future.cancelled():
+                        continue
+
+                    try:
+                        page = future.result()
+                    except FetchError as error:
+                        sys.stderr.write("Dropping {}: {}\n".format(slug, error))
+                        sys.stderr.flush()
+                        failed.add(slug)
+                        # pages of the airline that haven't been requested yet
+                        for pending, (pending_slug, _) in fetching.items():
+                            if pending_slug == slug:
+                                pending.cancel()
+                        continue
+
+                    # the first page tells us how many more pages to fetch
+                    if page_number == 1:
+                        n_pages = parse_pagination(page)[0] or 1
+                        first_url = airline_url(slug, base_url)
+                        for number in range(2, n_pages + 1):
+                            next_future, page_key = fetch(slug, number, page_url(first_url, number))
+                            fetching[next_future] = page_key
+
+                    parsing[parse_pool.submit(parse_page_rows, page)] = (slug, page_number)
+
+                else:
+                    slug, page_number = parsing.pop(future)
+                    parsed_pages[slug][page_number] = future.result()
+
+    reviews = {}
+    for slug in [slug for slug in slugs if slug not in failed]:
+        rows = [row for number in sorted(parsed_pages[slug]) for row in parsed_pages[slug][number]]
+        reviews[slug] = pd.DataFrame(rows, columns = REVIEW_COLUMNS)
+
+    return reviews
+
+def save_airlines(reviews, save_dir, file_format = "csv"):
+    """
+    save_airlines writes one file per airline, named after its slug, and all
+    reviews together in all_reviews with an added `airline` column.
+
+    Args:
+        reviews (dict) : airline slug mapped to a pandas dataframe of its reviews
+        save_dir (str) : directory to write to, created if needed
+        file_format (str) : "csv", "parquet" or "arrow"
+
+    Return:
+        pandas dataframe of all reviews
+    """
+    os.makedirs(save_dir, exist_ok = True)
+
+    for slug, df in reviews.items():
+        write_reviews(df, os.path.join(save_dir, "{}.{}".format(slug, file_format)))
+
+    combined = pd.concat([df.assign(airline = slug) for slug, df in reviews.items()],
+                         ignore_index = True)
+    write_reviews(combined, os.path.join(save_dir, "all_reviews.{}".format(file_format)))
+
+    return combined
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("save_dir")
+    parser.add_argument("sleep_time")
+    parser.add_argument("slugs", nargs = "+")
+    parser.add_argument("--n_workers", type = int, default = 4)
+    parser.add_argument("--n_processes", type = int, default = None)
+    parser.add_argument("--base_url", default = BASE_URL)
+    parser.add_argument("--cache_dir", default = None)
+    parser.add_argument("--cache_max_age", type = float, default = 3600)
+    parser.add_argument("--format", default = "csv", choices = ["csv", "parquet", "arrow"])
+    parser.add_argument("--aggregate_dir", default = None)
+    parser.add_argument("--retries", type = int, default = 5)
+    parser.add_argument("--timeout", type = float, default = 30.0)
+    args = parser.parse_args()
+
+    main(args.save_dir, float(args.sleep_time), args.slugs, n_workers = args.n_workers,
+         n_processes = args.n_processes, base_url = args.base_url, cache_dir = args.cache_dir,
+         cache_max_age = args.cache_max_age, file_format = args.format, aggregate_dir = args.aggregate_dir,
+         retries = args.retries, timeout = args.timeout)
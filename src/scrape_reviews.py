@@ -9,8 +9,37 @@
 # currently optimized for Germanwings, but can be easily extended to other
 # airlines on the same website.
 #
+# Pages after the first can be fetched concurrently with --n_workers.  The
+# sleep time is then enforced as a shared rate limit rather than a pause
+# between pages, so the website sees the same number of requests per second.
+#
 # sample usage
 # python src/scrape_reviews.py  data/scraped_gw_reviews.csv 5
+# python src/scrape_reviews.py  data/scraped_gw_reviews.csv 5 --n_workers 4
+#
+# With --cache_dir the raw pages are kept on disk and revalidated with the
+# server, and --incremental only scrapes the reviews that are newer than the
+# ones already in the csv, appending them to it.
+#
+# python src/scrape_reviews.py  data/scraped_gw_reviews.csv 5 --cache_dir data/page_cache --incremental
+#
+# Saving to a .parquet or .arrow path keeps the column types, see review_store.py.
+#
+# Requests go through an HttpSession (see http_session.py), which keeps the
+# connections to the website open between pages and retries pages that fail
+# with a 429 or 5xx answer, or a dropped connection, with backoff.  --retries
+# and --timeout set how hard it tries.
+#
+# --metrics_path records the time, pages, bytes fetched and peak memory of the
+# scrape, see instrumentation.py.
+#
+# python src/scrape_reviews.py  data/scraped_gw_reviews.csv 5 --metrics_path data/scrape_metrics.jsonl
+#
+# --aggregate_dir adds the scraped reviews to the monthly counts kept there for
+# the EDA views, see review_aggregates.py.  Only the reviews that are new to
+# the counts are added, so it can be given to every run.
+#
+# python src/scrape_reviews.py  data/scraped_gw_reviews.csv 5 --incremental --aggregate_dir data/aggregates
 
 # loading packages
 
@@ -19,241 +48,491 @@ import pandas as pd
 import time
 import argparse
 import sys
+import os
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
 
 # scraping
-from urllib.request import urlopen, Request
-from urllib.error import HTTPError, URLError
-from bs4 import BeautifulSoup
-
-# load argument for save path
-parser = argparse.ArgumentParser()
-parser.add_argument("save_path")
-parser.add_argument("sleep_time")
-args = parser.parse_args()
-save_path = args.save_path
-sleep_time = float(args.sleep_time)
-
-def main():
-
-    # access the Germanwings first review page
-    sys.stdout.write("Accessing the Germanwings review page.\n")
-    sys.stdout.flush()
-    gw_reviews_url = sneaky_request("https://www.airlinequality.com/airline-reviews/germanwings/")
+from urllib.parse import urljoin
 
-    # check that our status is okay, if not exit the script
-    if gw_reviews_url.reason != "OK":
-        sys.stdout.write("Status is not okay, exiting script.")
-        sys.stdout.flush()
-        sys.exit()
+import instrumentation
+
+from http_session import HttpSession
+from instrumentation import count, stage
+from page_cache import PageCache
+from review_parser import REVIEW_COLUMNS, parse_page, parse_pagination, parse_reviews
+from review_aggregates import update_store
+from review_store import append_reviews, normalize_date, read_reviews, write_reviews
+
+GW_REVIEWS_URL = "https://www.airlinequality.com/airline-reviews/germanwings/"
+
+# columns that together identify a review
+KEY_COLUMNS = ["date_of_review", "reviewer_name", "title"]
+
+def main(save_path, sleep_time, airline_url = GW_REVIEWS_URL, n_workers = 1,
+         cache_dir = None, cache_max_age = 3600, incremental = False, retries = 5, timeout = 30.0,
+         aggregate_dir = None):
+
+    # every request made during the crawl goes through the same rate limiter,
+    # allowing one request every sleep_time seconds
+    rate_limiter = RateLimiter(1.0 / sleep_time if sleep_time > 0 else None)
 
-    sys.stdout.write("Accessed URL: {} \nStatus: {}\n".format(gw_reviews_url.geturl(), gw_reviews_url.reason))
+    # raw pages are kept on disk when a cache directory is given, so that an
+    # interrupted crawl can pick up where it left off
+    cache = PageCache(cache_dir, max_age = cache_max_age) if cache_dir is not None else None
+
+    # one kept alive connection for each worker
+    session = HttpSession(max_connections = n_workers, retries = retries, read_timeout = timeout)
+
+    # access the first review page
+    sys.stdout.write("Accessing the review page.\n")
     sys.stdout.flush()
+    with stage("fetch_first_page"):
+        first_page = fetch_page(airline_url, rate_limiter, cache, session)
 
-    # Use BeautifulSoup to explore and scrape the pages for the relevant info.
+    sys.stdout.write("Accessed URL: {}\n".format(airline_url))
+    sys.stdout.flush()
 
-    gw_reviews = BeautifulSoup(gw_reviews_url.read(), features = "lxml")
+    # in incremental mode only the reviews that are newer than the ones already
+    # saved are scraped, and they are appended to the saved csv
+    if incremental and os.path.exists(save_path):
 
-    # We need to traverse all of the pages in order to extract all of the reviews;
-    # this means opening each subsequent page and extracting each review.
+        sys.stdout.write("Scraping review pages until a previously saved review is found.\n")
+        sys.stdout.flush()
 
-    # The following while loop iterates over each subsequent review page,
-    # terminating when there are no further pages to scrape. The airline review
-    # information is stored in reviews, to be parsed after extracting
-    # all of the information.
+        with stage("scrape", mode = "incremental") as scrape_stage:
+            seen_keys = load_review_keys(save_path)
+            new_reviews = crawl_new_reviews(first_page, airline_url, rate_limiter, seen_keys, cache, session)
+            scrape_stage.add("items", len(new_reviews))
+
+        sys.stdout.write("Appending {} new reviews to {}\n".format(len(new_reviews), save_path))
+        sys.stdout.flush()
 
-    # create the initial list and condition to keep scraping
-    reviews = []
-    keep_going = True
+        if len(new_reviews) > 0:
+            new_reviews_df = pd.DataFrame(new_reviews, columns = REVIEW_COLUMNS)
+            append_reviews(new_reviews_df, save_path)
+            if aggregate_dir is not None:
+                update_store(aggregate_dir, new_reviews_df, airline = airline_slug(airline_url),
+                             saved_path = save_path)
+        return
 
+    # We need to traverse all of the pages in order to extract all of the reviews;
+    # this means opening each subsequent page and extracting each review.
     sys.stdout.write("Scraping all review pages, this will take some time depending \
 on the input sleep time.\n")
     sys.stdout.flush()
 
-    while keep_going:
-
-        # store the customer reviews in a list for later parsing
-        if len(reviews) == 0:
-            # if it is the first page, create the list
-            reviews = gw_reviews.find_all("article", {"itemprop" : "review"})
-        else:
-            # concatenate the next pages reviews
-            for review in gw_reviews.find_all("article", {"itemprop" : "review"}):
-                reviews.append(review)
-
-        # find the next page tag, use it to construct the next page to access
-        # if it is the last page, end the loop
-        try:
-            next_page = gw_reviews.find("a", string = ">>")["href"]
-            next_page_url = "https://www.airlinequality.com" + next_page
-        except:
-            keep_going = False
-
-        # open the next page, but wait some seconds to be polite
-        # and not overload the server
-        time.sleep(sleep_time)
-        gw_reviews_url = sneaky_request(next_page_url)
-        gw_reviews = BeautifulSoup(gw_reviews_url.read(), features = "lxml")
-
-    # Iterate through the reviews, building lists of the required information.
-
-    # Note that this could be done in parallel using a library such as joblib,
-    # but the dataset is so small that there is no need to implement it.
-
-    # build a dictionary structure for easily working with, and to convert to a
-    # pandas dataframe later
-    parsed_reviews = {
-        "title" : [],
-        "review_value" : [],
-        "n_user_reviews" : [],
-        "reviewer_name" : [],
-        "reviewer_country" : [],
-        "date_of_review" : [],
-        "review_text" : [],
-        "aircraft" :[],
-        "traveller_type" : [],
-        "seat_type" : [],
-        "route" : [],
-        "date_flown" : [],
-        "seat_comfort_rating" : [],
-        "cabin_staff_service_rating" : [],
-        "food_and_beverages_rating" : [],
-        "inflight_entertainment_rating" : [],
-        "ground_service_rating" : [],
-        "value_for_money_rating" : [],
-        "recommendation" : []
-    }
-
-    # iterate through all reviews, extracting information from each
-    # and storing in the parsed_reviews dict
+    # Pages are parsed as they arrive, each page's reviews being read in a
+    # single pass so that the page can be freed straight away.
     sys.stdout.write("Parsing reviews\n")
     sys.stdout.flush()
 
-    for review in reviews:
+    with stage("scrape", mode = "full", n_workers = n_workers) as scrape_stage:
+        pages = crawl_pages(first_page, airline_url, rate_limiter, n_workers, cache, session)
+        parsed_reviews = list(parse_reviews(pages))
+        scrape_stage.add("items", len(parsed_reviews))
+
+    # Now that all information is parsed, convert to a pandas dataframe
+    # and save it, as a csv or in a typed format depending on the extension.
+    parsed_reviews_df = pd.DataFrame(parsed_reviews, columns = REVIEW_COLUMNS)
+
+    sys.stdout.write("Saving reviews to {}\n".format(save_path))
+    sys.stdout.flush()
+
+    with stage("write_reviews") as write_stage:
+        write_reviews(parsed_reviews_df, save_path)
+        write_stage.add("items", len(parsed_reviews_df))
+
+    # the monthly counts only take in the reviews they haven't counted yet
+    if aggregate_dir is not None:
+        update_store(aggregate_dir, parsed_reviews_df, airline = airline_slug(airline_url))
+
+def airline_slug(airline_url):
+    """
+    airline_slug gives the name of an airline as it appears in its review page
+    url, for example "germanwings".
+    """
+    return airline_url.rstrip("/").rsplit("/", 1)[-1]
 
-        # extract review title
-        review_title = review.find("h2", {"class" : "text_header"})
-        parsed_reviews["title"].append(safe_extract(review_title))
+def parse_review(review):
+    """
+    parse_review extracts the information of a single review by searching the
+    review once for each field.  The crawl uses the single pass parser in
+    review_parser.py instead, and this is kept as the reference implementation
+    that the parser is checked and benchmarked against.
 
-        # extract review value out of 10
-        review_value = review.find("span", {"itemprop" : "ratingValue"})
+    Args:
+        review (Tag) : BeautifulSoup `<article itemprop="review">` tag
 
-        # if there is no value out of 10, enter None instead using `safe_extract`
-        parsed_reviews["review_value"].append(safe_extract(review_value))
+    Return:
+        (dict) the value of each column in REVIEW_COLUMNS
+    """
+    parsed_review = {}
 
-        # extract number of reviews by the reviewer
-        n_reviews = review.find("span", {"class" : "userStatusReviewCount"})
-        parsed_reviews["n_user_reviews"].append(safe_extract(n_reviews))
 
-        # extract the reviewer
-        reviewer_name = review.find("span", {"itemprop" : "name"})
-        parsed_reviews["reviewer_name"].append(safe_extract(reviewer_name))
+    # extract review title
+    review_title = review.find("h2", {"class" : "text_header"})
+    parsed_review["title"] = safe_extract(review_title)
 
-        # extract the country of the reviewer
-        reviewer_country = review.find("h3", {"class" : "text_sub_header userStatusWrapper"})
-        parsed_reviews["reviewer_country"].append(safe_extract(reviewer_country))
+    # extract review value out of 10
+    review_value = review.find("span", {"itemprop" : "ratingValue"})
 
-        # extract the date of the review
-        date_of_review = review.find("time", {"itemprop" : "datePublished"})
-        parsed_reviews["date_of_review"].append(safe_extract(date_of_review))
+    # if there is no value out of 10, enter None instead using `safe_extract`
+    parsed_review["review_value"] = safe_extract(review_value)
 
-        # extract the review text
-        review_text = review.find("div", {"class" : "text_content"})
-        parsed_reviews["review_text"].append(safe_extract(review_text))
+    # extract number of reviews by the reviewer
+    n_reviews = review.find("span", {"class" : "userStatusReviewCount"})
+    parsed_review["n_user_reviews"] = safe_extract(n_reviews)
 
-        # extract the aircraft
-        # there are multiple td with class = "review-value"
-        # so we need to find the sibling header for aircraft then find it's sibling
-        # in order to find the aircraft type.  Use sibling_extract for this
-        aircraft = review.find("td", {"class" : "review-rating-header aircraft"})
-        aircraft_value = sibling_extract(aircraft)
-        parsed_reviews["aircraft"].append(aircraft_value)
+    # extract the reviewer
+    reviewer_name = review.find("span", {"itemprop" : "name"})
+    parsed_review["reviewer_name"] = safe_extract(reviewer_name)
 
-        # extract the type of traveller
-        traveller_type = review.find("td", {"class" : "review-rating-header type_of_traveller"})
-        traveller_type_value = sibling_extract(traveller_type)
-        parsed_reviews["traveller_type"].append(traveller_type_value)
+    # extract the country of the reviewer
+    reviewer_country = review.find("h3", {"class" : "text_sub_header userStatusWrapper"})
+    parsed_review["reviewer_country"] = safe_extract(reviewer_country)
 
-        # extract seat type
-        seat_type = review.find("td", {"class" : "review-rating-header cabin_flown"})
-        seat_type_value = sibling_extract(seat_type)
-        parsed_reviews["seat_type"].append(seat_type_value)
+    # extract the date of the review
+    date_of_review = review.find("time", {"itemprop" : "datePublished"})
+    parsed_review["date_of_review"] = safe_extract(date_of_review)
 
-        # extract the route
-        route = review.find("td", {"class" : "review-rating-header route"})
-        route_value = sibling_extract(route)
-        parsed_reviews["route"].append(route_value)
+    # extract the review text
+    review_text = review.find("div", {"class" : "text_content"})
+    parsed_review["review_text"] = safe_extract(review_text)
 
-        # extract the date flown
-        date_flown = review.find("td", {"class" : "review-rating-header date_flown"})
-        date_flown_value = sibling_extract(date_flown)
-        parsed_reviews["date_flown"].append(date_flown_value)
+    # extract the aircraft
+    # there are multiple td with class = "review-value"
+    # so we need to find the sibling header for aircraft then find it's sibling
+    # in order to find the aircraft type.  Use sibling_extract for this
+    aircraft = review.find("td", {"class" : "review-rating-header aircraft"})
+    aircraft_value = sibling_extract(aircraft)
+    parsed_review["aircraft"] = aircraft_value
 
-        # extract the seat comfort rating out of 5
-        # need to find the sibling in order to narrow down the number of stars for
-        # seat comfort or other ratings.  use star_extract to do this for us
-        seat_comfort_rating = review.find("td", {"class" : "review-rating-header seat_comfort"})
-        parsed_reviews["seat_comfort_rating"].append(star_extract(seat_comfort_rating))
+    # extract the type of traveller
+    traveller_type = review.find("td", {"class" : "review-rating-header type_of_traveller"})
+    traveller_type_value = sibling_extract(traveller_type)
+    parsed_review["traveller_type"] = traveller_type_value
 
-        # extract the cabin staff service rating out of 5
-        cabin_staff_service_rating = review.find("td", {"class" : "review-rating-header cabin_staff_service"})
-        parsed_reviews["cabin_staff_service_rating"].append(star_extract(cabin_staff_service_rating))
+    # extract seat type
+    seat_type = review.find("td", {"class" : "review-rating-header cabin_flown"})
+    seat_type_value = sibling_extract(seat_type)
+    parsed_review["seat_type"] = seat_type_value
 
-        # extract the food and beverages rating out of 5
-        food_and_beverages_rating = review.find("td", {"class" : "review-rating-header food_and_beverages"})
-        parsed_reviews["food_and_beverages_rating"].append(star_extract(food_and_beverages_rating))
+    # extract the route
+    route = review.find("td", {"class" : "review-rating-header route"})
+    route_value = sibling_extract(route)
+    parsed_review["route"] = route_value
 
-        # extract the inflight entertainment rating out of 5
-        inflight_entertainment_rating = review.find("td", {"class" : "review-rating-header inflight_entertainment"})
-        parsed_reviews["inflight_entertainment_rating"].append(star_extract(inflight_entertainment_rating))
+    # extract the date flown
+    date_flown = review.find("td", {"class" : "review-rating-header date_flown"})
+    date_flown_value = sibling_extract(date_flown)
+    parsed_review["date_flown"] = date_flown_value
 
-        # extract the ground service rating out of 5
-        ground_service_rating = review.find("td", {"class" : "review-rating-header ground_service"})
-        parsed_reviews["ground_service_rating"].append(star_extract(ground_service_rating))
+    # extract the seat comfort rating out of 5
+    # need to find the sibling in order to narrow down the number of stars for
+    # seat comfort or other ratings.  use star_extract to do this for us
+    seat_comfort_rating = review.find("td", {"class" : "review-rating-header seat_comfort"})
+    parsed_review["seat_comfort_rating"] = star_extract(seat_comfort_rating)
 
-        # extract the value for money rating out of 5
-        value_for_money_rating = review.find("td", {"class" : "review-rating-header value_for_money"})
-        parsed_reviews["value_for_money_rating"].append(star_extract(value_for_money_rating))
+    # extract the cabin staff service rating out of 5
+    cabin_staff_service_rating = review.find("td", {"class" : "review-rating-header cabin_staff_service"})
+    parsed_review["cabin_staff_service_rating"] = star_extract(cabin_staff_service_rating)
 
-        # extract if the review recommended Germanwings or not
-        recommendation = review.find("td", {"class" : "review-rating-header recommended"}).find_next("td")
-        parsed_reviews["recommendation"].append(recommendation.text)
+    # extract the food and beverages rating out of 5
+    food_and_beverages_rating = review.find("td", {"class" : "review-rating-header food_and_beverages"})
+    parsed_review["food_and_beverages_rating"] = star_extract(food_and_beverages_rating)
 
-        # Now that all information is parsed, convert to a pandas dataframe
-        # and save as a csv.
+    # extract the inflight entertainment rating out of 5
+    inflight_entertainment_rating = review.find("td", {"class" : "review-rating-header inflight_entertainment"})
+    parsed_review["inflight_entertainment_rating"] = star_extract(inflight_entertainment_rating)
 
-    parsed_reviews_df = pd.DataFrame(parsed_reviews)
+    # extract the ground service rating out of 5
+    ground_service_rating = review.find("td", {"class" : "review-rating-header ground_service"})
+    parsed_review["ground_service_rating"] = star_extract(ground_service_rating)
 
-    sys.stdout.write("Saving csv to {}\n".format(save_path))
-    sys.stdout.flush()
+    # extract the value for money rating out of 5
+    value_for_money_rating = review.find("td", {"class" : "review-rating-header value_for_money"})
+    parsed_review["value_for_money_rating"] = star_extract(value_for_money_rating)
+
+    # extract if the review recommended the airline or not
+    recommendation = review.find("td", {"class" : "review-rating-header recommended"}).find_next("td")
+    parsed_review["recommendation"] = recommendation.text
+
+    return parsed_review
+
+def review_key(review):
+    """
+    review_key identifies a review by its date, reviewer and title, which is
+    used to tell whether a review has already been scraped.
+
+    Args:
+        review (dict) : a parsed review, or a row read back from the saved reviews
+
+    Return:
+        (tuple) the identifying key
+    """
+    date_of_review = normalize_date(review["date_of_review"])
+    reviewer_name = "" if pd.isna(review["reviewer_name"]) else str(review["reviewer_name"])
+    title = "" if pd.isna(review["title"]) else str(review["title"])
+
+    return (date_of_review, reviewer_name, title)
+
+def load_review_keys(load_path):
+    """
+    load_review_keys reads the keys of previously saved reviews, loading only
+    the key columns.
+
+    Args:
+        load_path (str) : path of reviews written by this script
+
+    Return:
+        (set) the key of every saved review
+    """
+    saved = read_reviews(load_path, columns = KEY_COLUMNS)
+
+    return set(review_key(row) for row in saved.to_dict("records"))
+
+def crawl_new_reviews(first_page, first_url, rate_limiter, seen_keys, cache = None, session = None):
+    """
+    crawl_new_reviews walks the review pages from newest to oldest and stops at
+    the first review that has already been scraped.  Usually the newest
+    reviews all fit on the first page, so only one or two pages are requested.
+
+    Args:
+        first_page (bytes) : html of the first review page
+        first_url (str) : url of the first review page
+        rate_limiter (RateLimiter) : limiter shared by every request
+        seen_keys (set) : review_key of every review scraped before
+        cache (PageCache) : optional on disk page cache
+        session (HttpSession) : session the pages are requested with, see fetch_page
+
+    Return:
+        list of the parsed new reviews, newest first
+    """
+    new_reviews = []
+    page = first_page
+
+    while True:
+
+        for parsed_review in parse_page(page):
+            if review_key(parsed_review) in seen_keys:
+                return new_reviews
+            new_reviews.append(parsed_review)
 
-    parsed_reviews_df.to_csv(save_path, index = False)
+        next_href = parse_pagination(page)[1]
+        if next_href is None:
+            return new_reviews
 
-def sneaky_request(url):
+        page = fetch_page(urljoin(first_url, next_href), rate_limiter, cache, session)
+
+class RateLimiter:
+
+    """
+    RateLimiter is a thread safe token bucket.  Each call to acquire takes a
+    token, blocking until one is available.  Tokens are refilled at `rate` per
+    second up to `burst` tokens, so any number of threads sharing a limiter
+    make at most `rate` requests per second on average.
+
+    Arguments:
+        rate (float): tokens added per second, None for no limit
+        burst (int): maximum number of tokens that can be saved up
+    """
+
+    def __init__(self, rate, burst = 1):
+
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Takes a token, sleeping until the token would have been refilled if the
+        bucket is empty.
+        """
+
+        if not self.rate:
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+
+            # reserve a token even if we have to wait for it, so that threads
+            # queue up behind each other rather than all waking at once
+            self.tokens -= 1
+            wait = -self.tokens / self.rate
+
+        if wait > 0:
+            time.sleep(wait)
+
+def crawl_pages(first_page, first_url, rate_limiter, n_workers = 1, cache = None, session = None):
+    """
+    crawl_pages is a generator over every review page of an airline given the
+    first page.  Pages are yielded in page order as soon as they are fetched,
+    so they can be parsed while the rest of the crawl carries on.
+
+    With more than one worker the number of pages is read from the pagination
+    and the remaining pages are fetched concurrently.  Otherwise, or when the
+    number of pages can't be found, the ">>" link is followed page by page.
+
+    Args:
+        first_page (bytes) : html of the first review page
+        first_url (str) : url of the first review page
+        rate_limiter (RateLimiter) : limiter shared by every request
+        n_workers (int) : number of pages to fetch at the same time
+        cache (PageCache) : optional on disk page cache
+        session (HttpSession) : session the pages are requested with, see fetch_page
+
+    Return:
+        generator of the html of every review page, in page order
+    """
+    n_pages, next_href = parse_pagination(first_page)
+
+    yield first_page
+
+    if n_workers > 1 and n_pages is not None:
+        urls = [page_url(first_url, page) for page in range(2, n_pages + 1)]
+        for page in fetch_pages(urls, rate_limiter, n_workers, cache, session):
+            yield page
+        return
+
+    # The following while loop iterates over each subsequent review page,
+    # terminating when there are no further pages to scrape.
+    while next_href is not None:
+
+        page = fetch_page(urljoin(first_url, next_href), rate_limiter, cache, session)
+        yield page
+
+        # find the next page link, if it is the last page, end the loop
+        next_href = parse_pagination(page)[1]
+
+def fetch_pages(urls, rate_limiter, n_workers, cache = None, session = None):
+    """
+    fetch_pages fetches several pages at once with a bounded pool of threads.
+
+    Args:
+        urls (list) : urls to fetch
+        rate_limiter (RateLimiter) : limiter shared by every request
+        n_workers (int) : maximum number of requests in flight
+        cache (PageCache) : optional on disk page cache
+        session (HttpSession) : session the pages are requested with, see fetch_page
+
+    Return:
+        generator of the html of each page, in the same order as urls
+    """
+    with ThreadPoolExecutor(max_workers = n_workers) as pool:
+        for page in pool.map(lambda url: fetch_page(url, rate_limiter, cache, session), urls):
+            yield page
+
+def fetch_page(url, rate_limiter, cache = None, session = None):
+    """
+    fetch_page waits for the rate limiter then reads a page.
+
+    When a cache is given, pages fetched within the cache's max age are read
+    from disk without any request.  Older pages are revalidated with the
+    server using their ETag/Last-Modified headers, and only downloaded again
+    if they have changed.
+
+    Args:
+        url (str) : url of the page
+        rate_limiter (RateLimiter) : limiter shared by every request
+        cache (PageCache) : optional on disk page cache
+        session (HttpSession) : session the page is requested with, shared by
+                                every request of a crawl so that connections
+                                are reused.  By default a session kept by the
+                                module.
+
+    Return:
+        (bytes) the html of the page
+
+    Raises:
+        FetchError : if the page still couldn't be fetched after its retries
+    """
+    if cache is None:
+        rate_limiter.acquire()
+        return sneaky_request(url, session = session).raise_for_status().content
+
+    entry = cache.get(url)
+    if entry is not None and cache.is_fresh(entry):
+        count("cache_hits")
+        return cache.read(entry)
+
+    rate_limiter.acquire()
+    result = sneaky_request(url, headers = cache.conditional_headers(entry), session = session).raise_for_status()
+
+    # the page hasn't changed since it was cached
+    if entry is not None and result.status == 304:
+        count("not_modified")
+        cache.touch(entry)
+        return cache.read(entry)
+
+    cache.put(url, result.content, etag = result.headers.get("ETag"),
+              last_modified = result.headers.get("Last-Modified"))
+
+    return result.content
+
+def page_url(first_url, page):
+    """
+    page_url builds the url of a review page in the same form as the website's
+    own pagination links, for example `.../airline-reviews/germanwings/page/2/`
+
+    Args:
+        first_url (str) : url of the first review page
+        page (int) : page number, starting at 1
+
+    Return:
+        (str) url of the page
+    """
+    if page == 1:
+        return first_url
+
+    return urljoin(first_url if first_url.endswith("/") else first_url + "/", "page/{}/".format(page))
+
+# session used when none is given, made on first use
+DEFAULT_SESSION = None
+DEFAULT_SESSION_LOCK = threading.Lock()
+
+def default_session():
+    """
+    default_session gives the module's HttpSession, making it the first time.
+    """
+    global DEFAULT_SESSION
+
+    with DEFAULT_SESSION_LOCK:
+        if DEFAULT_SESSION is None:
+            DEFAULT_SESSION = HttpSession(max_connections = 8)
+
+    return DEFAULT_SESSION
+
+def sneaky_request(url, headers = None, session = None):
     """
     sneaky_request is a function designed to get around some pages blocking web scraping.
-    It uses a different User-Agent than the default `python urllib/3.X.X`
+    It uses a different User-Agent than the default `python urllib/3.X.X`, over a
+    kept alive connection, retrying the request if it fails with a 429/5xx answer
+    or a dropped connection.
 
     Args:
         url (str) : url of the website desired to be scraped
+        headers (dict) : additional request headers, for example for a conditional request.
+                         A 304 Not Modified answer has status 304.
+        session (HttpSession) : session to request with, by default the module's
 
     Return:
-        open_url (HTTPResponse) : the HTTP response of the input URL
+        (FetchResult) the status, content, size and latency of the request.  Failed
+        requests are returned rather than raised, check result.ok or call
+        result.raise_for_status()
     """
 
-    #`airlinequality.com` had a blocker for the default `urllib` agent, so this workaround was found in order to correctly scrape the reviews.
-    # Source:
-    # https://stackoverflow.com/questions/16627227/http-error-403-in-python-3-web-scraping
-    #
-    # Enable some default error handling in case the site cannot be accessed, and tell us why.
-    try:
-        req = Request(url, headers={'User-Agent': 'Mozilla/5.0'})
-        open_url = urlopen(req)
-    except HTTPError as error:
-        sys.stdout.write("Error code: ", error.code)
-        sys.stdout.write("The reason for the exception:", error.reason)
-        sys.stdout.flush()
+    #`airlinequality.com` had a blocker for the default `urllib` agent, so the session
+    # sends a browser's User-Agent, see http_session.py
+    if session is None:
+        session = default_session()
 
-    return open_url
+    return session.get(url, headers = headers)
 
 def safe_extract(extracted_tag, replacement_value = None):
     """
@@ -331,6 +610,36 @@ def star_extract(extracted_tag, next_tag = "td", replacement_value = None):
 
     return value
 
+def cli(argv = None):
+    """
+    Runs the scraper from command line arguments, as `python src/scrape_reviews.py`
+    does.  Nothing is parsed or run when the module is imported, so the
+    functions above can be used from other scripts and workers.
+
+    Args:
+        argv (list) : arguments, default the command line's
+    """
+    # load arguments for save path, sleep time and concurrency
+    parser = argparse.ArgumentParser()
+    parser.add_argument("save_path")
+    parser.add_argument("sleep_time")
+    parser.add_argument("--n_workers", type = int, default = 1)
+    parser.add_argument("--airline_url", default = GW_REVIEWS_URL)
+    parser.add_argument("--cache_dir", default = None)
+    parser.add_argument("--cache_max_age", type = float, default = 3600)
+    parser.add_argument("--incremental", action = "store_true")
+    parser.add_argument("--retries", type = int, default = 5)
+    parser.add_argument("--timeout", type = float, default = 30.0)
+    parser.add_argument("--aggregate_dir", default = None)
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    instrumentation.configure_from_args(args)
+
+    main(args.save_path, float(args.sleep_time), airline_url = args.airline_url, n_workers = args.n_workers,
+         cache_dir = args.cache_dir, cache_max_age = args.cache_max_age, incremental = args.incremental,
+         retries = args.retries, timeout = args.timeout, aggregate_dir = args.aggregate_dir)
+
 # call main function
 if __name__ == "__main__":
-    main()
+    cli()
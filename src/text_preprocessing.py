@@ -0,0 +1,219 @@
+#
+# text_preprocessing.py
+#
+# @author: Evan Yathon
+#
+# August 2019
+#
+# text_preprocessing turns review texts and titles into the space separated
+# lemmas used for topic modeling.  Texts are cleaned with a few regular
+# expressions, then run through spaCy in batches with `nlp.pipe`, across
+# several processes if asked, with only the components that the part of
+# speech filter needs (the dependency parser and entity recognizer are
+# disabled).
+#
+# The lemmas of every text are kept in an on disk cache, keyed by a hash of the
+# text and of the settings they were made with: min_token_len, relevant_pos,
+# the removed terms and the spaCy model and version.  Rerunning the topic
+# modeling notebook only sends new reviews to spaCy.
+#
+# Layout of the cache directory:
+#   <sha1 of settings>.json, mapping sha1 of each text to its lemmas
+#
+# Example usage:
+# nlp = load_model("en")
+# reviews["clean_review_text"] = preprocess_texts(reviews["review_text"], nlp, min_token_len = 3,
+#                                                 n_process = 4, cache_dir = "data/token_cache")
+
+import hashlib
+import json
+import os
+import re
+import threading
+
+from instrumentation import stage
+from page_cache import atomic_write
+
+# spaCy components that aren't needed to tag and lemmatize tokens
+DISABLED_COMPONENTS = ["parser", "ner"]
+
+# common terms found in most reviews, which aren't indicative of the things
+# that influenced a recommendation, eg/ germanwings, flight
+REMOVED_TERMS = ["flight", "germanwing", "fly", "review"]
+
+RELEVANT_POS = ["NOUN", "VERB", "ADJ"]
+
+# spaCy models loaded by load_model, by name
+MODELS = {}
+MODELS_LOCK = threading.Lock()
+
+def load_model(name = "en"):
+    """
+    load_model loads a spaCy model with the components that preprocessing
+    doesn't use disabled.  spaCy is imported and each model is loaded once per
+    process, later calls give back the same model.
+
+    Args:
+        name (str) : spaCy model name or shortcut, for example "en"
+
+    Return:
+        spaCy Language object
+    """
+    with MODELS_LOCK:
+        if name not in MODELS:
+            import spacy
+            MODELS[name] = spacy.load(name, disable = DISABLED_COMPONENTS)
+
+        return MODELS[name]
+
+def clean_text(text):
+    """
+    clean_text uses several regex expressions to remove strange characters or
+    unwanted text before the text is tokenized.
+
+    Args:
+        text (str) : the text to be cleaned
+
+    Return:
+        (str) the cleaned, lowercase text
+    """
+    # remove verified emoji
+    text = re.sub(r"✅", "", text)
+
+    # remove verified review and trip verified
+    text = re.sub(r"Verified Review|Trip Verified", "", text)
+
+    # remove anything that is not a word
+    text = re.sub(r"[^\w]", " ", text)
+
+    # replace multiple spaces with a single space
+    text = re.sub(r"\s+", " ", text)
+
+    # remove numbers
+    text = re.sub(r"[0-9]+", "", text)
+
+    # change all text to lowercase
+    text = text.lower()
+
+    # remove common terms found in topic modeling output
+    text = re.sub("|".join(REMOVED_TERMS), " ", text)
+
+    return text
+
+def keep_lemmas(doc, min_token_len = 2, relevant_pos = RELEVANT_POS):
+    """
+    keep_lemmas joins the lemmas of a spaCy doc's tokens, leaving out
+    stopwords, words shorter than min_token_len and parts of speech not in
+    relevant_pos.
+
+    Return:
+        (str) the lemmas, each preceded by a space
+    """
+    processed_text = ""
+
+    for token in doc:
+        if not token.is_stop and len(token.text) >= min_token_len and token.pos_ in relevant_pos:
+            processed_text += " " + token.lemma_
+
+    return processed_text
+
+def preprocess_text(text, nlp, min_token_len = 2, relevant_pos = RELEVANT_POS):
+    """
+    preprocess_text preprocesses a single text.  Use preprocess_texts for
+    more than a handful of texts.
+
+    Args:
+        text (str) : the text to be preprocessed
+        nlp (Language) : spaCy model, as from load_model
+        min_token_len (int) : min_token_length required
+        relevant_pos (list) : a list of relevant pos tags
+
+    Return:
+        (str) the preprocessed text
+    """
+    return keep_lemmas(nlp(clean_text(text)), min_token_len, relevant_pos)
+
+def preprocess_texts(texts, nlp, min_token_len = 2, relevant_pos = RELEVANT_POS, batch_size = 256,
+                     n_process = 1, cache_dir = None):
+    """
+    preprocess_texts preprocesses many texts, giving the same result as
+    preprocess_text on each.  Each distinct text is only processed once, and
+    texts found in the cache aren't processed at all.
+
+    Args:
+        texts (iterable) : the texts to be preprocessed
+        nlp (Language) : spaCy model, as from load_model
+        min_token_len (int) : min_token_length required
+        relevant_pos (list) : a list of relevant pos tags
+        batch_size (int) : number of texts spaCy processes at once
+        n_process (int) : number of processes spaCy runs in
+        cache_dir (str) : optional directory of the lemma cache, created if needed
+
+    Return:
+        list of preprocessed texts, in the order of texts
+    """
+    with stage("preprocess_texts", n_process = n_process) as preprocess_stage:
+        texts = list(texts)
+        keys = [text_hash(text) for text in texts]
+        preprocess_stage.add("items", len(texts))
+
+        cache_path = None
+        lemmas = {}
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok = True)
+            cache_path = os.path.join(cache_dir, settings_hash(nlp, min_token_len, relevant_pos) + ".json")
+            lemmas = load_lemmas(cache_path)
+
+        # texts not in the cache, once each
+        new_texts = {}
+        for key, text in zip(keys, texts):
+            if key not in lemmas and key not in new_texts:
+                new_texts[key] = text
+
+        preprocess_stage.add("spacy_texts", len(new_texts))
+
+        if len(new_texts) > 0:
+            docs = nlp.pipe((clean_text(text) for text in new_texts.values()), batch_size = batch_size,
+                            n_process = n_process)
+            for key, doc in zip(new_texts, docs):
+                lemmas[key] = keep_lemmas(doc, min_token_len, relevant_pos)
+
+            if cache_path is not None:
+                atomic_write(cache_path, json.dumps(lemmas).encode("utf-8"))
+
+        return [lemmas[key] for key in keys]
+
+def text_hash(text):
+    """
+    text_hash gives the sha1 hex digest of a text, the key of its lemmas in
+    the cache.
+    """
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+def settings_hash(nlp, min_token_len, relevant_pos):
+    """
+    settings_hash gives the sha1 hex digest of everything other than the text
+    that changes its lemmas, so that changing a setting starts a new cache
+    file rather than reusing stale lemmas.
+    """
+    import spacy
+
+    settings = {
+        "min_token_len" : min_token_len,
+        "relevant_pos" : sorted(relevant_pos),
+        "removed_terms" : REMOVED_TERMS,
+        "model" : "{}-{}".format(nlp.meta.get("lang"), nlp.meta.get("name")),
+        "model_version" : nlp.meta.get("version"),
+        "spacy_version" : spacy.__version__
+    }
+    return hashlib.sha1(json.dumps(settings, sort_keys = True).encode("utf-8")).hexdigest()
+
+def load_lemmas(cache_path):
+    """
+    load_lemmas reads a cache file, an empty dict if it doesn't exist yet.
+    """
+    try:
+        with open(cache_path, encoding = "utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
@@ -0,0 +1,357 @@
+#
+# topic_model.py
+#
+# @author: Evan Yathon
+#
+# August 2019
+#
+# topic_model is the LDA stage of the topic modeling notebook, kept on disk
+# between runs.  A TopicModel saves its gensim Dictionary, the LDA model and
+# the topic probabilities of every document it has seen.  When it is fit again
+# with a dataset that has new reviews, the saved model is updated with only
+# the new documents using gensim's online `update()`, and topics are only
+# inferred for the new documents.  A full retrain happens the first time, when
+# the model's settings change, or when asked for with `retrain = True`.
+#
+# The online update keeps the saved dictionary, so words first seen in new
+# reviews are ignored until the next full retrain.
+#
+# gensim is only imported once a model is trained, updated or its dictionary
+# or LDA model is used, so a fit whose documents have all been seen reads
+# doc_topics.parquet and nothing else.
+#
+# Layout of the model directory:
+#   dictionary.gensim
+#   lda.gensim (and the files gensim saves alongside it)
+#   doc_topics.parquet, topic probabilities by sha1 of each document
+#   settings.json
+#
+# Example usage:
+# review_model = TopicModel("data/topic_models/review", ["review_luggage_seats", "review_time_delays",
+#                           "review_food_bev_crew"], alpha = 0.5, eta = 0.01)
+# review_topics = review_model.fit(reviews["clean_review_text"])
+
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from instrumentation import stage
+
+class TopicModel:
+
+    """
+    TopicModel fits an LDA model to preprocessed documents and saves it, with
+    the topics of each document, so that later fits only process new documents.
+
+    Arguments:
+        model_dir (str): directory to keep the model in, created if needed
+        topic_names (list): name of each topic, used as the columns of the
+                            topic probabilities.  The number of names is the
+                            number of topics.
+        alpha (float): document topic prior
+        eta (float): topic word prior
+        passes (int): passes over the corpus when training from scratch
+        update_passes (int): passes over the new documents when updating
+        random_state (int): seed of the model
+        workers (int): train with gensim's LdaMulticore on this many worker
+                       processes, or with LdaModel when None
+
+    Attributes:
+        dictionary (Dictionary): mapping between words and integer ids,
+                                 loaded on first use
+        lda (LdaModel): the fitted model, loaded on first use
+        doc_topics (pd.DataFrame): topic probabilities of every document seen,
+                                   indexed by the sha1 of the document
+    """
+
+    def __init__(self, model_dir, topic_names, alpha = "symmetric", eta = None, passes = 5,
+                 update_passes = 1, random_state = None, workers = None):
+
+        self.model_dir = model_dir
+        self.topic_names = list(topic_names)
+        self.num_topics = len(self.topic_names)
+        self.alpha = alpha
+        self.eta = eta
+        self.passes = passes
+        self.update_passes = update_passes
+        self.random_state = random_state
+        self.workers = workers
+
+        self._dictionary = None
+        self._lda = None
+        self.doc_topics = None
+
+        os.makedirs(model_dir, exist_ok = True)
+
+    def settings(self):
+        """
+        The settings that a saved model must have been trained with to be
+        updated rather than retrained.
+        """
+        return {
+            "num_topics" : self.num_topics,
+            "alpha" : self.alpha,
+            "eta" : self.eta,
+            "passes" : self.passes,
+            "random_state" : self.random_state,
+            "multicore" : self.workers is not None
+        }
+
+    @property
+    def dictionary(self):
+        """
+        The gensim Dictionary, loaded from the model directory on first use.
+        """
+        if self._dictionary is None and self.doc_topics is not None:
+            self.load_gensim()
+        return self._dictionary
+
+    @dictionary.setter
+    def dictionary(self, dictionary):
+        self._dictionary = dictionary
+
+    @property
+    def lda(self):
+        """
+        The LDA model, loaded from the model directory on first use.
+        """
+        if self._lda is None and self.doc_topics is not None:
+            self.load_gensim()
+        return self._lda
+
+    @lda.setter
+    def lda(self, lda):
+        self._lda = lda
+
+    def path(self, name):
+        """
+        Path of one of the model's files.
+        """
+        return os.path.join(self.model_dir, name)
+
+    def load(self):
+        """
+        Loads the saved document topics, if there is a model trained with the
+        same settings.  The dictionary and LDA model are loaded when first used.
+
+        Return:
+            True if a model was loaded, False otherwise
+        """
+        try:
+            with open(self.path("settings.json")) as f:
+                saved_settings = json.load(f)
+        except (OSError, ValueError):
+            return False
+
+        if saved_settings != json.loads(json.dumps(self.settings())):
+            return False
+
+        self.doc_topics = pd.read_parquet(self.path("doc_topics.parquet"))
+        self._dictionary = None
+        self._lda = None
+
+        return True
+
+    def load_gensim(self):
+        """
+        Loads the saved dictionary and LDA model.
+        """
+        from gensim.corpora import Dictionary
+        from gensim.models import LdaModel, LdaMulticore
+
+        model_class = LdaMulticore if self.workers is not None else LdaModel
+        self._dictionary = Dictionary.load(self.path("dictionary.gensim"))
+        self._lda = model_class.load(self.path("lda.gensim"))
+
+    def save(self):
+        """
+        Saves the dictionary, model and document topics.  The settings are
+        written last, so an interrupted save is retrained rather than loaded.
+        """
+        if os.path.exists(self.path("settings.json")):
+            os.remove(self.path("settings.json"))
+
+        self.dictionary.save(self.path("dictionary.gensim"))
+        self.lda.save(self.path("lda.gensim"))
+        self.doc_topics.to_parquet(self.path("doc_topics.parquet"))
+
+        with open(self.path("settings.json"), "w") as f:
+            json.dump(self.settings(), f)
+
+    def corpus(self, docs):
+        """
+        Converts preprocessed documents to bags of words with the model's
+        dictionary.
+
+        Arguments:
+            docs (iterable): documents as space separated tokens
+
+        Return:
+            list of bags of words, lists of (word id, count)
+        """
+        return [self.dictionary.doc2bow(doc.split()) for doc in docs]
+
+    def train(self, docs):
+        """
+        Trains the dictionary and model from scratch.
+
+        Arguments:
+            docs (list): documents as space separated tokens
+        """
+        from gensim.corpora import Dictionary
+        from gensim.models import LdaModel, LdaMulticore
+
+        with stage("TopicModel.train", workers = self.workers) as train_stage:
+            train_stage.add("items", len(docs))
+
+            self.dictionary = Dictionary(doc.split() for doc in docs)
+            corpus = self.corpus(docs)
+
+            if self.workers is not None:
+                self.lda = LdaMulticore(corpus = corpus, id2word = self.dictionary, num_topics = self.num_topics,
+                                        alpha = self.alpha, eta = self.eta, passes = self.passes,
+                                        random_state = self.random_state, workers = self.workers)
+            else:
+                self.lda = LdaModel(corpus = corpus, id2word = self.dictionary, num_topics = self.num_topics,
+                                    alpha = self.alpha, eta = self.eta, passes = self.passes,
+                                    random_state = self.random_state)
+
+            self.doc_topics = self.infer(docs, corpus)
+
+    def update(self, docs):
+        """
+        Updates the model with documents it hasn't seen, and infers their topics.
+
+        Arguments:
+            docs (list): new documents as space separated tokens
+        """
+        with stage("TopicModel.update") as update_stage:
+            update_stage.add("items", len(docs))
+
+            corpus = self.corpus(docs)
+
+            self.lda.update(corpus, passes = self.update_passes)
+
+            self.doc_topics = pd.concat([self.doc_topics, self.infer(docs, corpus)])
+
+    def infer(self, docs, corpus):
+        """
+        Infers the topic probabilities of documents.
+
+        Arguments:
+            docs (list): documents as space separated tokens
+            corpus (list): the documents as bags of words
+
+        Return:
+            pandas dataframe of topic probabilities, one column per topic name,
+            indexed by the sha1 of each document
+        """
+        return document_topics(self.lda, corpus, self.topic_names,
+                               index = pd.Index([doc_hash(doc) for doc in docs], name = "doc_hash"))
+
+    def fit(self, docs, retrain = False):
+        """
+        Fits the model to a dataset, updating the saved model with the
+        documents it hasn't seen or retraining it from scratch, then saves it.
+
+        Arguments:
+            docs (iterable): documents as space separated tokens, for example
+                             the clean_review_text column
+            retrain (bool): retrain from scratch even if a saved model exists
+
+        Return:
+            pandas dataframe of topic probabilities, one row per document in
+            the order of docs, one column per topic name
+        """
+        docs = list(docs)
+
+        changed = True
+        if retrain or not self.load():
+            self.train(docs)
+        else:
+            seen = set(self.doc_topics.index)
+            new_docs = list(dict.fromkeys(doc for doc in docs if doc_hash(doc) not in seen))
+            if len(new_docs) > 0:
+                self.update(new_docs)
+            else:
+                changed = False
+
+        # a document can appear more than once in doc_topics after training
+        doc_topics = self.doc_topics[~self.doc_topics.index.duplicated()]
+        self.doc_topics = doc_topics
+        if changed:
+            self.save()
+
+        return doc_topics.loc[[doc_hash(doc) for doc in docs]].reset_index(drop = True)
+
+def document_topic_matrix(lda, corpus, minimum_probability = None, chunksize = 2000, sparse = False):
+    """
+    document_topic_matrix infers the topic probabilities of a corpus with one
+    call to the model's batched `inference` per chunk of documents, rather
+    than one call and a list of (topic, probability) tuples per document.  The
+    result is the same as `lda.get_document_topics` placed into a matrix.
+
+    Args:
+        lda (LdaModel) : a fitted model
+        corpus (iterable) : bags of words, read a chunk at a time so that only
+                            one chunk of documents is held in memory
+        minimum_probability (float) : probabilities below this are set to 0,
+                                      default the model's minimum_probability
+        chunksize (int) : number of documents inferred at once
+        sparse (bool) : return a scipy.sparse csr matrix instead of an array
+
+    Return:
+        documents by topics matrix of probabilities
+    """
+    import scipy.sparse
+    from gensim.utils import grouper
+
+    if minimum_probability is None:
+        minimum_probability = lda.minimum_probability
+    # as get_document_topics, which never keeps topics with no probability
+    minimum_probability = max(minimum_probability, 1e-8)
+
+    with stage("document_topic_matrix") as inference_stage:
+        blocks = []
+        for chunk in grouper(corpus, chunksize):
+            gamma, _ = lda.inference(chunk)
+            inference_stage.add("items", len(chunk))
+            probs = gamma / gamma.sum(axis = 1)[:, np.newaxis]
+            probs[probs < minimum_probability] = 0.0
+            blocks.append(scipy.sparse.csr_matrix(probs) if sparse else probs)
+
+        if len(blocks) == 0:
+            empty = np.zeros((0, lda.num_topics))
+            return scipy.sparse.csr_matrix(empty) if sparse else empty
+
+        return scipy.sparse.vstack(blocks, format = "csr") if sparse else np.vstack(blocks)
+
+def document_topics(lda, corpus, topic_names, index = None, minimum_probability = None, chunksize = 2000):
+    """
+    document_topics gives the topic probabilities of a corpus as a dataframe
+    with the interpreted topic names as columns.
+
+    Args:
+        lda (LdaModel) : a fitted model
+        corpus (iterable) : bags of words
+        topic_names (list) : name of each of the model's topics, in order
+        index (pd.Index) : optional index of the documents
+        minimum_probability (float) : probabilities below this are set to 0
+        chunksize (int) : number of documents inferred at once
+
+    Return:
+        pandas dataframe of topic probabilities, one column per topic name
+    """
+    matrix = document_topic_matrix(lda, corpus, minimum_probability = minimum_probability,
+                                   chunksize = chunksize)
+
+    return pd.DataFrame(matrix, columns = topic_names, index = index)
+
+def doc_hash(doc):
+    """
+    doc_hash gives the sha1 hex digest of a preprocessed document.
+    """
+    return hashlib.sha1(doc.encode("utf-8")).hexdigest()
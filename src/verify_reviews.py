@@ -0,0 +1,240 @@
+#
+# verify_reviews.py
+#
+# @author: Evan Yathon
+#
+# August 2019
+#
+# verify_reviews checks scraped reviews against the reviews given in
+# data/given_4U_reviews.txt.  The given file is read into structured records,
+# one per block of lines:
+#
+#   "title"
+#   Name (Country) 16th October 2015
+#   score out of 10, or na
+#   review text
+#   Attribute<tab>Value, one line per attribute
+#
+# Reviews are matched on a hash of their normalized text, so that the
+# whitespace and unicode differences between the given file and the website
+# (for example "on  time" on the website and "on time" in the given file) don't hide a match.  The
+# scraped hashes are put in a dict and the given file is streamed past it
+# once, so verifying takes time linear in the size of both datasets and only
+# the scraped hashes and the unmatched given reviews are held in memory.
+#
+# sample usage
+# python src/verify_reviews.py data/scraped_gw_reviews.csv data/given_4U_reviews.txt
+#
+# Example usage:
+# result = verify_reviews(read_reviews("data/scraped_gw_reviews.csv"), read_given_reviews("data/given_4U_reviews.txt"))
+# result["new"][["date_of_review", "title"]]
+
+# utils
+import argparse
+import hashlib
+import re
+import sys
+import unicodedata
+
+import pandas as pd
+
+from review_store import read_reviews
+
+# attribute labels of the given file and the scraped column holding the same
+# value.  Star ratings are given as the text "12345" of the stars rather than
+# the number filled in, so they're kept under their label only.
+ATTRIBUTE_COLUMNS = {
+    "Aircraft" : "aircraft",
+    "Type Of Traveller" : "traveller_type",
+    "Cabin Flown" : "seat_type",
+    "Route" : "route",
+    "Date Flown" : "date_flown",
+    "Recommended" : "recommendation"
+}
+
+# Name (Country) 16th October 2015, with the country sometimes left out
+NAME_LINE = re.compile(r"^(?P<name>.*?)(?: \((?P<country>[^()]*)\))?\s+"
+                       r"(?P<date>\d{1,2}(?:st|nd|rd|th)? \w+ \d{4})\s*$")
+
+# columns of a given review record, in order
+GIVEN_COLUMNS = (["title", "reviewer_name", "reviewer_country", "date_of_review", "review_value",
+                  "review_text"] + list(ATTRIBUTE_COLUMNS.values()) + ["attributes"])
+
+WHITESPACE = re.compile(r"\s+")
+
+# "✅ Trip Verified |" and "Verified Review |" prefixes added to newer reviews
+VERIFIED_PREFIX = re.compile(r"^\s*(?:✅\s*)?(?:trip verified|verified review|not verified)\s*\|\s*",
+                             re.IGNORECASE)
+
+def main(load_path, old_data_path, encoding = "cp1252"):
+
+    reviews = read_reviews(load_path)
+    result = verify_reviews(reviews, read_given_reviews(old_data_path, encoding = encoding))
+
+    sys.stdout.write("{} matched, {} missing from the scraped reviews, {} new\n".format(
+        len(result["matched"]), len(result["missing"]), len(result["new"])))
+
+    for name in ["missing", "new"]:
+        if len(result[name]) > 0:
+            sys.stdout.write("\n{} reviews:\n".format(name.capitalize()))
+            for date, title in zip(result[name]["date_of_review"], result[name]["title"]):
+                sys.stdout.write("{} : {}\n".format(date, title))
+
+    sys.stdout.flush()
+
+def read_given_reviews(load_path, encoding = "cp1252"):
+    """
+    read_given_reviews is a generator over the review blocks of the given
+    reviews file.  The file is read a line at a time, so it can be larger
+    than memory.
+
+    Args:
+        load_path (str) : path of the given reviews, data/given_4U_reviews.txt
+        encoding (str) : encoding of the file, which was saved as Windows-1252
+
+    Return:
+        generator of dicts, see parse_given_block
+    """
+    block = []
+
+    with open(load_path, encoding = encoding) as f:
+        for line in f:
+            line = line.rstrip("\r\n")
+
+            if line.strip() == "":
+                if len(block) > 0:
+                    yield parse_given_block(block)
+                block = []
+            else:
+                block.append(line)
+
+    if len(block) > 0:
+        yield parse_given_block(block)
+
+def parse_given_block(lines):
+    """
+    parse_given_block reads one review of the given reviews file.  The review
+    text is every line between the score and the first attribute line, so
+    reviews with line breaks are kept whole.
+
+    Args:
+        lines (list) : the block's lines, without line endings
+
+    Return:
+        (dict) a value for each column in GIVEN_COLUMNS: the scraped columns
+        the block has, and attributes, a dict of every attribute by its
+        label.  Values that aren't in the block are None.
+    """
+    record = dict.fromkeys(GIVEN_COLUMNS)
+
+    # the attribute lines are the only ones with tabs
+    n_attributes = 0
+    while n_attributes < len(lines) and "\t" in lines[len(lines) - n_attributes - 1]:
+        n_attributes += 1
+    header, attribute_lines = lines[:len(lines) - n_attributes], lines[len(lines) - n_attributes:]
+
+    record["title"] = header[0].strip() if len(header) > 0 else None
+
+    if len(header) > 1:
+        match = NAME_LINE.match(header[1].strip())
+        if match is not None:
+            record["reviewer_name"] = match.group("name")
+            record["reviewer_country"] = match.group("country")
+            record["date_of_review"] = match.group("date")
+        else:
+            record["reviewer_name"] = header[1].strip()
+
+    if len(header) > 2:
+        score = header[2].strip()
+        record["review_value"] = int(score) if score.isdigit() else None
+
+    if len(header) > 3:
+        record["review_text"] = "\n".join(header[3:])
+
+    attributes = {}
+    for line in attribute_lines:
+        label, value = line.split("\t", 1)
+        attributes[label.strip()] = value.strip()
+        if label.strip() in ATTRIBUTE_COLUMNS:
+            record[ATTRIBUTE_COLUMNS[label.strip()]] = value.strip()
+    record["attributes"] = attributes
+
+    return record
+
+def normalize_text(text):
+    """
+    normalize_text puts review text in a canonical form for matching:
+    unicode compatibility characters and case are folded, verified prefixes
+    are removed and every run of whitespace becomes a single space.
+
+    Args:
+        text (str) : review text
+
+    Return:
+        (str) the normalized text, "" for missing text
+    """
+    if text is None or (isinstance(text, float) and text != text):
+        return ""
+
+    text = unicodedata.normalize("NFKC", str(text))
+    text = VERIFIED_PREFIX.sub("", text)
+
+    return WHITESPACE.sub(" ", text).strip().casefold()
+
+def text_hash(text):
+    """
+    text_hash gives the sha1 digest of a review's normalized text, a fixed 20
+    bytes to hold in memory however long the review is.
+    """
+    return hashlib.sha1(normalize_text(text).encode("utf-8")).digest()
+
+def verify_reviews(reviews, given_reviews, text_column = "review_text"):
+    """
+    verify_reviews joins scraped reviews to the given reviews on the hash of
+    their normalized text.
+
+    Args:
+        reviews (pd.DataFrame) : scraped reviews
+        given_reviews (iterable) : given review records, as from read_given_reviews
+        text_column (str) : column of reviews to match on
+
+    Return:
+        dict of pandas dataframes
+            matched : scraped reviews found in the given reviews
+            missing : given reviews not found in the scraped reviews
+            new : scraped reviews not in the given reviews
+    """
+    # positions of the scraped reviews with each hash
+    index = {}
+    for position, text in enumerate(reviews[text_column]):
+        index.setdefault(text_hash(text), []).append(position)
+
+    matched_hashes = set()
+    missing = []
+
+    for record in given_reviews:
+        digest = text_hash(record["review_text"])
+        if digest in index:
+            matched_hashes.add(digest)
+        else:
+            missing.append(record)
+
+    matched = sorted(position for digest in matched_hashes for position in index[digest])
+    new = sorted(position for digest, positions in index.items()
+                 if digest not in matched_hashes for position in positions)
+
+    return {
+        "matched" : reviews.iloc[matched],
+        "missing" : pd.DataFrame(missing, columns = GIVEN_COLUMNS),
+        "new" : reviews.iloc[new]
+    }
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("load_path")
+    parser.add_argument("old_data_path")
+    parser.add_argument("--encoding", default = "cp1252")
+    args = parser.parse_args()
+
+    main(args.load_path, args.old_data_path, encoding = args.encoding)